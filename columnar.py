@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+from argparse import ArgumentParser
+from array import array
+from datetime import date
+
+
+MAGIC = b'SDBCOL1\0'
+VERSION = 1
+ALIGN = 8
+MISSING_INT = -2 ** 31
+_EPOCH = date(1970, 1, 1).toordinal()
+_HEAD = struct.Struct('<8sQ')
+
+# Kind of every known field, everything else is stored as JSON text.
+SCHEMA = {
+    'wgk': 'int',
+    'vwvws': 'int',
+    'pc_cid': 'int',
+    'molmass': 'float',
+    'agw': 'float',
+    'bgw': 'float',
+    'ioelv': 'float',
+    'review_date': 'date',
+    'art_name': 'str',
+    'art_num': 'str',
+    'betrsichv': 'str',
+    'cas': 'str',
+    'color': 'str',
+    'eg_num': 'str',
+    'formula': 'str',
+    'inchi': 'str',
+    'inchikey': 'str',
+    'iupac_de': 'str',
+    'iupac_en': 'str',
+    'kemler': 'str',
+    'lgk_trgs510': 'str',
+    'name': 'str',
+    'name_en': 'str',
+    'odor': 'str',
+    'producer': 'str',
+    'signal': 'str',
+    'smiles': 'str',
+    'source': 'str',
+    'state': 'str',
+    'structure': 'str',
+    'h': 'codes',
+    'p': 'codes',
+    'euh': 'codes',
+    'symbols': 'codes',
+}
+
+
+def iter_json_records(source):
+    """
+    Yields all parsed chemicals from an ``all.json`` file or from a result
+    directory with the ``x/{name} SDB.json`` layout.
+
+    :parameters:
+        source : str
+            Path to a JSON file or to a result directory.
+    """
+    if os.path.isdir(source):
+        pattern = os.path.join(source, '*', '* SDB.json')
+        for filename in sorted(glob.glob(pattern)):
+            with open(filename, encoding='utf-8') as fp:
+                yield json.load(fp)
+    else:
+        with open(source, encoding='utf-8') as fp:
+            data = json.load(fp)
+        for chem in data:
+            if chem:
+                yield chem
+
+
+def _to_int(value):
+    if value is None or isinstance(value, bool):
+        return MISSING_INT
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING_INT
+
+
+def _to_float(value):
+    if value is None or isinstance(value, bool):
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _to_day(value):
+    if isinstance(value, date):
+        return value.toordinal() - _EPOCH
+    try:
+        return date.fromisoformat(str(value)[:10]).toordinal() - _EPOCH
+    except ValueError:
+        return MISSING_INT
+
+
+class _ColumnBuilder:
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.offsets = array('Q', [0])
+        if kind in ('int', 'date'):
+            self.values = array('i')
+        elif kind == 'float':
+            self.values = array('d')
+        elif kind == 'codes':
+            self.values = array('I')
+            self.vocabulary = {}
+        else:
+            self.values = bytearray()
+
+    def append(self, value):
+        if self.kind == 'int':
+            self.values.append(_to_int(value))
+        elif self.kind == 'date':
+            self.values.append(_to_day(value))
+        elif self.kind == 'float':
+            self.values.append(_to_float(value))
+        elif self.kind == 'codes':
+            for code in value or []:
+                idx = self.vocabulary.setdefault(code, len(self.vocabulary))
+                self.values.append(idx)
+            self.offsets.append(len(self.values))
+        else:
+            if self.kind == 'str':
+                text = '' if value is None else str(value)
+            else:
+                text = json.dumps(value, sort_keys=True)
+            self.values.extend(text.encode('utf-8'))
+            self.offsets.append(len(self.values))
+
+    def fill(self, count):
+        # Pad columns of fields which appear only in later records
+        for _ in range(count):
+            self.append(None)
+
+    def buffers(self):
+        if self.kind in ('int', 'date', 'float'):
+            return [('values', self.values.typecode, self.values)]
+        if self.kind == 'codes':
+            values = self.values
+            if len(self.vocabulary) < 2 ** 16:
+                values = array('H', values)
+            return [('offsets', 'Q', self.offsets),
+                    ('values', values.typecode, values)]
+        return [('offsets', 'Q', self.offsets), ('values', 'B', self.values)]
+
+
+def export_corpus(records, filename):
+    """
+    Stores the given chemicals column by column in one file.
+
+    :parameters:
+        records : iterable
+            Parsed chemicals (dicts as written by ``sdbparser.run``).
+        filename : str
+            The file to write.
+
+    :returns: Number of stored chemicals.
+    :rtype: int
+    """
+    columns = {}
+    count = 0
+    for chem in records:
+        for key in chem:
+            if key not in columns:
+                columns[key] = _ColumnBuilder(key, SCHEMA.get(key, 'json'))
+                columns[key].fill(count)
+        for key, column in columns.items():
+            column.append(chem.get(key))
+        count += 1
+    header = dict(version=VERSION, count=count, byteorder=sys.byteorder,
+                  columns={})
+    chunks = []
+    pos = 0
+    for name, column in sorted(columns.items()):
+        info = dict(kind=column.kind, buffers={})
+        if column.kind == 'codes':
+            info['vocabulary'] = sorted(column.vocabulary,
+                                        key=column.vocabulary.get)
+        for part, typecode, values in column.buffers():
+            data = bytes(values)
+            info['buffers'][part] = [typecode, pos, len(data)]
+            chunks.append(data)
+            pos += len(data)
+            pad = -pos % ALIGN
+            if pad:
+                chunks.append(b'\0' * pad)
+                pos += pad
+        header['columns'][name] = info
+    raw_header = json.dumps(header, sort_keys=True).encode('utf-8')
+    raw_header += b' ' * (-(len(raw_header) + _HEAD.size) % ALIGN)
+    tmp_name = '{}.tmp'.format(filename)
+    with open(tmp_name, 'wb') as fp:
+        fp.write(_HEAD.pack(MAGIC, len(raw_header)))
+        fp.write(raw_header)
+        for chunk in chunks:
+            fp.write(chunk)
+    os.replace(tmp_name, filename)
+    return count
+
+
+class StringColumn:
+    """Lazily decoded text (or JSON) values backed by the mapped file."""
+
+    def __init__(self, offsets, blob, as_json=False):
+        self.offsets = offsets
+        self.blob = blob
+        self.as_json = as_json
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        raw = str(self.blob[self.offsets[idx]:self.offsets[idx + 1]], 'utf-8')
+        if self.as_json:
+            return json.loads(raw)
+        return raw
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class CodesColumn:
+    """Code lists (H, P, EUH, GHS) as offsets into a vocabulary array."""
+
+    def __init__(self, offsets, values, vocabulary):
+        self.offsets = offsets
+        self.values = values
+        self.vocabulary = vocabulary
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return [self.vocabulary[x] for x in self.values[start:end]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def code_id(self, code):
+        try:
+            return self.vocabulary.index(code)
+        except ValueError:
+            return None
+
+    def rows_with(self, code):
+        """Returns the row numbers of all chemicals carrying ``code``."""
+        cid = self.code_id(code)
+        if cid is None:
+            return []
+        rows = []
+        offsets = self.offsets
+        values = self.values
+        for idx in range(len(self)):
+            if cid in values[offsets[idx]:offsets[idx + 1]]:
+                rows.append(idx)
+        return rows
+
+
+class Corpus:
+    """
+    Read only, memory mapped view of a file written by ``export_corpus``.
+    Numeric columns are returned as ``memoryview`` objects without copying,
+    missing integers and dates are ``MISSING_INT``, missing floats are NaN
+    and dates are days since 1970-01-01.
+    """
+
+    def __init__(self, filename):
+        self._fp = open(filename, 'rb')
+        self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = _HEAD.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a columnar SDB corpus'.format(filename))
+        self.header = json.loads(self._map[_HEAD.size:_HEAD.size + size])
+        if self.header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError('Corpus was written with different byte order')
+        self._base = _HEAD.size + size
+        self._view = memoryview(self._map)
+        self._buffers = []
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def names(self):
+        return list(self.header['columns'])
+
+    def _buffer(self, info, part):
+        typecode, offset, length = info['buffers'][part]
+        start = self._base + offset
+        buf = self._view[start:start + length].cast(typecode)
+        self._buffers.append(buf)
+        return buf
+
+    def column(self, name):
+        if name in self._columns:
+            return self._columns[name]
+        info = self.header['columns'][name]
+        kind = info['kind']
+        if kind in ('int', 'date', 'float'):
+            col = self._buffer(info, 'values')
+        elif kind == 'codes':
+            col = CodesColumn(self._buffer(info, 'offsets'),
+                              self._buffer(info, 'values'),
+                              info['vocabulary'])
+        else:
+            col = StringColumn(self._buffer(info, 'offsets'),
+                               self._buffer(info, 'values'),
+                               kind == 'json')
+        self._columns[name] = col
+        return col
+
+    def value(self, name, idx):
+        kind = self.header['columns'][name]['kind']
+        value = self.column(name)[idx]
+        if kind in ('int', 'date') and value == MISSING_INT:
+            return None
+        if kind == 'float' and math.isnan(value):
+            return None
+        if kind == 'date':
+            return date.fromordinal(value + _EPOCH).strftime('%Y-%m-%d')
+        return value
+
+    def record(self, idx):
+        return {name: self.value(name, idx) for name in self.names}
+
+    def records(self):
+        for idx in range(len(self)):
+            yield self.record(idx)
+
+    def close(self):
+        self._columns = {}
+        for buf in getattr(self, '_buffers', []):
+            buf.release()
+        self._buffers = []
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._view = None
+        if not self._map.closed:
+            self._map.close()
+        self._fp.close()
+
+
+def load(filename):
+    return Corpus(filename)
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Convert parsed SDB data from and to a '
+                       'memory mapped columnar corpus file.')
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    e = sub.add_parser('export', help='Write a columnar corpus file')
+    e.add_argument('source', help='all.json or result directory')
+    e.add_argument('outfile', help='Corpus file to write')
+    i = sub.add_parser('import', help='Write the corpus back as JSON')
+    i.add_argument('infile', help='Corpus file to read')
+    i.add_argument('outfile', help='JSON file to write (like all.json)')
+    n = sub.add_parser('info', help='Show the columns of a corpus file')
+    n.add_argument('infile', help='Corpus file to read')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    if args.command == 'export':
+        num = export_corpus(iter_json_records(args.source), args.outfile)
+        print('Stored {} chemicals in {}'.format(num, args.outfile))
+    elif args.command == 'import':
+        with load(args.infile) as corpus:
+            data = list(corpus.records())
+        with open(args.outfile, 'w', encoding='utf-8') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+    else:
+        with load(args.infile) as corpus:
+            print('Chemicals:', len(corpus))
+            for name in corpus.names:
+                print('  {:<16} {}'.format(
+                    name, corpus.header['columns'][name]['kind']))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+
+from argparse import ArgumentParser
+
+from prepare_mongodata import Archive, clean_chem, iter_data
+
+
+SNAPSHOT_FILE = 'export_snapshot.json'
+BULK_SIZE = 500
+
+
+def record_hash(chem):
+    raw = json.dumps(chem, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def load_snapshot(filename):
+    if not os.path.isfile(filename):
+        return dict(records={}, files={})
+    with open(filename, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def save_snapshot(filename, snapshot):
+    tmp_name = '{}.tmp'.format(filename)
+    with open(tmp_name, 'w', encoding='utf-8') as fp:
+        json.dump(snapshot, fp, sort_keys=True)
+    os.replace(tmp_name, filename)
+
+
+class FileSink:
+    """Writes the upserts and deletes as NDJSON files."""
+
+    def __init__(self, batch_dir):
+        self.upserts = open(os.path.join(batch_dir, 'upserts.ndjson'), 'w',
+                            encoding='utf-8')
+        self.deletes = open(os.path.join(batch_dir, 'deletes.ndjson'), 'w',
+                            encoding='utf-8')
+
+    def upsert(self, doc):
+        self.upserts.write(json.dumps(doc, sort_keys=True))
+        self.upserts.write('\n')
+
+    def delete(self, key):
+        self.deletes.write(json.dumps({'_id': key}))
+        self.deletes.write('\n')
+
+    def close(self):
+        self.upserts.close()
+        self.deletes.close()
+
+
+class MemorySink:
+    """
+    Stand-in for a MongoDB collection, a dict of documents by ``_id``. If
+    a filename is given, the collection is loaded from and saved to it, so
+    repeated delta exports can be checked against a full export.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.docs = {}
+        if filename and os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as fp:
+                self.docs = json.load(fp)
+
+    def upsert(self, doc):
+        self.docs[doc['_id']] = doc
+
+    def delete(self, key):
+        self.docs.pop(key, None)
+
+    def close(self):
+        if self.filename:
+            save_snapshot(self.filename, self.docs)
+
+
+class MongoSink:
+    """Sends the changes as bulk upserts and deletes to MongoDB."""
+
+    def __init__(self, uri, database='msds', collection='chemicals'):
+        import pymongo
+        self._ops = pymongo
+        self.client = pymongo.MongoClient(uri)
+        self.collection = self.client[database][collection]
+        self.pending = []
+
+    def _flush(self):
+        if self.pending:
+            self.collection.bulk_write(self.pending, ordered=False)
+            self.pending = []
+
+    def upsert(self, doc):
+        self.pending.append(self._ops.ReplaceOne({'_id': doc['_id']}, doc,
+                                                 upsert=True))
+        if len(self.pending) >= BULK_SIZE:
+            self._flush()
+
+    def delete(self, key):
+        self.pending.append(self._ops.DeleteOne({'_id': key}))
+        if len(self.pending) >= BULK_SIZE:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.client.close()
+
+
+def open_sink(spec, batch_dir):
+    """
+    ``file`` (NDJSON in the batch directory), ``memory[:FILE]`` or a
+    ``mongodb://`` URI (``mongodb://host/db.collection``).
+    """
+    if not spec or spec == 'file':
+        return FileSink(batch_dir)
+    if spec.startswith('memory'):
+        return MemorySink(spec.partition(':')[2] or None)
+    if spec.startswith('mongodb://'):
+        uri, _, target = spec.rpartition('/')
+        database, _, collection = target.partition('.')
+        return MongoSink(uri, database or 'msds', collection or 'chemicals')
+    raise ValueError('Unknown sink: {}'.format(spec))
+
+
+def _make_batch_dir(outdir):
+    """
+    Creates a new batch directory named by the time, with a counter if
+    there is already a batch of this second (never reused).
+    """
+    name = time.strftime('delta-%Y%m%d-%H%M%S')
+    num = 0
+    while True:
+        batch_dir = os.path.join(outdir, name if not num else
+                                 '{}-{}'.format(name, num))
+        try:
+            os.makedirs(batch_dir)
+        except FileExistsError:
+            num += 1
+            continue
+        return batch_dir
+
+
+def _file_crc(path, known):
+    # The mtime only tells when the CRC of the last export can be reused
+    st = os.stat(path)
+    old = known.get(path)
+    if old is not None and old[:2] == [st.st_size, st.st_mtime]:
+        return old
+    with open(path, 'rb') as fp:
+        crc = zlib.crc32(fp.read())
+    return [st.st_size, st.st_mtime, crc]
+
+
+def _file_changed(old, new):
+    """Compares size and CRC, a touched or copied file is unchanged."""
+    return old is None or [old[0], old[2]] != [new[0], new[2]]
+
+
+def _relative(path, root=None):
+    """
+    The path below ``root`` (by default the file system root), the ID of a
+    file in the records and archives.
+    """
+    if root is not None:
+        return os.path.relpath(path, root).replace(os.sep, '/')
+    path = os.path.splitdrive(os.path.abspath(path))[1]
+    return path.replace(os.sep, '/').lstrip('/')
+
+
+def export_delta(infile, outdir, sink='file', snapshot_file=None,
+                 root=None):
+    """
+    Compares the current parse results with the last exported snapshot
+    and emits only inserted, updated and deleted records. New or changed
+    PDFs and structures are stored in the zip files of the batch directory.
+    The snapshot is only updated after the sink accepted all changes.
+    Without changes no batch directory is kept.
+
+    :parameters:
+        infile : str
+            all.json (or NDJSON) with the current parse results.
+        outdir : str
+            Directory for the snapshot and the batch directories.
+        sink : str
+            Where to send the changes (see ``open_sink``).
+        snapshot_file : str
+            Defaults to ``export_snapshot.json`` in outdir.
+        root : str
+            The PDFs and structures are named (and the records identified)
+            by their path relative to this directory.
+
+    :returns: Batch directory (None without changes) and statistics.
+    :rtype: tuple
+    """
+    snapshot_file = snapshot_file or os.path.join(outdir, SNAPSHOT_FILE)
+    snapshot = load_snapshot(snapshot_file)
+    old_records = snapshot['records']
+    old_files = snapshot['files']
+    os.makedirs(outdir, exist_ok=True)
+    batch_dir = _make_batch_dir(outdir)
+    records = {}
+    files = {}
+    stats = dict(inserted=0, updated=0, deleted=0, unchanged=0, files=0)
+    target = open_sink(sink, batch_dir)
+    sdbs = Archive(os.path.join(batch_dir, 'sdbs.zip'))
+    structures = Archive(os.path.join(batch_dir, 'structures.zip'))
+    archives = dict(source=sdbs, structure=structures)
+    with sdbs, structures:
+        for chem in iter_data(infile):
+            if not chem:
+                continue
+            chem = clean_chem(chem)
+            new_files = []
+            crcs = {}
+            for key in ('source', 'structure'):
+                path = chem[key]
+                if not path:
+                    continue
+                files[path] = _file_crc(path, old_files)
+                crcs[key] = files[path][2]
+                if _file_changed(old_files.get(path), files[path]):
+                    new_files.append((key, path))
+                chem[key] = _relative(path, root)
+            doc_id = chem['source'] or chem['name']
+            chem['_id'] = doc_id
+            digest = record_hash([chem, crcs])
+            records[doc_id] = digest
+            if old_records.get(doc_id) == digest:
+                stats['unchanged'] += 1
+                continue
+            stats['updated' if doc_id in old_records else 'inserted'] += 1
+            target.upsert(chem)
+            for key, path in new_files:
+                with open(path, 'rb') as fp:
+                    archives[key].add(_relative(path, root), fp.read())
+                stats['files'] += 1
+    for doc_id in sorted(set(old_records) - set(records)):
+        target.delete(doc_id)
+        stats['deleted'] += 1
+    target.close()
+    if not (stats['inserted'] or stats['updated'] or stats['deleted']):
+        shutil.rmtree(batch_dir)
+        batch_dir = None
+    save_snapshot(snapshot_file, dict(records=records, files=files))
+    return batch_dir, stats
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Export only the chemicals changed since '
+                       'the last export.')
+    p.add_argument('infile', help='all.json (or NDJSON) file')
+    p.add_argument('outdir', help='Directory for snapshot and batches')
+    p.add_argument('--sink', '-s', default='file', help='"file", '
+                   '"memory[:FILE]" or "mongodb://HOST/DB.COLLECTION" '
+                   '(default: %(default)s)')
+    p.add_argument('--snapshot', default=None, help='Snapshot file '
+                   '(default: OUTDIR/{})'.format(SNAPSHOT_FILE))
+    p.add_argument('--root', default=None, help='Name the files (and '
+                   'identify the records) by the path relative to this '
+                   'directory (default: the full path)')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    batch, stats = export_delta(args.infile, args.outdir, args.sink,
+                                args.snapshot, args.root)
+    print('{}: {inserted} inserted, {updated} updated, {deleted} deleted, '
+          '{unchanged} unchanged, {files} files'.format(batch or 'No changes',
+                                                        **stats))
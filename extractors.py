@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import codecs
+import glob
+import logging
+import multiprocessing
+import os
+import time
+
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+import ocr
+import tools
+
+
+logger = logging.getLogger(__name__)
+if os.name == 'nt':
+    GS_BIN = r'C:\Users\wet\Downloads\Ghostscript\bin\gswin64c.exe'
+    TESS_BIN = r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe'
+else:
+    GS_BIN = 'gsc'
+    TESS_BIN = 'tesseract'
+OCR_MODES = ('fixed', 'adaptive')
+# Pages with less (non whitespace) characters are treated as scanned
+MIN_PAGE_CHARS = 50
+# Maximum text size per document (characters), the rest is not extracted
+MAX_TEXT_CHARS = 1000000
+
+
+class SubprocessExtractor:
+    """
+    The classic backend: pdftotext for the text layer, Ghostscript and one
+    Tesseract process per page for OCR.
+    """
+
+    name = 'subprocess'
+
+    def __init__(self, ocr_mode='fixed', gs_bin=None, tess_bin=None,
+                 max_chars=MAX_TEXT_CHARS):
+        self.ocr_mode = ocr_mode
+        self.gs_bin = gs_bin or GS_BIN
+        self.tess_bin = tess_bin or TESS_BIN
+        self.max_chars = max_chars
+
+    @property
+    def adaptive(self):
+        return self.ocr_mode == 'adaptive'
+
+    def iter_pages(self, pdf_file):
+        """
+        Yields the text layer page by page while pdftotext is still
+        running, so a document never has to be read completely.
+        """
+        page = []
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        cmd = ['pdftotext', '-raw', '-enc', 'UTF-8', pdf_file, '-']
+        for chunk in tools.stream_tool('pdftotext', cmd):
+            text = decoder.decode(chunk)
+            while '\f' in text:
+                end, text = text.split('\f', 1)
+                page.append(end)
+                yield ''.join(page)
+                page = []
+            page.append(text)
+        page.append(decoder.decode(b'', final=True))
+        if ''.join(page).strip():
+            yield ''.join(page)
+
+    def pages(self, pdf_file):
+        """Returns the text layer of every page."""
+        return list(self.iter_pages(pdf_file))
+
+    def recognize(self, images):
+        """OCR of the given images, returns (text, confidence) pairs."""
+        return [ocr.recognize(self.tess_bin, image) for image in images]
+
+    def ocr_pages(self, pdf_file, pages, adaptive=None):
+        """
+        OCR of single pages (numbers start with 1), contiguous pages are
+        rendered by one Ghostscript call. In adaptive mode every page is
+        first tried in greyscale at ``ocr.LOW_DPI``.
+
+        :returns: Text by page number.
+        :rtype: dict
+        """
+        if adaptive is None:
+            adaptive = self.adaptive
+        out = {}
+        todo = sorted(set(pages))
+        with TemporaryDirectory() as tmp:
+            if adaptive:
+                images = []
+                for first, last in ocr.page_ranges(todo):
+                    prefix = 'low{:03d}'.format(first)
+                    images.extend(ocr.render(self.gs_bin, pdf_file, tmp,
+                                             ocr.LOW_DPI, first=first,
+                                             last=last, prefix=prefix))
+                for num, (text, conf) in zip(todo, self.recognize(images)):
+                    if conf >= ocr.MIN_CONFIDENCE:
+                        out[num] = text
+                todo = [num for num in todo if num not in out]
+            images = []
+            for first, last in ocr.page_ranges(todo):
+                prefix = 'page{:03d}'.format(first)
+                images.extend(ocr.render(self.gs_bin, pdf_file, tmp,
+                                         ocr.HIGH_DPI, 'tiffscaled24',
+                                         first=first, last=last,
+                                         prefix=prefix))
+            for num, (text, _) in zip(todo, self.recognize(images)):
+                out[num] = text
+        return out
+
+    def ocr_document(self, pdf_file, stop=None):
+        if self.adaptive:
+            text, stats = ocr.run_adaptive(pdf_file, self.gs_bin,
+                                           self.tess_bin, stop=stop,
+                                           max_chars=self.max_chars)
+            logger.info('OCR: %s', ocr.format_stats(stats))
+            return text[:self.max_chars]
+        text = ocr.run_fixed(pdf_file, self.gs_bin, self.tess_bin, stop,
+                             self.max_chars)
+        return text[:self.max_chars]
+
+    def extract(self, pdf_file, stop=None):
+        """
+        Returns the text of all pages. Only pages without (enough) text are
+        sent to OCR and stitched back in page order. Raises an exception if
+        the document has no text layer at all.
+
+        Reading stops after the page for which ``stop(page_text)`` returns
+        True and once ``max_chars`` characters have been read.
+        """
+        pages = []
+        size = 0
+        truncated = False
+        it = self.iter_pages(pdf_file)
+        try:
+            for page in it:
+                pages.append(page)
+                size += len(page)
+                if size >= self.max_chars:
+                    logger.warning('Text limit (%d chars) reached: %s',
+                                   self.max_chars, pdf_file)
+                    pages[-1] = page[:len(page) - size + self.max_chars]
+                    truncated = True
+                    break
+                if stop is not None and stop(page):
+                    break
+        finally:
+            it.close()
+        if not ''.join(pages).strip():
+            raise ValueError('No text layer')
+        checked = pages[:-1] if truncated else pages
+        scanned = [num for num, page in enumerate(checked, start=1)
+                   if len(''.join(page.split())) < MIN_PAGE_CHARS]
+        if scanned:
+            logger.info('Pages without text: %s of %d, trying tesseract',
+                        scanned, len(pages))
+            try:
+                texts = self.ocr_pages(pdf_file, scanned)
+            except Exception as err:
+                logger.error('tesseract can not handle %s (%s)', pdf_file,
+                             err)
+                texts = {}
+            for num, text in texts.items():
+                pages[num - 1] = text
+        return '\n'.join(pages)
+
+    def close(self):
+        pass
+
+
+class PyPDFExtractor(SubprocessExtractor):
+    """
+    Reads the text layer in process with pypdf (optional dependency), OCR
+    is done as in the subprocess backend. The text layout differs slightly
+    from ``pdftotext -raw``, check the parsers with the benchmark first.
+    """
+
+    name = 'pypdf'
+
+    def __init__(self, ocr_mode='fixed', gs_bin=None, tess_bin=None,
+                 max_chars=MAX_TEXT_CHARS):
+        SubprocessExtractor.__init__(self, ocr_mode, gs_bin, tess_bin,
+                                     max_chars)
+        from pypdf import PdfReader
+        self._reader = PdfReader
+
+    def iter_pages(self, pdf_file):
+        reader = self._reader(pdf_file)
+        for page in reader.pages:
+            yield page.extract_text() or ''
+
+
+_TESS_API = None
+
+
+def _init_tesseract(lang):
+    global _TESS_API
+    import tesserocr
+    _TESS_API = tesserocr.PyTessBaseAPI(lang=lang)
+
+
+def _recognize_in_pool(image):
+    _TESS_API.SetImageFile(image)
+    return _TESS_API.GetUTF8Text(), float(_TESS_API.MeanTextConf())
+
+
+class TesseractPoolExtractor(SubprocessExtractor):
+    """
+    OCR in a pool of long-lived worker processes, each holding a loaded
+    Tesseract engine (tesserocr, optional dependency), so neither the
+    process start nor the language model load is paid per page.
+    """
+
+    name = 'tesspool'
+
+    def __init__(self, ocr_mode='fixed', gs_bin=None, tess_bin=None,
+                 max_chars=MAX_TEXT_CHARS, processes=None, lang='deu'):
+        SubprocessExtractor.__init__(self, ocr_mode, gs_bin, tess_bin,
+                                     max_chars)
+        # Fail early (not in the pool workers) if tesserocr is missing
+        import tesserocr
+        self.pool = multiprocessing.Pool(processes, _init_tesseract, (lang,))
+
+    def recognize(self, images):
+        return self.pool.map(_recognize_in_pool, images)
+
+    def ocr_document(self, pdf_file, stop=None):
+        with TemporaryDirectory() as tmp:
+            if self.adaptive:
+                images = ocr.render(self.gs_bin, pdf_file, tmp, ocr.LOW_DPI)
+            else:
+                images = ocr.render(self.gs_bin, pdf_file, tmp, ocr.HIGH_DPI,
+                                    'tiffscaled24')
+            results = self.recognize(images)
+        texts = [text for text, _ in results]
+        if self.adaptive:
+            low = [num for num, (_, conf) in enumerate(results, start=1)
+                   if conf < ocr.MIN_CONFIDENCE]
+            for num, text in self.ocr_pages(pdf_file, low, False).items():
+                texts[num - 1] = text
+        return '\n'.join(texts)[:self.max_chars]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+EXTRACTORS = {
+    SubprocessExtractor.name: SubprocessExtractor,
+    PyPDFExtractor.name: PyPDFExtractor,
+    TesseractPoolExtractor.name: TesseractPoolExtractor,
+}
+
+
+def get_extractor(name='subprocess', ocr_mode='fixed',
+                  max_chars=MAX_TEXT_CHARS):
+    try:
+        cls = EXTRACTORS[name]
+    except KeyError:
+        raise ValueError('Unknown extractor: {}'.format(name))
+    return cls(ocr_mode, max_chars=max_chars)
+
+
+def benchmark(pdf_files, names, ocr_mode='fixed'):
+    """
+    Extracts the same files with every given backend (no text cache) and
+    prints the time and the amount of extracted text.
+    """
+    for name in names:
+        try:
+            extractor = get_extractor(name, ocr_mode)
+        except ImportError as err:
+            print('{}: not available ({})'.format(name, err))
+            continue
+        chars = failed = 0
+        start = time.time()
+        try:
+            for pdf_file in pdf_files:
+                try:
+                    text = extractor.extract(pdf_file)
+                except Exception:
+                    try:
+                        text = extractor.ocr_document(pdf_file)
+                    except Exception:
+                        failed += 1
+                        continue
+                chars += len(text)
+        finally:
+            extractor.close()
+        elapsed = time.time() - start
+        print('{}: {} files in {:.1f}s ({:.2f}s/file), {} chars, {} '
+              'failed'.format(name, len(pdf_files), elapsed,
+                              elapsed / max(len(pdf_files), 1), chars,
+                              failed))
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Compare the text extraction backends '
+                       'on the same SDBs.')
+    p.add_argument('paths', nargs='+', help='PDF files or directories')
+    p.add_argument('--backends', '-b', default=','.join(EXTRACTORS),
+                   help='Comma separated backends (default: %(default)s)')
+    p.add_argument('--ocr', default='fixed', choices=OCR_MODES,
+                   help='OCR mode (default: %(default)s)')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.pdf'))))
+        else:
+            files.append(path)
+    benchmark(files, args.backends.split(','), args.ocr)
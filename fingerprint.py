@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import threading
+
+
+FINGERPRINT_FILE = 'fingerprints.json'
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+# Minimum estimated Jaccard similarity for a near duplicate
+THRESHOLD = 0.9
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(5867)
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME))
+          for _ in range(NUM_PERM)]
+_WORD_re = re.compile(r'\w+')
+_HASH = struct.Struct('<Q')
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """The set of word ``size``-grams of the lower case text."""
+    words = _WORD_re.findall(text.lower())
+    if len(words) < size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size])
+            for i in range(len(words) - size + 1)}
+
+
+def minhash(text, size=SHINGLE_SIZE):
+    """
+    MinHash signature of the text shingles. The share of equal positions
+    of two signatures estimates the Jaccard similarity of the shingle sets.
+
+    :rtype: list
+    """
+    hashes = [_HASH.unpack(hashlib.blake2b(s.encode('utf-8'),
+                                           digest_size=8).digest())[0]
+              for s in shingles(text, size)]
+    if not hashes:
+        return [_MAX_HASH] * NUM_PERM
+    return [min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes)
+            for a, b in _PERMS]
+
+
+def similarity(sig1, sig2):
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+def _band_keys(sig):
+    rows = len(sig) // BANDS
+    for band in range(BANDS):
+        yield '{}:{}'.format(band, ','.join(
+            str(x) for x in sig[band * rows:(band + 1) * rows]))
+
+
+class FingerprintIndex:
+    """
+    MinHash signatures of all processed SDBs with the producer. Candidates
+    are found with locality sensitive hashing (signature bands), so a
+    lookup does not compare against every known document. Thread safe,
+    the stages of several documents use it at the same time (pipeline).
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.docs = {}
+        self._buckets = {}
+        # Documents added (entry) or removed (None) since loading
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filename):
+        self = cls(filename)
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as fp:
+                for doc_id, entry in json.load(fp).items():
+                    self._add(doc_id, entry['producer'], entry['sig'])
+        return self
+
+    def _add(self, doc_id, producer, sig):
+        self.docs[doc_id] = dict(producer=producer, sig=sig)
+        for key in _band_keys(sig):
+            self._buckets.setdefault((producer, key), set()).add(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self.docs.pop(doc_id, None)
+        if entry is None:
+            return
+        for key in _band_keys(entry['sig']):
+            bucket = self._buckets.get((entry['producer'], key))
+            if bucket is not None:
+                bucket.discard(doc_id)
+        self._changes[doc_id] = None
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def add(self, doc_id, producer, sig):
+        with self._lock:
+            self._remove(doc_id)
+            self._add(doc_id, producer, sig)
+            self._changes[doc_id] = self.docs[doc_id]
+
+    def similar(self, sig, producer, threshold=THRESHOLD, exclude=None):
+        """
+        Returns the most similar known document of the same producer.
+
+        :returns: Document ID and estimated similarity or (None, 0.0).
+        :rtype: tuple
+        """
+        candidates = set()
+        with self._lock:
+            for key in _band_keys(sig):
+                candidates |= self._buckets.get((producer, key), set())
+            candidates.discard(exclude)
+            sigs = {doc_id: self.docs[doc_id]['sig'] for doc_id in candidates}
+        best, best_sim = None, 0.0
+        for doc_id, other in sorted(sigs.items()):
+            sim = similarity(sig, other)
+            if sim > best_sim:
+                best, best_sim = doc_id, sim
+        if best_sim < threshold:
+            return None, best_sim
+        return best, best_sim
+
+    def save(self):
+        """
+        Writes the changes since loading into the file, documents added
+        meanwhile by other processes are kept.
+        """
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self.filename or not self._changes:
+            return
+        docs = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, encoding='utf-8') as fp:
+                docs = json.load(fp)
+        for doc_id, entry in self._changes.items():
+            if entry is None:
+                docs.pop(doc_id, None)
+            else:
+                docs[doc_id] = entry
+        tmp_name = '{}.tmp'.format(self.filename)
+        with open(tmp_name, 'w', encoding='utf-8') as fp:
+            json.dump(docs, fp, sort_keys=True)
+        os.replace(tmp_name, self.filename)
+        self._changes = {}
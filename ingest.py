@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import time
+
+from argparse import ArgumentParser
+from functools import partial
+
+import extractors
+import fingerprint
+import jsonlog
+import resultstore
+import sdbindex
+import sdbparser
+import spool
+import translate
+import uba
+
+
+logger = logging.getLogger(__name__)
+STATE_FILE = 'ingest_state.json'
+# A file must be unchanged for this long (seconds) before it is parsed
+SETTLE_TIME = 2.0
+POLL_INTERVAL = 5.0
+# How often (seconds) the UBA data is checked for a new download
+UBA_CHECK = 3600
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+
+
+def is_sdb(filename):
+    return filename.lower().endswith('.pdf')
+
+
+def signature(filename):
+    """Size and modification time, None if the file is gone."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def find_sdbs(directories):
+    """Yields all PDFs below the directories (recursive)."""
+    for d in directories:
+        for root, dirs, files in os.walk(os.path.abspath(d)):
+            dirs.sort()
+            for f in sorted(files):
+                if is_sdb(f):
+                    yield os.path.join(root, f)
+
+
+class PollingWatcher:
+    """Finds new and changed PDFs by scanning the directories."""
+
+    def __init__(self, directories, interval=POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        self.seen = self._scan()
+        self._next = time.time() + interval
+
+    def _scan(self):
+        return {f: signature(f) for f in find_sdbs(self.directories)}
+
+    def changes(self, timeout):
+        """Returns the changed files, waits at most ``timeout`` seconds."""
+        wait = self._next - time.time()
+        if wait > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self._next = time.time() + self.interval
+        current = self._scan()
+        changed = [f for f, sig in current.items()
+                   if self.seen.get(f) != sig]
+        self.seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Watches the directories recursively with inotify (Linux, via ctypes).
+    New sub directories are watched as soon as they are created.
+    """
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = directories
+        self.watches = {}
+        for d in directories:
+            self._watch_tree(os.path.abspath(d))
+
+    def _watch(self, path):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Can not watch', path)
+        self.watches[wd] = path
+
+    def _watch_tree(self, path):
+        """Watches a directory tree, returns the PDFs already in it."""
+        found = []
+        for root, dirs, files in os.walk(path):
+            self._watch(root)
+            found.extend(os.path.join(root, f) for f in files if is_sdb(f))
+        return found
+
+    def changes(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        changed = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, size = _EVENT.unpack_from(buf, pos)
+            pos += _EVENT.size
+            name = os.fsdecode(buf[pos:pos + size].rstrip(b'\0'))
+            pos += size
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, fall back to a full scan
+                changed.extend(find_sdbs(self.directories))
+                continue
+            path = os.path.join(self.watches.get(wd, ''), name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self._watch_tree(path))
+            elif is_sdb(name):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(directories, polling=False):
+    if not polling:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError, TypeError) as err:
+            logger.warning('inotify not available (%s), polling', err)
+    return PollingWatcher(directories)
+
+
+class Ingester:
+    """
+    Keeps the UBA data, the index, the result store, the text extractor
+    and the translator loaded and parses every new or changed SDB as soon
+    as it is completely written.
+    """
+
+    def __init__(self, directories, outdir, store='dir', ocr_mode='fixed',
+                 extractor='subprocess', settle_time=SETTLE_TIME,
+                 polling=False):
+        self.directories = directories
+        self.outdir = outdir
+        self.settle_time = settle_time
+        self.state_file = os.path.join(outdir, STATE_FILE)
+        self.state = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, encoding='utf-8') as fp:
+                self.state = json.load(fp)
+        self._load_uba()
+        self.index = sdbindex.SDBIndex.load(
+            os.path.join(outdir, sdbindex.INDEX_FILE))
+        self.store = resultstore.open_store(store, outdir)
+        self.extractor = extractors.get_extractor(extractor, ocr_mode)
+        self.fingerprints = fingerprint.FingerprintIndex.load(
+            os.path.join(outdir, fingerprint.FINGERPRINT_FILE))
+        self.watcher = get_watcher(directories, polling)
+        # Path -> (due time, signature)
+        self.pending = {}
+        self.parsed = []
+        self.running = True
+
+    def _load_uba(self):
+        if getattr(self, 'translator', None) is not None:
+            self.translator.save()
+        self.uba_data = uba.main(self.outdir)
+        self.translator = translate.OfflineTranslator.from_uba(
+            self.uba_data, os.path.join(self.outdir, translate.CACHE_FILE))
+        self._uba_loaded = time.time()
+
+    def schedule(self, filename):
+        self.pending[filename] = (time.time() + self.settle_time,
+                                  signature(filename))
+
+    def catch_up(self):
+        """Schedules all files which are new or changed since the last run."""
+        for f in find_sdbs(self.directories):
+            if self.state.get(f) != signature(f):
+                self.schedule(f)
+
+    def _ready(self):
+        now = time.time()
+        ready = []
+        for f, (due, sig) in list(self.pending.items()):
+            if due > now:
+                continue
+            current = signature(f)
+            if current is None:
+                del self.pending[f]
+            elif current != sig:
+                # Still being written
+                self.schedule(f)
+            else:
+                del self.pending[f]
+                if self.state.get(f) != current:
+                    ready.append(f)
+        return ready
+
+    def process(self, filename):
+        logger.info('Ingest: %s', filename)
+        force = filename in self.state
+        try:
+            data = sdbparser.run(filename, self.outdir, force, self.uba_data,
+                                 self.store, self.extractor, self.translator,
+                                 self.fingerprints)
+        except Exception:
+            # Keep watching, the file is retried when it changes again
+            logger.exception('Ingest failed: %s', filename)
+            data = None
+        self.state[filename] = signature(filename)
+        if data:
+            self.parsed.append(data)
+
+    def flush(self):
+        """
+        Translation, index, all.json and state updates for the parsed
+        batch. The shared files are updated under the lock of sdbparser
+        runs on the same output directory.
+        """
+        if self.parsed:
+            sdbparser._add_translations(
+                self.parsed, self.translator, self.store,
+                partial(sdbparser.run, outdir=self.outdir,
+                        uba_data=self.uba_data, store=self.store,
+                        extractor=self.extractor, translator=self.translator,
+                        fingerprints=self.fingerprints, from_stage='enrich'))
+            sdbparser._write_structures(self.parsed, self.store)
+            with spool.file_lock(os.path.join(self.outdir,
+                                              sdbparser.LOCK_FILE)):
+                # Reloaded, a CLI run may have added documents meanwhile
+                self.index = sdbindex.SDBIndex.load(self.index.filename)
+                for data in self.parsed:
+                    self.index.add(data)
+                self.index.save()
+                self.translator.save()
+                self.fingerprints.save()
+                sdbparser._write_all(self.outdir, self.parsed, merge=True)
+            self.parsed = []
+        tmp_name = '{}.tmp'.format(self.state_file)
+        with open(tmp_name, 'w', encoding='utf-8') as fp:
+            json.dump(self.state, fp, indent=2, sort_keys=True)
+        os.replace(tmp_name, self.state_file)
+
+    def run(self):
+        self.catch_up()
+        while self.running:
+            if time.time() - self._uba_loaded > UBA_CHECK:
+                self._load_uba()
+            if self.pending:
+                due = min(due for due, _ in self.pending.values())
+                timeout = min(max(due - time.time(), 0), POLL_INTERVAL)
+            else:
+                timeout = POLL_INTERVAL
+            for f in self.watcher.changes(timeout):
+                self.schedule(f)
+            ready = self._ready()
+            for f in ready:
+                if not self.running:
+                    break
+                self.process(f)
+            if ready:
+                self.flush()
+
+    def stop(self, *args):
+        self.running = False
+
+    def close(self):
+        self.flush()
+        self.watcher.close()
+        self.extractor.close()
+        self.store.close()
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Watch directories (recursively) and '
+                       'parse new or changed SDBs as they arrive.')
+    p.add_argument('directories', nargs='+', help='Directories to watch')
+    p.add_argument('--outdir', '-o', default=sdbparser.STORE_PATH,
+                   help='Output directory (default: %(default)s)')
+    p.add_argument('--store', '-s', default='dir', help='Result store, see '
+                   'sdbparser.py (default: %(default)s)')
+    p.add_argument('--ocr', default='fixed', choices=extractors.OCR_MODES,
+                   help='OCR mode (default: %(default)s)')
+    p.add_argument('--extractor', '-e', default='subprocess',
+                   choices=sorted(extractors.EXTRACTORS),
+                   help='Text extraction backend (default: %(default)s)')
+    p.add_argument('--settle', type=float, default=SETTLE_TIME,
+                   help='Seconds a file must be unchanged before it is '
+                   'parsed (default: %(default)s)')
+    p.add_argument('--poll', action='store_true', default=False,
+                   help='Poll instead of using inotify')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    # Format and level from MSDS_LOG_FORMAT and MSDS_LOG_LEVEL
+    jsonlog.configure()
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    ingester = Ingester(args.directories, args.outdir, args.store, args.ocr,
+                        args.extractor, args.settle, args.poll)
+    signal.signal(signal.SIGTERM, ingester.stop)
+    try:
+        ingester.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingester.close()
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import deque
+
+import requests
+
+
+CLASSES = ('interactive', 'bulk')
+# Cost units are seconds of expected processing time
+BASE_COST = 2.0
+COST_PER_PAGE = 0.3
+OCR_COST_PER_PAGE = 6.0
+BYTES_PER_PAGE = 60000
+# A waiting job gets cheaper by this much per second waited (aging)
+AGING_RATE = 0.05
+# A bulk job which waited longer is served before interactive jobs
+MAX_BULK_WAIT = 600.0
+HEAD_TIMEOUT = 5
+JOBS_DB = 'jobs.db'
+# A leased job becomes visible again if not done within this time
+VISIBILITY_TIMEOUT = 1800.0
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60.0
+# Group commit: wait at most this long (seconds) or for this many jobs
+COMMIT_DELAY = 0.05
+COMMIT_SIZE = 200
+LATENCY_SAMPLES = 1000
+_PAGE_re = re.compile(rb'/Type\s*/Page(?!s)')
+_FONT_re = re.compile(rb'/Font\b')
+
+
+def pdf_info(filename, max_bytes=32 * 1024 * 1024):
+    """
+    Size, page count and whether the PDF has fonts (a text layer) from a
+    scan of the raw file. Compressed object streams hide pages and fonts,
+    the page count then falls back to an estimate from the size.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as fp:
+        raw = fp.read(max_bytes)
+    pages = len(_PAGE_re.findall(raw)) or max(size // BYTES_PER_PAGE, 1)
+    text_layer = bool(_FONT_re.search(raw)) or b'/ObjStm' in raw
+    return dict(size=size, pages=pages, text_layer=text_layer)
+
+
+def _remote_size(url):
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=HEAD_TIMEOUT)
+        return int(r.headers.get('Content-Length', 0))
+    except (requests.RequestException, ValueError):
+        return 0
+
+
+def _needs_size(job):
+    """Whether only the download could tell the size of the PDF."""
+    return (bool(job.get('download_url')) and not job.get('pdf_path') and
+            'size' not in job and 'pages' not in job)
+
+
+def estimate_cost(job):
+    """
+    Predicted processing time of a job from the PDF (if already local, see
+    ``pdf_path``) or hints in the job (``size``, ``pages``, ``text_layer``).
+    Nothing is downloaded, without hints a job counts as one page until
+    ``CostRefiner`` knows the Content-Length of the download.
+    """
+    info = {}
+    if job.get('pdf_path') and os.path.isfile(job['pdf_path']):
+        info = pdf_info(job['pdf_path'])
+    for key in ('size', 'pages', 'text_layer'):
+        if key in job:
+            info[key] = job[key]
+    pages = info.get('pages') or max(info.get('size', 0) // BYTES_PER_PAGE, 1)
+    per_page = COST_PER_PAGE
+    if info.get('text_layer') is False:
+        per_page = OCR_COST_PER_PAGE
+    return BASE_COST + pages * per_page
+
+
+class CostRefiner:
+    """
+    Refines the cost of queued download jobs without size hints in the
+    background: a HEAD request per job gives the size, ``update(key,
+    cost)`` stores the new cost. Queueing a job never waits for the
+    remote server.
+    """
+
+    def __init__(self, cost_func, update):
+        self.cost_func = cost_func
+        self.update = update
+        self._todo = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def add(self, key, job):
+        if not _needs_size(job):
+            return
+        with self._cond:
+            self._todo.append((key, job))
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._todo and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                key, job = self._todo.popleft()
+            size = _remote_size(job['download_url'])
+            with self._cond:
+                if size and not self._stopped:
+                    self.update(key, self.cost_func(dict(job, size=size)))
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+class _Entry:
+    __slots__ = ('job', 'cls', 'cost', 'queued', 'started')
+
+    def __init__(self, job, cls, cost):
+        self.job = job
+        self.cls = cls
+        self.cost = cost
+        self.queued = time.time()
+        self.started = None
+
+
+class PriorityJobQueue:
+    """
+    Drop-in replacement for ``queue.Queue`` in the worker: interactive jobs
+    before bulk jobs, within a class the cheapest (predicted) job first.
+    Waiting jobs age, so expensive jobs are not postponed forever, and a
+    bulk job that waited ``max_bulk_wait`` seconds is served next. Call
+    ``done(job)`` after processing for the latency statistics.
+    """
+
+    def __init__(self, aging_rate=AGING_RATE, max_bulk_wait=MAX_BULK_WAIT,
+                 cost_func=estimate_cost):
+        self.aging_rate = aging_rate
+        self.max_bulk_wait = max_bulk_wait
+        self.cost_func = cost_func
+        self._jobs = {cls: [] for cls in CLASSES}
+        self._active = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._stats = {cls: dict(jobs=0, waits=deque(maxlen=LATENCY_SAMPLES),
+                                 runs=deque(maxlen=LATENCY_SAMPLES))
+                       for cls in CLASSES}
+        self._refiner = CostRefiner(cost_func, self._set_cost)
+
+    def put(self, job, priority=None):
+        """
+        Queues a job (dict). The class is ``priority``, the job's
+        ``priority`` key or interactive. None stops the consumer.
+        """
+        with self._cond:
+            if job is None:
+                self._stopped = True
+                self._cond.notify_all()
+                return
+        cls = priority or job.get('priority') or 'interactive'
+        if cls not in CLASSES:
+            raise ValueError('Unknown job class: {}'.format(cls))
+        entry = _Entry(job, cls, self.cost_func(job))
+        with self._cond:
+            self._jobs[cls].append(entry)
+            self._cond.notify()
+        self._refiner.add(entry, job)
+
+    def _set_cost(self, entry, cost):
+        with self._cond:
+            entry.cost = cost
+
+    def _score(self, entry, now):
+        return entry.cost - self.aging_rate * (now - entry.queued)
+
+    def _pick(self):
+        now = time.time()
+        bulk = self._jobs['bulk']
+        if bulk:
+            oldest = min(bulk, key=lambda e: e.queued)
+            if now - oldest.queued >= self.max_bulk_wait:
+                return oldest
+        for cls in CLASSES:
+            if self._jobs[cls]:
+                return min(self._jobs[cls], key=lambda e: self._score(e, now))
+        return None
+
+    def get(self):
+        """Blocks until a job is available, returns None once stopped."""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                entry = self._pick()
+                if entry is not None:
+                    break
+                self._cond.wait()
+            self._jobs[entry.cls].remove(entry)
+            entry.started = time.time()
+            self._active[id(entry.job)] = entry
+            stats = self._stats[entry.cls]
+            stats['jobs'] += 1
+            stats['waits'].append(entry.started - entry.queued)
+        return entry.job
+
+    def done(self, job):
+        with self._cond:
+            entry = self._active.pop(id(job), None)
+            if entry is not None:
+                self._stats[entry.cls]['runs'].append(
+                    time.time() - entry.started)
+
+    def fail(self, job, error=''):
+        """Jobs in memory are not retried."""
+        self.done(job)
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(x) for x in self._jobs.values())
+
+    def stats(self):
+        """Queue length, wait and run time (mean, p95, max) by class."""
+        out = {}
+        with self._cond:
+            for cls in CLASSES:
+                s = self._stats[cls]
+                out[cls] = dict(queued=len(self._jobs[cls]), jobs=s['jobs'],
+                                wait=_summary(s['waits']),
+                                run=_summary(s['runs']))
+        return out
+
+
+def _summary(values):
+    if not values:
+        return dict(mean=None, p95=None, max=None)
+    ordered = sorted(values)
+    p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+    return dict(mean=sum(ordered) / len(ordered), p95=p95, max=ordered[-1])
+
+
+class SQLiteJobQueue:
+    """
+    Persistent job queue with the scheduling of ``PriorityJobQueue``, so
+    jobs survive restarts and crashes (at-least-once delivery). ``get``
+    leases a job for ``visibility_timeout`` seconds; a job which is neither
+    ``done`` nor ``fail``-ed by then is delivered again. Failed jobs are
+    retried after ``retry_delay`` up to ``max_attempts`` times and then
+    moved to the ``dead`` table. ``put`` blocks until its job is committed,
+    concurrent puts share one transaction (group commit).
+    """
+
+    def __init__(self, filename, aging_rate=AGING_RATE,
+                 max_bulk_wait=MAX_BULK_WAIT, cost_func=estimate_cost,
+                 visibility_timeout=VISIBILITY_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.filename = filename
+        self.aging_rate = aging_rate
+        self.max_bulk_wait = max_bulk_wait
+        self.cost_func = cost_func
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.conn = sqlite3.connect(filename, timeout=30,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, payload TEXT NOT NULL, '
+            'cls TEXT NOT NULL, cost REAL NOT NULL, queued REAL NOT NULL, '
+            'visible REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+            'error TEXT)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS dead ('
+            'id INTEGER PRIMARY KEY, payload TEXT NOT NULL, '
+            'cls TEXT NOT NULL, queued REAL NOT NULL, '
+            'attempts INTEGER NOT NULL, error TEXT, failed REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_visible ON '
+                          'jobs (cls, visible)')
+        self.conn.commit()
+        self._db_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending = []
+        self._stopped = False
+        self._active = {}
+        self._stats = {cls: dict(jobs=0, waits=deque(maxlen=LATENCY_SAMPLES),
+                                 runs=deque(maxlen=LATENCY_SAMPLES))
+                       for cls in CLASSES}
+        self._committer = threading.Thread(target=self._commit_loop,
+                                           daemon=True)
+        self._committer.start()
+        self._refiner = CostRefiner(cost_func, self._set_cost)
+
+    def put(self, job, priority=None):
+        """Queues a job (see ``PriorityJobQueue.put``) durably."""
+        if job is None:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            return
+        cls = priority or job.get('priority') or 'interactive'
+        if cls not in CLASSES:
+            raise ValueError('Unknown job class: {}'.format(cls))
+        row = (json.dumps(job), cls, self.cost_func(job), time.time())
+        committed = threading.Event()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Job queue is stopped')
+            self._pending.append((row, job, committed))
+            self._cond.notify_all()
+        committed.wait()
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            # Let concurrent puts join the transaction
+            deadline = time.time() + COMMIT_DELAY
+            while time.time() < deadline:
+                with self._cond:
+                    if len(self._pending) >= COMMIT_SIZE:
+                        break
+                time.sleep(COMMIT_DELAY / 10)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            ids = []
+            with self._db_lock, self.conn:
+                for row, _, _ in batch:
+                    ids.append(self.conn.execute(
+                        'INSERT INTO jobs (payload, cls, cost, queued, '
+                        'visible) VALUES (?, ?, ?, ?, ?)',
+                        row + (row[3],)).lastrowid)
+            for job_id, (_, job, committed) in zip(ids, batch):
+                committed.set()
+                self._refiner.add(job_id, job)
+            with self._cond:
+                self._cond.notify_all()
+
+    def _set_cost(self, job_id, cost):
+        with self._db_lock, self.conn:
+            self.conn.execute('UPDATE jobs SET cost = ? WHERE id = ?',
+                              (cost, job_id))
+
+    def _lease(self):
+        """Leases the next job, returns (id, job, class, queued) or None."""
+        now = time.time()
+        with self._db_lock, self.conn:
+            while True:
+                row = self.conn.execute(
+                    'SELECT id, payload, cls, queued, attempts, error '
+                    'FROM jobs WHERE cls = ? AND visible <= ? AND '
+                    'queued <= ? ORDER BY queued LIMIT 1',
+                    ('bulk', now, now - self.max_bulk_wait)).fetchone()
+                if row is None:
+                    row = self.conn.execute(
+                        'SELECT id, payload, cls, queued, attempts, error '
+                        'FROM jobs WHERE visible <= ? ORDER BY cls = ?, '
+                        'cost - ? * (? - queued) LIMIT 1',
+                        (now, 'bulk', self.aging_rate, now)).fetchone()
+                if row is None:
+                    return None
+                job_id, payload, cls, queued, attempts, error = row
+                if attempts < self.max_attempts:
+                    break
+                # Leased too often without being done (e.g. a crash)
+                self._bury(job_id, error or 'visibility timeout expired')
+            self.conn.execute(
+                'UPDATE jobs SET visible = ?, attempts = attempts + 1 '
+                'WHERE id = ?', (now + self.visibility_timeout, job_id))
+        return job_id, json.loads(payload), cls, queued
+
+    def _bury(self, job_id, error):
+        self.conn.execute(
+            'INSERT INTO dead (id, payload, cls, queued, attempts, error, '
+            'failed) SELECT id, payload, cls, queued, attempts, ?, ? '
+            'FROM jobs WHERE id = ?', (error, time.time(), job_id))
+        self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def _next_visible(self):
+        with self._db_lock:
+            row = self.conn.execute('SELECT MIN(visible) FROM jobs').fetchone()
+        return row[0]
+
+    def get(self):
+        """Blocks until a job is available, returns None once stopped."""
+        # Looking for a job and waiting under the same lock, so a job
+        # committed in between notifies the wait (no lost wakeup)
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                leased = self._lease()
+                if leased is not None:
+                    break
+                nxt = self._next_visible()
+                self._cond.wait(None if nxt is None else
+                                max(nxt - time.time(), 0.01))
+            job_id, job, cls, queued = leased
+            started = time.time()
+            self._active[id(job)] = (job_id, cls, started)
+            stats = self._stats[cls]
+            stats['jobs'] += 1
+            stats['waits'].append(started - queued)
+        return job
+
+    def done(self, job):
+        """Acknowledges a job, it is removed for good."""
+        with self._cond:
+            job_id, cls, started = self._active.pop(id(job))
+            self._stats[cls]['runs'].append(time.time() - started)
+        with self._db_lock, self.conn:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def fail(self, job, error=''):
+        """
+        Schedules a failed job for a retry or moves it to the dead letter
+        table after ``max_attempts``.
+        """
+        with self._cond:
+            job_id, cls, started = self._active.pop(id(job))
+            self._stats[cls]['runs'].append(time.time() - started)
+        with self._db_lock, self.conn:
+            row = self.conn.execute('SELECT attempts FROM jobs WHERE id = ?',
+                                    (job_id,)).fetchone()
+            if row is None:
+                return
+            if row[0] >= self.max_attempts:
+                self._bury(job_id, error)
+            else:
+                self.conn.execute(
+                    'UPDATE jobs SET visible = ?, error = ? WHERE id = ?',
+                    (time.time() + self.retry_delay, error, job_id))
+        with self._cond:
+            self._cond.notify_all()
+
+    def recover(self):
+        """
+        Makes all leased jobs visible again, e.g. at startup after a crash
+        when this process is the only consumer.
+        """
+        with self._db_lock, self.conn:
+            num = self.conn.execute('UPDATE jobs SET visible = ? WHERE '
+                                    'visible > ? AND attempts > 0',
+                                    (time.time(), time.time())).rowcount
+        return num
+
+    def dead_jobs(self, limit=100):
+        with self._db_lock:
+            cur = self.conn.execute(
+                'SELECT id, payload, attempts, error, failed FROM dead '
+                'ORDER BY failed DESC LIMIT ?', (limit,))
+            return [dict(id=x[0], job=json.loads(x[1]), attempts=x[2],
+                         error=x[3], failed=x[4]) for x in cur.fetchall()]
+
+    def requeue_dead(self, job_id):
+        """Moves a dead job back into the queue (attempts reset)."""
+        with self._db_lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO jobs (payload, cls, cost, queued, visible) '
+                'SELECT payload, cls, 0, ?, ? FROM dead WHERE id = ?',
+                (time.time(), time.time(), job_id))
+            self.conn.execute('DELETE FROM dead WHERE id = ?', (job_id,))
+        with self._cond:
+            self._cond.notify_all()
+
+    def qsize(self):
+        with self._db_lock:
+            return self.conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def stats(self):
+        """Like ``PriorityJobQueue.stats`` plus leased and dead jobs."""
+        now = time.time()
+        with self._db_lock:
+            counts = dict(self.conn.execute(
+                'SELECT cls, COUNT(*) FROM jobs WHERE visible <= ? '
+                'GROUP BY cls', (now,)).fetchall())
+            leased = dict(self.conn.execute(
+                'SELECT cls, COUNT(*) FROM jobs WHERE visible > ? '
+                'GROUP BY cls', (now,)).fetchall())
+            dead = dict(self.conn.execute(
+                'SELECT cls, COUNT(*) FROM dead GROUP BY cls').fetchall())
+        out = {}
+        with self._cond:
+            for cls in CLASSES:
+                s = self._stats[cls]
+                out[cls] = dict(queued=counts.get(cls, 0),
+                                leased=leased.get(cls, 0),
+                                dead=dead.get(cls, 0), jobs=s['jobs'],
+                                wait=_summary(s['waits']),
+                                run=_summary(s['runs']))
+        return out
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._committer.join()
+        self._refiner.close()
+        with self._db_lock:
+            self.conn.close()
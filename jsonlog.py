@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+import zlib
+
+from contextlib import contextmanager
+
+
+FORMATS = ('text', 'json')
+LEVEL = os.environ.get('MSDS_LOG_LEVEL', 'INFO')
+FORMAT = os.environ.get('MSDS_LOG_FORMAT', 'text')
+# Share of documents (by trace ID) whose full records are logged at DEBUG
+PAYLOAD_SAMPLE = float(os.environ.get('MSDS_LOG_SAMPLE', '0.01'))
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+_context = contextvars.ContextVar('log_context', default={})
+_sample = [PAYLOAD_SAMPLE]
+# Attributes of every LogRecord, the others are extra fields
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'context'}
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current():
+    """The fields of the current context, e.g. ``trace_id``."""
+    return _context.get()
+
+
+@contextmanager
+def context(**fields):
+    """
+    Adds the fields (e.g. ``trace_id``, ``doc``, ``vendor``, ``stage``) to
+    all records logged within, in this thread. Nested contexts add to or
+    override the outer fields.
+    """
+    token = _context.set(dict(_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def _fields(record):
+    fields = dict(getattr(record, 'context', {}))
+    for key, value in vars(record).items():
+        if key not in _RECORD_ATTRS:
+            fields[key] = value
+    return fields
+
+
+class ContextFilter(logging.Filter):
+    """Attaches the context fields to every record passing the handler."""
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the context and extra fields."""
+
+    def format(self, record):
+        out = dict(ts=round(record.created, 3), level=record.levelname,
+                   logger=record.name, msg=record.getMessage())
+        out.update(_fields(record))
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return json.dumps(out, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human readable lines, the fields appended as ``key=value``."""
+
+    def __init__(self):
+        logging.Formatter.__init__(self, TEXT_FORMAT)
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        fields = _fields(record)
+        fields.pop('payload', None)
+        if fields:
+            head, sep, tail = line.partition('\n')
+            line = '{} [{}]{}{}'.format(head, ' '.join(
+                '{}={}'.format(k, v) for k, v in sorted(fields.items())),
+                sep, tail)
+        if getattr(record, 'payload', None) is not None:
+            line = '{}\n{}'.format(line, ascii(record.payload))
+        return line
+
+
+def configure(level=None, fmt=None, sample=None, stream=None):
+    """
+    Sets up the root logger, by default from the environment variables
+    ``MSDS_LOG_LEVEL``, ``MSDS_LOG_FORMAT`` (text or json) and
+    ``MSDS_LOG_SAMPLE``.
+    """
+    fmt = fmt or FORMAT
+    if fmt not in FORMATS:
+        raise ValueError('Unknown log format: {}'.format(fmt))
+    if sample is not None:
+        _sample[0] = sample
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.addFilter(ContextFilter())
+    handler.setFormatter(JSONFormatter() if fmt == 'json' else
+                         TextFormatter())
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel((level or LEVEL).upper())
+
+
+def sampled(trace_id=None):
+    """Whether the verbose payloads of this trace are logged."""
+    rate = _sample[0]
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    trace_id = trace_id or _context.get().get('trace_id', '')
+    return zlib.crc32(trace_id.encode('utf-8')) % 10000 < rate * 10000
+
+
+def log_payload(logger, msg, payload):
+    """
+    Logs a full record at DEBUG level for a sample of the traces. Nothing
+    is formatted unless the record is emitted.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and sampled():
+        logger.debug(msg, extra=dict(payload=payload))
+
+
+@contextmanager
+def timed(logger, msg, **fields):
+    """Logs ``msg`` with the duration (seconds) of the block."""
+    start = time.time()
+    try:
+        yield fields
+    finally:
+        fields['duration'] = round(time.time() - start, 3)
+        logger.info(msg, extra=fields)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+
+import requests
+
+import jobqueue
+import transport
+import worker
+
+
+PATTERNS = ('constant', 'ramp', 'burst', 'bulk')
+PERCENTILES = (50, 90, 95, 99)
+PDF_SIZE = 200000
+SAMPLE_INTERVAL = 1.0
+# Metrics shown by compare, lower is better unless marked
+COMPARED = (
+    ('throughput', True),
+    ('error_rate', False),
+    ('latency.p50', False),
+    ('latency.p95', False),
+    ('latency.p99', False),
+    ('submit.p95', False),
+    ('queue.max', False),
+    ('queue.growth', False),
+)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def synthetic_pdf(size=PDF_SIZE):
+    head = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n'
+    return head + b'%' * max(size - len(head), 0)
+
+
+def percentiles(values):
+    if not values:
+        return dict(mean=None, max=None, **{'p{}'.format(p): None
+                                            for p in PERCENTILES})
+    ordered = sorted(values)
+    out = dict(mean=sum(ordered) / len(ordered), max=ordered[-1])
+    for p in PERCENTILES:
+        out['p{}'.format(p)] = ordered[min(int(len(ordered) * p / 100),
+                                           len(ordered) - 1)]
+    return out
+
+
+def _slope(points):
+    """Least squares slope of (time, value) points, e.g. jobs/s."""
+    if len(points) < 2:
+        return 0.0
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    var = sum((x - mx) ** 2 for x, _ in points)
+    if not var:
+        return 0.0
+    return sum((x - mx) * (y - my) for x, y in points) / var
+
+
+class StubServer:
+    """
+    Local HTTP server standing in for the document source (GET and HEAD
+    ``/pdf/NAME``) and the result receiver (POST ``/result/JOB_ID``). The
+    arrival time of every result is recorded.
+    """
+
+    def __init__(self, pdfs, port=0):
+        self.pdfs = pdfs
+        self.results = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _pdf(self):
+                name = self.path.rsplit('/', 1)[-1]
+                return stub.pdfs[int(name.split('.')[0]) % len(stub.pdfs)]
+
+            def do_HEAD(self):
+                if not self.path.startswith('/pdf/'):
+                    return self.send_error(404)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/pdf')
+                self.send_header('Content-Length', str(len(self._pdf())))
+                self.end_headers()
+
+            def do_GET(self):
+                self.do_HEAD()
+                if self.path.startswith('/pdf/'):
+                    self.wfile.write(self._pdf())
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                if not self.path.startswith('/result/'):
+                    return self.send_error(404)
+                stub.record(self.path.rsplit('/', 1)[-1])
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def record(self, job_id):
+        with self._done:
+            self.results.setdefault(job_id, time.time())
+            self._done.notify_all()
+
+    def wait(self, job_ids, timeout):
+        """Waits until all results arrived or ``timeout`` seconds passed."""
+        deadline = time.time() + timeout
+        with self._done:
+            while not job_ids <= set(self.results):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SimulatedWorker(worker.Worker):
+    """
+    Processes a job by downloading the PDF, sleeping ``work_time`` seconds
+    instead of parsing and sending a small result, so the service can be
+    measured without the external tools and without network access.
+    """
+
+    def __init__(self, queue, work_time):
+        worker.Worker.__init__(self, queue)
+        self.daemon = True
+        self.work_time = work_time
+
+    def setup(self):
+        pass
+
+    def _process_item(self, result_url, download_url=None, pdf_path=None,
+                      **kw):
+        if pdf_path is None:
+            r = requests.get(download_url)
+            r.raise_for_status()
+        time.sleep(self.work_time)
+        result = dict(name='stub', security_token=kw.get('security_token'))
+        transport.send_result(result_url, result, None,
+                              kw.get('result_format', 'json'))
+
+
+def start_service(queue_kind, workers, work_time, tmpdir):
+    """
+    Runs ``server.WorkerApp`` with simulated workers in this process.
+
+    :returns: The base URL and a function stopping the service.
+    :rtype: tuple
+    """
+    import cherrypy as cp
+    import server
+
+    if queue_kind == 'sqlite':
+        q = jobqueue.SQLiteJobQueue(os.path.join(tmpdir, jobqueue.JOBS_DB))
+    else:
+        q = jobqueue.PriorityJobQueue()
+    threads = [SimulatedWorker(q, work_time) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    port = _free_port()
+    cp.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': port,
+        'server.thread_pool': server.config['global']['server.thread_pool'],
+        'engine.autoreload.on': False,
+        'log.screen': False,
+    })
+    cp.tree.mount(server.WorkerApp(q), '/', {'/': {}})
+    cp.engine.start()
+    cp.engine.wait(cp.engine.states.STARTED)
+
+    def stop():
+        for _ in threads:
+            q.put(None)
+        cp.engine.exit()
+    return 'http://127.0.0.1:{}'.format(port), stop
+
+
+def schedule(pattern, rate, duration, jobs=None, batch=1):
+    """
+    Yields the submission times (seconds from the start) with the number
+    of jobs posted at once: ``constant`` rate, ``ramp`` from zero to
+    ``rate``, ``burst`` (``jobs`` at once) and ``bulk`` (lists of
+    ``batch`` jobs at ``rate`` jobs/s).
+    """
+    if pattern == 'burst':
+        yield 0.0, jobs or int(rate * duration)
+    elif pattern == 'constant':
+        for i in range(jobs or int(rate * duration)):
+            yield i / rate, 1
+    elif pattern == 'ramp':
+        # Jobs until t at a linear rise to rate: rate * t^2 / (2 * duration)
+        for i in range(jobs or int(rate * duration / 2)):
+            yield (2.0 * i * duration / rate) ** 0.5, 1
+    elif pattern == 'bulk':
+        total = jobs or int(rate * duration)
+        for i in range(0, total, batch):
+            yield i / rate, min(batch, total - i)
+    else:
+        raise ValueError('Unknown pattern: {}'.format(pattern))
+
+
+class LoadTest:
+    """
+    Submits jobs to the worker service following a ``schedule`` with a
+    pool of ``concurrency`` clients, samples the queue length through
+    ``/stats`` and collects the latency of the submission and from the
+    submission to the result arriving at the stub receiver.
+    """
+
+    def __init__(self, target, stub, concurrency=8, auth=None,
+                 result_format='json', priority=None):
+        self.target = target.rstrip('/')
+        self.stub = stub
+        self.concurrency = concurrency
+        self.auth = auth
+        self.result_format = result_format
+        self.priority = priority
+        self.jobs = {}
+        self.errors = []
+        self.queue_samples = []
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def _job(self, num):
+        job_id = uuid.uuid4().hex
+        job = dict(download_url='{}/pdf/{}.pdf'.format(self.stub.url, num),
+                   result_url='{}/result/{}'.format(self.stub.url, job_id),
+                   security_token='loadtest', result_format=self.result_format,
+                   size=len(self.stub.pdfs[num % len(self.stub.pdfs)]))
+        if self.priority:
+            job['priority'] = self.priority
+        return job_id, job
+
+    def _submit(self, jobs, scheduled):
+        start = time.time()
+        body = jobs[0][1] if len(jobs) == 1 else [job for _, job in jobs]
+        try:
+            r = self._session.post(self.target + '/', json=body,
+                                   auth=self.auth, timeout=60)
+            error = None if r.ok else 'HTTP {}'.format(r.status_code)
+        except requests.RequestException as err:
+            error = type(err).__name__
+        end = time.time()
+        with self._lock:
+            for job_id, _ in jobs:
+                self.jobs[job_id] = dict(scheduled=scheduled, submitted=start,
+                                         accepted=end, error=error)
+            if error:
+                self.errors.append(error)
+
+    def _sample_queue(self, stop, start):
+        while not stop.wait(SAMPLE_INTERVAL):
+            try:
+                stats = self._session.get(self.target + '/stats',
+                                          auth=self.auth, timeout=10).json()
+            except (requests.RequestException, ValueError):
+                continue
+            queued = sum(s.get('queued', 0) for s in stats.values())
+            self.queue_samples.append((time.time() - start, queued))
+
+    def run(self, plan, timeout=60.0):
+        start = time.time()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_queue,
+                                   args=(stop, start), daemon=True)
+        sampler.start()
+        num = 0
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for offset, count in plan:
+                wait = start + offset - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                jobs = [self._job(num + i) for i in range(count)]
+                num += count
+                pool.submit(self._submit, jobs, start + offset)
+        accepted = {k for k, v in self.jobs.items() if v['error'] is None}
+        self.stub.wait(accepted, timeout)
+        end = time.time()
+        stop.set()
+        sampler.join()
+        return self.summary(start, end)
+
+    def summary(self, start, end):
+        results = dict(self.stub.results)
+        accepted = {k: v for k, v in self.jobs.items() if v['error'] is None}
+        latency = [results[k] - v['submitted'] for k, v in accepted.items()
+                   if k in results]
+        last = max(results.values()) if results else end
+        queue = [q for _, q in self.queue_samples]
+        return dict(
+            jobs=len(self.jobs),
+            accepted=len(accepted),
+            completed=len(latency),
+            submit_errors=len(self.jobs) - len(accepted),
+            timeouts=len(accepted) - len(latency),
+            error_rate=1 - len(latency) / max(len(self.jobs), 1),
+            duration=end - start,
+            throughput=len(latency) / max(last - start, 1e-9),
+            lag=percentiles([v['submitted'] - v['scheduled']
+                             for v in self.jobs.values()]),
+            submit=percentiles([v['accepted'] - v['submitted']
+                                for v in self.jobs.values()]),
+            latency=percentiles(latency),
+            queue=dict(max=max(queue) if queue else 0,
+                       final=queue[-1] if queue else 0,
+                       growth=_slope(self.queue_samples),
+                       samples=self.queue_samples),
+            errors=sorted(set(self.errors)),
+        )
+
+
+def _ms(value):
+    return '-' if value is None else '{:.0f}ms'.format(value * 1000)
+
+
+def format_summary(s):
+    lines = [
+        '{jobs} jobs in {duration:.1f}s: {completed} completed, '
+        '{submit_errors} submit errors, {timeouts} timeouts ({rate:.1%} '
+        'errors)'.format(rate=s['error_rate'], **s),
+        'Throughput: {:.2f} jobs/s'.format(s['throughput']),
+    ]
+    for key in ('latency', 'submit', 'lag'):
+        p = s[key]
+        lines.append('{:<8} mean {} p50 {} p90 {} p95 {} p99 {} max {}'.format(
+            key.capitalize(), _ms(p['mean']), _ms(p['p50']), _ms(p['p90']),
+            _ms(p['p95']), _ms(p['p99']), _ms(p['max'])))
+    lines.append('Queue: max {max}, final {final}, growth {growth:.2f} '
+                 'jobs/s'.format(**s['queue']))
+    if s['errors']:
+        lines.append('Errors: ' + ', '.join(s['errors']))
+    return '\n'.join(lines)
+
+
+def _metric(summary, key):
+    value = summary
+    for part in key.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(base, other):
+    """Lines with the compared metrics of two saved runs and the change."""
+    lines = ['{:<14} {:>12} {:>12} {:>9}'.format('', base['name'],
+                                                 other['name'], 'change')]
+    for key, higher_better in COMPARED:
+        a = _metric(base['summary'], key)
+        b = _metric(other['summary'], key)
+        if a is None or b is None:
+            continue
+        change = ''
+        if a:
+            rel = (b - a) / abs(a)
+            worse = rel < 0 if higher_better else rel > 0
+            change = '{:+.1%}{}'.format(rel, ' !' if worse and
+                                        abs(rel) > 0.05 else '')
+        lines.append('{:<14} {:>12.4g} {:>12.4g} {:>9}'.format(key, a, b,
+                                                               change))
+    return '\n'.join(lines)
+
+
+def _load_pdfs(pdf_dir, size):
+    if not pdf_dir:
+        return [synthetic_pdf(size)]
+    pdfs = []
+    for name in sorted(os.listdir(pdf_dir)):
+        if name.lower().endswith('.pdf'):
+            with open(os.path.join(pdf_dir, name), 'rb') as fp:
+                pdfs.append(fp.read())
+    if not pdfs:
+        raise ValueError('No PDFs in {}'.format(pdf_dir))
+    return pdfs
+
+
+def main(args):
+    stub = StubServer(_load_pdfs(args.pdf_dir, args.pdf_size))
+    stub.start()
+    auth = tuple(args.auth.split(':', 1)) if args.auth else None
+    with TemporaryDirectory(prefix='msds-loadtest-') as tmpdir:
+        stop = None
+        target = args.target
+        if target is None:
+            target, stop = start_service(args.queue, args.workers,
+                                         args.work_time, tmpdir)
+        try:
+            test = LoadTest(target, stub, args.concurrency, auth,
+                            args.result_format, args.priority)
+            summary = test.run(schedule(args.pattern, args.rate,
+                                        args.duration, args.jobs,
+                                        args.batch), args.timeout)
+        finally:
+            if stop is not None:
+                stop()
+            stub.close()
+    print(format_summary(summary))
+    if args.save:
+        config = {k: v for k, v in vars(args).items()
+                  if k not in ('command', 'save', 'auth')}
+        with open(args.save, 'w', encoding='utf-8') as fp:
+            json.dump(dict(name=args.name or os.path.splitext(
+                os.path.basename(args.save))[0], time=time.time(),
+                config=config, summary=summary), fp, indent=2)
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Load test the worker service with local '
+                       'stub servers for the PDFs and the results.')
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    r = sub.add_parser('run', help='Run a load test')
+    r.add_argument('--target', default=None, help='URL of a running worker '
+                   'service, default is to start one in this process with '
+                   'simulated workers')
+    r.add_argument('--auth', default=None, metavar='USER:PASSWORD',
+                   help='Basic auth for --target')
+    r.add_argument('--pattern', choices=PATTERNS, default='constant',
+                   help='(default: %(default)s)')
+    r.add_argument('--rate', type=float, default=10.0,
+                   help='Jobs per second, the final rate of a ramp '
+                   '(default: %(default)s)')
+    r.add_argument('--duration', type=float, default=30.0,
+                   help='Seconds of submissions (default: %(default)s)')
+    r.add_argument('--jobs', type=int, default=None,
+                   help='Number of jobs instead of rate * duration')
+    r.add_argument('--batch', type=int, default=20,
+                   help='Jobs per request for the bulk pattern (default: '
+                   '%(default)s)')
+    r.add_argument('--priority', choices=jobqueue.CLASSES, default=None,
+                   help='Job class (default: interactive, bulk for lists)')
+    r.add_argument('--concurrency', '-c', type=int, default=8,
+                   help='Concurrent clients (default: %(default)s)')
+    r.add_argument('--timeout', type=float, default=60.0,
+                   help='Seconds to wait for outstanding results after the '
+                   'last submission (default: %(default)s)')
+    r.add_argument('--result-format', choices=transport.FORMATS,
+                   default='json', help='(default: %(default)s)')
+    r.add_argument('--pdf-dir', default=None, help='Serve these PDFs, '
+                   'default is a synthetic one')
+    r.add_argument('--pdf-size', type=int, default=PDF_SIZE,
+                   help='Size of the synthetic PDF (default: %(default)s)')
+    r.add_argument('--queue', choices=('sqlite', 'memory'), default='sqlite',
+                   help='Job queue of the in-process service (default: '
+                   '%(default)s)')
+    r.add_argument('--workers', '-w', type=int, default=1,
+                   help='Simulated workers of the in-process service '
+                   '(default: %(default)s)')
+    r.add_argument('--work-time', type=float, default=0.05,
+                   help='Seconds a simulated worker spends per job '
+                   '(default: %(default)s)')
+    r.add_argument('--save', default=None, metavar='FILE',
+                   help='Store the configuration and results as JSON')
+    r.add_argument('--name', default=None, help='Name of the run in '
+                   'comparisons (default: the file name)')
+    c = sub.add_parser('compare', help='Compare saved runs')
+    c.add_argument('base', help='Saved run to compare against')
+    c.add_argument('others', nargs='+', help='Saved runs')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    if args.command == 'run':
+        main(args)
+    else:
+        with open(args.base, encoding='utf-8') as fp:
+            base = json.load(fp)
+        for filename in args.others:
+            with open(filename, encoding='utf-8') as fp:
+                print(compare(base, json.load(fp)))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import tracemalloc
+
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+
+
+PROFILE_FILE = 'memprofile.json'
+TOP = 20
+HISTORY = 1000
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+_profiler = None
+
+
+class MemoryProfiler:
+    """
+    Takes a tracemalloc snapshot before and after every pipeline stage.
+    The difference is the memory a stage allocated and still holds after
+    it, summed by stage, by document and by source line (allocator). In
+    the pipeline of thread pools (``--workers``) the stages of documents
+    running at the same time are included, profile sequential runs for
+    exact numbers. Snapshots are slow, this is a debugging mode.
+    """
+
+    def __init__(self, frames=1, top=TOP):
+        self.frames = frames
+        self.top = top
+        self.started = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.docs = Counter()
+            self.lines = {}
+            self.history = deque(maxlen=HISTORY)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.started = time.time()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.started = None
+
+    @property
+    def running(self):
+        return self.started is not None and tracemalloc.is_tracing()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(_FILTERS)
+
+    @contextmanager
+    def stage(self, name, doc=None):
+        if not self.running:
+            yield
+            return
+        before = self._snapshot()
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            if self.running:
+                peak = tracemalloc.get_traced_memory()[1] - current
+                after = self._snapshot()
+                self._record(name, doc, after.compare_to(before, 'lineno'),
+                             peak)
+
+    def _record(self, name, doc, diffs, peak):
+        growth = sum(x.size_diff for x in diffs)
+        with self._lock:
+            s = self.stages.setdefault(name, dict(calls=0, growth=0,
+                                                  max_growth=0, peak=0))
+            s['calls'] += 1
+            s['growth'] += growth
+            s['max_growth'] = max(s['max_growth'], growth)
+            s['peak'] = max(s['peak'], peak)
+            if doc is not None:
+                self.docs[doc] += growth
+            lines = self.lines.setdefault(name, Counter())
+            for x in diffs:
+                if x.size_diff:
+                    lines[str(x.traceback[0])] += x.size_diff
+            self.history.append(dict(
+                time=round(time.time(), 3), stage=name, doc=doc,
+                growth=growth, current=tracemalloc.get_traced_memory()[0]))
+
+    def totals(self):
+        """Calls and growth by stage so far (cheap, no snapshot)."""
+        with self._lock:
+            return {name: (s['calls'], s['growth'])
+                    for name, s in self.stages.items()}
+
+    def delta(self, before):
+        """Growth by stage since ``totals`` returned ``before``."""
+        out = {}
+        for name, (calls, growth) in self.totals().items():
+            old_calls, old_growth = before.get(name, (0, 0))
+            if calls != old_calls:
+                out[name] = growth - old_growth
+        return out
+
+    def report(self, top=None):
+        """
+        Growth and peak (bytes above the start) per stage, the documents
+        and source lines with the largest growth and the lines holding the
+        most memory now.
+        """
+        top = top or self.top
+        out = dict(running=self.running, started=self.started)
+        if self.running:
+            current, peak = tracemalloc.get_traced_memory()
+            holders = self._snapshot().statistics('lineno')[:top]
+            out.update(current=current, peak=peak, holders=[
+                dict(line=str(x.traceback[0]), size=x.size, count=x.count)
+                for x in holders])
+        with self._lock:
+            stages = {}
+            for name, s in self.stages.items():
+                stages[name] = dict(s, mean_growth=s['growth'] / s['calls'])
+            out.update(
+                stages=stages,
+                docs=self.docs.most_common(top),
+                lines={name: lines.most_common(top)
+                       for name, lines in self.lines.items()},
+                history=list(self.history)[-top:])
+        return out
+
+
+def _size(num):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(num) < 1024:
+            return '{:.0f} {}'.format(num, unit)
+        num /= 1024
+    return '{:.1f} GiB'.format(num)
+
+
+def format_delta(delta):
+    return ', '.join('{} {}'.format(name, _size(size))
+                     for name, size in sorted(delta.items()))
+
+
+def format_report(report):
+    lines = []
+    for name, s in sorted(report['stages'].items()):
+        lines.append('{}: {} calls, growth {} ({} mean, {} max), peak '
+                     '{}'.format(name, s['calls'], _size(s['growth']),
+                                 _size(s['mean_growth']),
+                                 _size(s['max_growth']), _size(s['peak'])))
+        for line, size in report['lines'].get(name, [])[:5]:
+            lines.append('    {:>10}  {}'.format(_size(size), line))
+    if report['docs']:
+        lines.append('Documents: ' + ', '.join(
+            '{} {}'.format(doc, _size(size)) for doc, size in
+            report['docs'][:5]))
+    if 'current' in report:
+        lines.append('Traced: {} now, {} peak'.format(
+            _size(report['current']), _size(report['peak'])))
+        for holder in report['holders'][:5]:
+            lines.append('    {:>10}  {}'.format(_size(holder['size']),
+                                                 holder['line']))
+    return '\n'.join(lines)
+
+
+def enable(frames=1, top=TOP):
+    """Starts (or restarts) profiling, returns the profiler."""
+    global _profiler
+    if _profiler is None:
+        _profiler = MemoryProfiler(frames, top)
+    _profiler.start()
+    return _profiler
+
+
+def disable():
+    if _profiler is not None:
+        _profiler.stop()
+
+
+def get_profiler():
+    return _profiler
+
+
+def stage(name, doc=None):
+    """Profiles the block as ``name`` if profiling is enabled."""
+    if _profiler is None or not _profiler.running:
+        return nullcontext()
+    return _profiler.stage(name, doc)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import re
+import time
+
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+import tools
+
+
+LOW_DPI = 150
+HIGH_DPI = 300
+MIN_CONFIDENCE = 70.0
+MIN_HEADING_SHARE = 0.6
+SECTIONS = 16
+SECTION_re = re.compile(r'^\s*(?:abschnitt\s+)?(\d{1,2})(?:\.\d{1,2})?[.:]?\s+'
+                        r'[A-ZÄÖÜ]', re.I | re.M)
+
+
+def render(gs_bin, pdf_file, outdir, dpi, device='pnggray', first=None,
+           last=None, prefix='scan'):
+    """
+    Renders the pages of a PDF with Ghostscript.
+
+    :returns: The image files sorted by page.
+    :rtype: list
+    """
+    ext = 'tif' if device.startswith('tiff') else 'png'
+    outname = os.path.join(outdir, '{}_%03d.{}'.format(prefix, ext))
+    cmd = [gs_bin, '-dNOPAUSE', '-r{}'.format(dpi),
+           '-sDEVICE={}'.format(device), '-dBATCH']
+    if device.startswith('tiff'):
+        cmd.append('-sCompression=lzw')
+    if first is not None:
+        cmd.extend(['-dFirstPage={}'.format(first),
+                    '-dLastPage={}'.format(last or first)])
+    cmd.extend(['-sOutputFile={}'.format(outname), pdf_file])
+    tools.run_tool('gs', cmd)
+    files = glob.glob(os.path.join(outdir, '{}_*.{}'.format(prefix, ext)))
+    files.sort()
+    return files
+
+
+def page_ranges(pages):
+    """
+    Groups page numbers into contiguous ranges, so each range is rendered
+    by a single Ghostscript process.
+
+    :returns: (first, last) pairs.
+    :rtype: list
+    """
+    ranges = []
+    for num in sorted(set(pages)):
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return [tuple(r) for r in ranges]
+
+
+def _mean_confidence(tsv_file):
+    confs = []
+    with open(tsv_file, encoding='utf-8') as fp:
+        next(fp, None)
+        for line in fp:
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) < 12 or not cols[11].strip():
+                continue
+            try:
+                conf = float(cols[10])
+            except ValueError:
+                continue
+            if conf >= 0:
+                confs.append(conf)
+    if not confs:
+        return 0.0
+    return sum(confs) / len(confs)
+
+
+def recognize(tess_bin, image, lang='deu'):
+    """
+    Runs Tesseract on one image.
+
+    :returns: The text and the mean word confidence (0-100).
+    :rtype: tuple
+    """
+    outbase = os.path.splitext(image)[0]
+    tools.run_tool('tesseract', [tess_bin, image, outbase, '-l', lang, 'txt',
+                                 'tsv'])
+    with open('{}.txt'.format(outbase), encoding='utf-8') as fp:
+        text = fp.read()
+    return text, _mean_confidence('{}.tsv'.format(outbase))
+
+
+def heading_share(text):
+    """Share of the 16 SDB sections with a recognised heading."""
+    found = set()
+    for m in SECTION_re.finditer(text):
+        num = int(m.group(1))
+        if 1 <= num <= SECTIONS:
+            found.add(num)
+    return len(found) / SECTIONS
+
+
+def run_fixed(pdf_file, gs_bin, tess_bin, stop=None, max_chars=None):
+    """
+    The classic OCR: every page in colour at 300 dpi. Pages are recognised
+    in order until ``stop(page_text)`` returns True or ``max_chars`` are
+    collected.
+    """
+    with TemporaryDirectory() as tmp:
+        outname = os.path.join(tmp, 'scan_%03d.tif')
+        cmd = [gs_bin, '-dNOPAUSE', '-r300', '-sDEVICE=tiffscaled24',
+               '-sCompression=lzw', '-dBATCH',
+               '-sOutputFile={}'.format(outname), pdf_file]
+        tools.run_tool('gs', cmd)
+        scans = glob.glob(os.path.join(tmp, 'scan_*.tif'))
+        scans.sort()
+        out = []
+        size = 0
+        for scan in scans:
+            outname = os.path.splitext(scan)[0]
+            cmd = [tess_bin, scan, outname, '-l', 'deu']
+            tools.run_tool('tesseract', cmd)
+            with open('{}.txt'.format(outname), encoding='utf-8') as fp:
+                out.append(fp.read())
+            size += len(out[-1])
+            if max_chars is not None and size >= max_chars:
+                break
+            if stop is not None and stop(out[-1]):
+                break
+    return '\n'.join(out)
+
+
+def run_adaptive(pdf_file, gs_bin, tess_bin, low_dpi=LOW_DPI,
+                 high_dpi=HIGH_DPI, min_confidence=MIN_CONFIDENCE,
+                 min_heading_share=MIN_HEADING_SHARE, stop=None,
+                 max_chars=None):
+    """
+    OCR in greyscale at low resolution first. Pages with a mean word
+    confidence below ``min_confidence`` are rendered again at
+    ``high_dpi``. If the whole document still shows less than
+    ``min_heading_share`` of the section headings, all remaining low
+    resolution pages are escalated too. As in :func:`run_fixed` pages are
+    recognised in order until ``stop(page_text)`` returns True or
+    ``max_chars`` are collected, the heading check is skipped then.
+
+    :returns: The text and statistics (pages, escalated pages, elapsed
+              seconds and the estimated cost of the fixed 300 dpi run).
+    :rtype: tuple
+    """
+    start = time.time()
+    with TemporaryDirectory() as tmp:
+        pages = []
+        t = time.time()
+        images = render(gs_bin, pdf_file, tmp, low_dpi)
+        render_time = (time.time() - t) / max(len(images), 1)
+
+        def escalate(nums):
+            t = time.time()
+            high = []
+            for first, last in page_ranges(num + 1 for num in nums):
+                high.extend(render(gs_bin, pdf_file, tmp, high_dpi,
+                                   first=first, last=last,
+                                   prefix='high{:03d}'.format(first)))
+            for num, image in zip(sorted(nums), high):
+                text, conf = recognize(tess_bin, image)
+                page = pages[num]
+                if conf >= page['conf'] or not page['text'].strip():
+                    page.update(text=text, conf=conf)
+                page['high'] = True
+            cost = (time.time() - t) / max(len(nums), 1)
+            for num in nums:
+                pages[num]['high_cost'] = cost
+
+        size = 0
+        complete = True
+        for num, image in enumerate(images):
+            t = time.time()
+            text, conf = recognize(tess_bin, image)
+            pages.append(dict(text=text, conf=conf, high=False,
+                              cost=render_time + time.time() - t))
+            if conf < min_confidence:
+                escalate([num])
+            size += len(pages[-1]['text'])
+            if max_chars is not None and size >= max_chars:
+                complete = False
+                break
+            if stop is not None and stop(pages[-1]['text']):
+                complete = False
+                break
+        low_cost = sum(p['cost'] for p in pages) / max(len(pages), 1)
+        text = '\n'.join(p['text'] for p in pages)
+        if complete and heading_share(text) < min_heading_share:
+            escalate([num for num, page in enumerate(pages)
+                      if not page['high']])
+            text = '\n'.join(p['text'] for p in pages)
+    high = [p['high_cost'] for p in pages if p['high']]
+    if high:
+        page_cost = sum(high) / len(high)
+    else:
+        # No high resolution page to measure, scale by the pixel count
+        page_cost = low_cost * (high_dpi / low_dpi) ** 2
+    stats = dict(pages=len(pages), escalated=len(high),
+                 elapsed=time.time() - start,
+                 baseline=page_cost * len(pages))
+    stats['saved'] = stats['baseline'] - stats['elapsed']
+    return text, stats
+
+
+def format_stats(stats):
+    return ('{escalated}/{pages} pages escalated, {elapsed:.1f}s, '
+            '{saved:.1f}s saved against ~{baseline:.1f}s at fixed '
+            '300 dpi'.format(**stats))
+
+
+def benchmark(pdf_files, gs_bin, tess_bin):
+    """Runs both OCR modes on the given files and prints the timings."""
+    total_fixed = total_adaptive = 0.0
+    for pdf_file in pdf_files:
+        t = time.time()
+        run_fixed(pdf_file, gs_bin, tess_bin)
+        fixed = time.time() - t
+        _, stats = run_adaptive(pdf_file, gs_bin, tess_bin)
+        total_fixed += fixed
+        total_adaptive += stats['elapsed']
+        print('{}: fixed {:.1f}s, adaptive {:.1f}s ({}/{} pages '
+              'escalated)'.format(os.path.basename(pdf_file), fixed,
+                                  stats['elapsed'], stats['escalated'],
+                                  stats['pages']))
+    print('Total: fixed {:.1f}s, adaptive {:.1f}s'.format(total_fixed,
+                                                          total_adaptive))
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Compare fixed 300 dpi OCR with the '
+                       'adaptive OCR mode.')
+    p.add_argument('pdf_files', nargs='+', help='Scanned SDBs')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    from extractors import GS_BIN, TESS_BIN
+    args = _parse_commandline()
+    benchmark(args.pdf_files, GS_BIN, TESS_BIN)
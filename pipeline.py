@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import threading
+import time
+
+
+# Stage groups by the kind of work: text extraction and parsing (CPU and
+# external tools), PubChem enrichment (network) and writing the results.
+POOLS = (
+    ('cpu', ('extract', 'parse', 'uba')),
+    ('io', ('enrich',)),
+    ('write', ('finalize',)),
+)
+logger = logging.getLogger(__name__)
+DEFAULT_WORKERS = {'cpu': os.cpu_count() or 2, 'io': 8, 'write': 1}
+SAMPLE_INTERVAL = 0.2
+_DONE = object()
+
+
+def parse_workers(spec):
+    """
+    Parses pool sizes like ``cpu=4,io=16`` from the command line, missing
+    pools keep their default size.
+    """
+    workers = dict(DEFAULT_WORKERS)
+    for part in filter(None, (spec or '').split(',')):
+        name, _, value = part.partition('=')
+        name = name.strip()
+        if name not in workers:
+            raise ValueError('Unknown pool: {}'.format(name))
+        workers[name] = max(int(value), 1)
+    return workers
+
+
+class Step:
+    """One pool of worker threads with its bounded input queue."""
+
+    def __init__(self, name, func, workers, maxsize=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize or 2 * workers)
+        self.busy = 0
+        self.done = 0
+        self.errors = 0
+        self.work_time = 0.0
+        self.samples = 0
+        self.queued_sum = 0
+        self.queued_max = 0
+        self.busy_sum = 0
+        self._lock = threading.Lock()
+
+    def sample(self):
+        size = self.queue.qsize()
+        with self._lock:
+            self.samples += 1
+            self.queued_sum += size
+            self.queued_max = max(self.queued_max, size)
+            self.busy_sum += self.busy
+
+    def stats(self):
+        samples = max(self.samples, 1)
+        return dict(name=self.name, workers=self.workers,
+                    maxsize=self.queue.maxsize, done=self.done,
+                    errors=self.errors,
+                    queued_mean=self.queued_sum / samples,
+                    queued_max=self.queued_max,
+                    busy=self.busy_sum / samples / self.workers,
+                    item_time=self.work_time / max(self.done, 1))
+
+
+class PipelineExecutor:
+    """
+    Runs items through consecutive steps, each with its own thread pool and
+    bounded queue, so e.g. documents are parsed while others wait for
+    PubChem. A full queue blocks the previous step (back pressure). A step
+    function returns the item for the next step or None to drop it.
+    Exceptions are logged and drop the item.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.results = []
+        self._results_lock = threading.Lock()
+
+    def _work(self, num):
+        step = self.steps[num]
+        last = num == len(self.steps) - 1
+        while True:
+            item = step.queue.get()
+            if item is _DONE:
+                break
+            with step._lock:
+                step.busy += 1
+            t = time.time()
+            try:
+                out = step.func(item)
+            except Exception:
+                logger.exception('%s failed', step.name,
+                                 extra=dict(step=step.name))
+                out = None
+                with step._lock:
+                    step.errors += 1
+            with step._lock:
+                step.busy -= 1
+                step.done += 1
+                step.work_time += time.time() - t
+            if out is None:
+                continue
+            if last:
+                with self._results_lock:
+                    self.results.append(out)
+            else:
+                self.steps[num + 1].queue.put(out)
+
+    def _monitor(self, stop):
+        while not stop.wait(SAMPLE_INTERVAL):
+            for step in self.steps:
+                step.sample()
+
+    def run(self, items):
+        """Processes all items, returns the results of the last step."""
+        stop = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(stop,),
+                                   daemon=True)
+        monitor.start()
+        pools = []
+        for num, step in enumerate(self.steps):
+            threads = [threading.Thread(target=self._work, args=(num,),
+                                        daemon=True)
+                       for _ in range(step.workers)]
+            for thread in threads:
+                thread.start()
+            pools.append(threads)
+        for item in items:
+            self.steps[0].queue.put(item)
+        # Shut the pools down in order, so every queue is drained first
+        for step, threads in zip(self.steps, pools):
+            for _ in threads:
+                step.queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+        stop.set()
+        monitor.join()
+        return self.results
+
+    def report(self):
+        lines = []
+        for step in self.steps:
+            lines.append(
+                '{name}: {done} items ({errors} errors) with {workers} '
+                'workers, {item_time:.2f}s/item, {busy:.0%} busy, queue '
+                '{queued_mean:.1f} mean / {queued_max} max of '
+                '{maxsize}'.format(**step.stats()))
+        return '\n'.join(lines)
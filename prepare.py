@@ -28,7 +28,7 @@ def check_cmr(hazard):
     return False
 
 
-def prepare_data(chem, outdir):
+def prepare_data(chem, outdir, embed_structure=True):
     if not chem:
         return
     chem['cmr'] = False
@@ -46,10 +46,14 @@ def prepare_data(chem, outdir):
     if chem['source']:
         del chem['source']
     if chem['structure']:
-        with open(chem['structure'], 'rb') as fp:
-            data = fp.read()
         chem['structure_fn'] = os.path.basename(chem['structure'])
-        chem['structure'] = base64.b64encode(data).decode('ascii')
+        if embed_structure:
+            with open(chem['structure'], 'rb') as fp:
+                data = fp.read()
+            chem['structure'] = base64.b64encode(data).decode('ascii')
+        else:
+            # Sent as separate part, see transport.send_result
+            chem['structure'] = ''
     if chem['formula']:
         chem['formula'] = chem['formula'].replace(' ', '')
     if chem['signal']:
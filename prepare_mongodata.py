@@ -4,9 +4,16 @@
 
 import json
 import os
-import sys
+import zlib
 
-from zipfile import ZipFile
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZIP_STORED, ZipFile
+
+
+READ_WORKERS = 4
+CHUNK_SIZE = 1 << 16
 
 
 def load_data(filename):
@@ -20,44 +27,253 @@ def write_data(filename, data):
         json.dump(data, fp, indent=2, sort_keys=True)
 
 
-def prepare_data(data, outdir):
-    new_data = []
-    sdbs = ZipFile(os.path.join(outdir, 'sdbs.zip'), 'w')
-    structures = ZipFile(os.path.join(outdir, 'structures.zip'), 'w')
-    for chem in data:
-        if not chem:
-            continue
-        if chem['h']:
-            chem['h'] = [x.replace('H', '') for x in chem['h']]
-        if chem['p']:
-            chem['p'] = [x.replace('P', '') for x in chem['p']]
-        if chem['euh']:
-            chem['euh'] = [x.replace('EUH', '') for x in chem['euh']]
-        if chem['symbols']:
-            chem['symbols'] = [int(x.replace('GHS', '')) for x in
-                               chem['symbols']]
-        if chem['source']:
-            name = os.path.basename(chem['source'])
-            sdbs.write(chem['source'], name)
-            chem['source'] = name
-        if chem['structure']:
-            name = os.path.basename(chem['structure'])
-            structures.write(chem['structure'], name)
-            chem['structure'] = name
-        new_data.append(chem)
-    sdbs.close()
-    structures.close()
-    write_data(os.path.join(outdir, 'all_cleaned.json'), new_data)
-
-
-def main(infile, outdir):
-    data = load_data(infile)
-    new = prepare_data(data, outdir)
+def iter_data(filename):
+    """
+    Yields the chemicals of a JSON array file (like all.json) one by one
+    without loading the whole file. Files not starting with '[' are read
+    as NDJSON.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, encoding='utf-8') as fp:
+        buf = fp.read(CHUNK_SIZE).lstrip()
+        if not buf.startswith('['):
+            for line in (buf + fp.readline()).splitlines():
+                if line.strip():
+                    yield json.loads(line)
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        pos = 1
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                chem, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = fp.read(CHUNK_SIZE)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield chem
+            pos = end
 
 
-if __name__ == '__main__':
+def _bounded_map(func, items, workers):
+    # Like Executor.map, but only keeps a few results in flight so the
+    # input is never read completely into memory.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def clean_chem(chem):
+    if chem['h']:
+        chem['h'] = [x.replace('H', '') for x in chem['h']]
+    if chem['p']:
+        chem['p'] = [x.replace('P', '') for x in chem['p']]
+    if chem['euh']:
+        chem['euh'] = [x.replace('EUH', '') for x in chem['euh']]
+    if chem['symbols']:
+        chem['symbols'] = [int(x.replace('GHS', '')) for x in
+                           chem['symbols']]
+    return chem
+
+
+def read_file(path, with_crc=False):
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    crc = zlib.crc32(content) if with_crc else None
+    return content, crc
+
+
+class Archive:
+    """
+    Zip archive storing (not deflating) already compressed PDFs and PNGs.
+    In incremental mode an existing archive is opened for appending and
+    only new files are added, changed files (different CRC or size) are
+    replaced by rewriting the archive once on close.
+    """
+
+    def __init__(self, filename, incremental=False):
+        self.filename = filename
+        self.existing = {}
+        self.names = set()
+        self.replaced = {}
+        self.stats = dict(added=0, unchanged=0, replaced=0)
+        mode = 'w'
+        if incremental and os.path.isfile(filename):
+            with ZipFile(filename) as zf:
+                self.existing = {i.filename: (i.CRC, i.file_size) for i in
+                                 zf.infolist()}
+            mode = 'a'
+        self.zip = ZipFile(filename, mode, ZIP_STORED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, name, content, crc=None):
+        if name in self.names:
+            return
+        self.names.add(name)
+        old = self.existing.get(name)
+        if old is None:
+            self.zip.writestr(name, content, ZIP_STORED)
+            self.stats['added'] += 1
+        elif old == (crc, len(content)):
+            self.stats['unchanged'] += 1
+        else:
+            self.replaced[name] = content
+            self.stats['replaced'] += 1
+
+    def close(self):
+        self.zip.close()
+        if not self.replaced:
+            return
+        tmp_name = '{}.tmp'.format(self.filename)
+        try:
+            with ZipFile(self.filename) as old, \
+                    ZipFile(tmp_name, 'w', ZIP_STORED) as new:
+                for info in old.infolist():
+                    if info.filename not in self.replaced:
+                        new.writestr(info, old.read(info),
+                                     info.compress_type)
+                for name, content in self.replaced.items():
+                    new.writestr(name, content, ZIP_STORED)
+            os.replace(tmp_name, self.filename)
+        except BaseException:
+            _remove(tmp_name)
+            raise
+        self.replaced = {}
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _load(chem, archives):
+    files = []
+    chem = clean_chem(chem)
+    for key in ('source', 'structure'):
+        if chem[key]:
+            name = os.path.basename(chem[key])
+            # The CRC is only needed to compare with an archived file, the
+            # zip file computes it for the files it writes
+            content, crc = read_file(chem[key],
+                                     name in archives[key].existing)
+            files.append((key, name, content, crc))
+            chem[key] = name
+    return chem, files
+
+
+def prepare_data(data, outdir, incremental=False, workers=READ_WORKERS,
+                 ndjson=False):
+    """
+    Cleans the chemicals and packs sources and structures into zip files.
+    Files are read in parallel, the cleaned data is written as JSON array
+    (all_cleaned.json) and optionally as NDJSON (all_cleaned.ndjson, ready
+    for mongoimport). Nothing is left behind on errors except the zip
+    files.
+
+    :parameters:
+        data : iterable
+            The chemicals (e.g. from ``iter_data``).
+        outdir : str
+            Directory to write the results to.
+        incremental : bool
+            Only add new or changed files to existing archives.
+        workers : int
+            Number of threads reading files.
+        ndjson : bool
+            Write all_cleaned.ndjson too.
+
+    :returns: Statistics of both archives.
+    :rtype: dict
+    """
+    json_path = os.path.join(outdir, 'all_cleaned.json')
+    ndjson_path = os.path.join(outdir, 'all_cleaned.ndjson')
+    tmp_names = ['{}.tmp'.format(json_path)]
+    if ndjson:
+        tmp_names.append('{}.tmp'.format(ndjson_path))
+    sdbs = Archive(os.path.join(outdir, 'sdbs.zip'), incremental)
+    structures = Archive(os.path.join(outdir, 'structures.zip'), incremental)
+    archives = dict(source=sdbs, structure=structures)
+    lines = None
     try:
-        main(sys.argv[1], sys.argv[2])
-    except:
-        print('Usage: {} INFILE OUTDIR'.format(sys.argv[0]))
+        out = open(tmp_names[0], 'w', encoding='utf-8')
+        if ndjson:
+            lines = open(tmp_names[1], 'w', encoding='utf-8')
+        with out, sdbs, structures:
+            out.write('[')
+            chems = (chem for chem in data if chem)
+            loaded = _bounded_map(lambda c: _load(c, archives), chems,
+                                  workers)
+            for num, (chem, files) in enumerate(loaded):
+                for key, name, content, crc in files:
+                    archives[key].add(name, content, crc)
+                out.write(',\n' if num else '\n')
+                out.write(json.dumps(chem, indent=2, sort_keys=True))
+                if lines is not None:
+                    lines.write(json.dumps(chem, sort_keys=True))
+                    lines.write('\n')
+            out.write('\n]')
+            if lines is not None:
+                lines.close()
+    except BaseException:
+        if lines is not None:
+            lines.close()
+        for tmp_name in tmp_names:
+            _remove(tmp_name)
         raise
+    os.replace(tmp_names[0], json_path)
+    if ndjson:
+        os.replace(tmp_names[1], ndjson_path)
+    return dict(sdbs=sdbs.stats, structures=structures.stats)
+
+
+def main(infile, outdir, incremental=False, workers=READ_WORKERS,
+         ndjson=False):
+    return prepare_data(iter_data(infile), outdir, incremental, workers,
+                        ndjson)
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Prepare parsed SDB data (all.json) for '
+                       'the import into MongoDB.')
+    p.add_argument('infile', help='all.json (or NDJSON) file')
+    p.add_argument('outdir', help='Directory to write the results to')
+    p.add_argument('--incremental', '-i', action='store_true', default=False,
+                   help='Only add new or changed files to existing archives '
+                   '(default: %(default)s)')
+    p.add_argument('--workers', '-w', type=int, default=READ_WORKERS,
+                   help='Threads reading files (default: %(default)s)')
+    p.add_argument('--ndjson', '-n', action='store_true', default=False,
+                   help='Also write all_cleaned.ndjson for mongoimport '
+                   '(default: %(default)s)')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    stats = main(args.infile, args.outdir, args.incremental, args.workers,
+                 args.ndjson)
+    for name, s in sorted(stats.items()):
+        print('{}: {added} added, {replaced} replaced, {unchanged} '
+              'unchanged'.format(name, **s))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+PRIORITIES = ('interactive', 'bulk')
+# (capacity, period in seconds) per bucket. PubChem allows 5 requests per
+# second and 400 per minute, one token per 0.2 s avoids bursts.
+PUBCHEM_LIMITS = ((1, 0.2), (400, 60.0))
+STATE_FILE = os.environ.get('MSDS_RATE_FILE', os.path.join(
+    tempfile.gettempdir(), 'msds-pubchem-rate.json'))
+# Interactive waiters older than this are considered dead
+WAITER_TTL = 30.0
+MAX_RETRIES = 4
+BACKOFF = 2.0
+_POLL = 0.05
+_priority = contextvars.ContextVar('rate_priority', default=None)
+
+
+def _add_stats(stats, priority, waited=0.0, throttled=False):
+    s = stats.setdefault(priority, dict(requests=0, waited=0.0, max_wait=0.0,
+                                        throttled=0))
+    if throttled:
+        s['throttled'] += 1
+    else:
+        s['requests'] += 1
+        s['waited'] += waited
+        s['max_wait'] = max(s['max_wait'], waited)
+
+
+class RateLimiter:
+    """
+    Token buckets shared by all processes on the host through a locked
+    state file, so CLI batches and the worker service together stay below
+    the PubChem limits. While an interactive request is waiting, bulk
+    requests hold back. Wait times are collected per process (``stats``)
+    and per priority in the state file (``shared_stats``).
+    """
+
+    def __init__(self, state_file=STATE_FILE, limits=PUBCHEM_LIMITS,
+                 priority='bulk'):
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority: {}'.format(priority))
+        self.state_file = state_file
+        self.limits = limits
+        self.priority = priority
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._waiter = '{}-{}'.format(os.getpid(), id(self))
+
+    def _update(self, func):
+        """Calls ``func(state)`` with the state file locked and saves it."""
+        with self._lock:
+            fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o666)
+            with os.fdopen(fd, 'r+', encoding='utf-8') as fp:
+                if fcntl is not None:
+                    fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(fp.read() or '{}')
+                except ValueError:
+                    state = {}
+                result = func(state)
+                fp.seek(0)
+                fp.truncate()
+                json.dump(state, fp)
+                fp.flush()
+        return result
+
+    def _take(self, state, priority, start):
+        """Takes a token from every bucket or returns the time to wait."""
+        now = time.time()
+        waiters = state.setdefault('waiters', {})
+        for key, since in list(waiters.items()):
+            if now - since > WAITER_TTL:
+                del waiters[key]
+        if priority == 'bulk' and waiters:
+            return _POLL
+        buckets = state.setdefault('buckets', {})
+        levels = []
+        wait = 0.0
+        for capacity, period in self.limits:
+            key = '{}/{}'.format(capacity, period)
+            tokens, last = buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * capacity / period)
+            levels.append((key, tokens))
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) * period / capacity)
+        if wait:
+            if priority == 'interactive':
+                waiters[self._waiter] = waiters.get(self._waiter, now)
+            return wait
+        for key, tokens in levels:
+            buckets[key] = (tokens - 1, now)
+        waiters.pop(self._waiter, None)
+        _add_stats(state.setdefault('stats', {}), priority, now - start)
+        return 0.0
+
+    def acquire(self, priority=None):
+        """
+        Blocks until a request may be sent.
+
+        :returns: The time waited in seconds.
+        :rtype: float
+        """
+        priority = priority or _priority.get() or self.priority
+        start = time.time()
+        while True:
+            wait = self._update(
+                lambda state: self._take(state, priority, start))
+            if not wait:
+                break
+            time.sleep(wait)
+        waited = time.time() - start
+        with self._lock:
+            _add_stats(self._stats, priority, waited)
+        return waited
+
+    def throttled(self, priority=None):
+        """Records a request rejected by the server (HTTP 503)."""
+        priority = priority or _priority.get() or self.priority
+        with self._lock:
+            _add_stats(self._stats, priority, throttled=True)
+        self._update(lambda state: _add_stats(
+            state.setdefault('stats', {}), priority, throttled=True))
+
+    def call(self, func, *args, **kw):
+        """
+        Calls ``func`` after acquiring a token. Calls rejected because of
+        too many requests (HTTP 503) are retried with exponential backoff.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kw)
+            except Exception as err:
+                if (getattr(err, 'code', None) != 503 or
+                        attempt == MAX_RETRIES):
+                    raise
+                self.throttled()
+            else:
+                if getattr(result, 'status_code', None) != 503:
+                    return result
+                if attempt == MAX_RETRIES:
+                    return result
+                self.throttled()
+            time.sleep(BACKOFF * 2 ** attempt)
+
+    def stats(self):
+        """Returns the wait statistics of this process by priority."""
+        with self._lock:
+            return {p: dict(s) for p, s in self._stats.items()}
+
+    def shared_stats(self):
+        """Returns the wait statistics of all processes by priority."""
+        return self._update(lambda state: dict(state.get('stats', {})))
+
+
+_LIMITER = None
+
+
+def configure(priority=None, state_file=None):
+    """Sets up the limiter of this process (e.g. interactive in the worker)."""
+    global _LIMITER
+    _LIMITER = RateLimiter(state_file or STATE_FILE,
+                           priority=priority or 'bulk')
+    return _LIMITER
+
+
+def get_limiter():
+    if _LIMITER is None:
+        configure()
+    return _LIMITER
+
+
+@contextmanager
+def priority(name):
+    """
+    Requests within (in this thread) use the priority instead of the one
+    of the limiter, e.g. the class of a job in the worker service.
+    """
+    if name not in PRIORITIES:
+        raise ValueError('Unknown priority: {}'.format(name))
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def format_stats(stats):
+    lines = []
+    for priority, s in sorted(stats.items()):
+        mean = s['waited'] / s['requests'] if s['requests'] else 0.0
+        lines.append('{}: {} requests, {:.1f}s waited (mean {:.2f}s, max '
+                     '{:.2f}s), {} throttled'.format(
+                         priority, s['requests'], s['waited'], mean,
+                         s['max_wait'], s['throttled']))
+    return '\n'.join(lines)
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Show or reset the shared PubChem rate '
+                       'limiter statistics.')
+    p.add_argument('--state-file', default=STATE_FILE,
+                   help='State file (default: %(default)s)')
+    p.add_argument('--reset', action='store_true', default=False,
+                   help='Reset the statistics')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    limiter = RateLimiter(args.state_file)
+    if args.reset:
+        limiter._update(lambda state: state.pop('stats', None))
+    print(format_stats(limiter.shared_stats()) or 'No requests recorded.')
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from argparse import ArgumentParser
+
+
+DB_FILE = 'results.db'
+# Structure PNGs of the SQLite store, written on demand
+STRUCTURE_DIR = 'structures'
+# Stage artifacts of the directory store, see stages.ArtifactStore
+ARTIFACT_DIR = 'stages'
+
+
+def layout_path(outdir, doc_id, ext='json'):
+    """
+    Returns the path of a result file in the classic directory layout
+    (``outdir/a/Aceton SDB.json``).
+    """
+    return os.path.join(outdir, doc_id[0].lower(),
+                        '{} SDB.{}'.format(doc_id, ext))
+
+
+def _ensure_dir(filename, created):
+    """Creates the directory of a file once per store (``created``)."""
+    path = os.path.dirname(filename)
+    if path not in created:
+        os.makedirs(path, exist_ok=True)
+        created.add(path)
+
+
+def _dump(data):
+    return json.dumps(data, indent=2, sort_keys=True)
+
+
+def _write_atomic(filename, content, created):
+    _ensure_dir(filename, created)
+    tmp_name = '{}.tmp'.format(filename)
+    with open(tmp_name, 'wb') as fp:
+        fp.write(content)
+    os.replace(tmp_name, filename)
+
+
+class DirectoryStore:
+    """One JSON (and PNG) file per document, the classic layout."""
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self._dirs = set()
+
+    def exists(self, doc_id):
+        return os.path.isfile(layout_path(self.outdir, doc_id))
+
+    def structure_path(self, doc_id):
+        return layout_path(self.outdir, doc_id, 'png')
+
+    def get(self, doc_id):
+        try:
+            with open(layout_path(self.outdir, doc_id), encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def get_structure(self, doc_id):
+        try:
+            with open(self.structure_path(doc_id), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def structure_file(self, doc_id):
+        """The path of the structure PNG or None if there is none."""
+        path = self.structure_path(doc_id)
+        return path if os.path.isfile(path) else None
+
+    def put(self, doc_id, data, structure=None):
+        if structure:
+            _write_atomic(self.structure_path(doc_id), structure,
+                          self._dirs)
+        _write_atomic(layout_path(self.outdir, doc_id),
+                      _dump(data).encode('utf-8'), self._dirs)
+
+    def _artifact_path(self, stage, doc_id, ext):
+        return layout_path(os.path.join(self.outdir, ARTIFACT_DIR, stage),
+                           doc_id, ext)
+
+    def get_artifact(self, stage, doc_id, ext):
+        try:
+            with open(self._artifact_path(stage, doc_id, ext), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def put_artifact(self, stage, doc_id, ext, content):
+        _write_atomic(self._artifact_path(stage, doc_id, ext), content,
+                      self._dirs)
+
+    def ids(self):
+        pattern = os.path.join(self.outdir, '*', '* SDB.json')
+        for filename in sorted(glob.glob(pattern)):
+            yield os.path.basename(filename)[:-len(' SDB.json')]
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """
+    All results in one SQLite file. JSON is stored zlib compressed, the
+    structure PNGs (already compressed) as they are. Every ``put`` is one
+    transaction, so a document is either stored completely or not at all.
+    Structure paths point into ``outdir/structures/``, where
+    ``structure_file`` writes a PNG from the database when it is needed.
+    The stage artifacts are kept in the same file. The connection is
+    shared by the threads of the pipeline, every access holds a lock.
+    """
+
+    def __init__(self, filename, outdir=None, shared=False):
+        self.filename = filename
+        self.outdir = outdir or os.path.dirname(os.path.abspath(filename))
+        self._dirs = set()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=30,
+                                    check_same_thread=False)
+        # WAL needs shared memory, which network file systems lack
+        self.conn.execute('PRAGMA journal_mode={}'.format(
+            'DELETE' if shared else 'WAL'))
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'doc_id TEXT PRIMARY KEY, data BLOB NOT NULL, structure BLOB, '
+            'updated REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS artifacts ('
+            'stage TEXT NOT NULL, doc_id TEXT NOT NULL, ext TEXT NOT NULL, '
+            'content BLOB NOT NULL, PRIMARY KEY (stage, doc_id, ext))'
+        )
+        self.conn.commit()
+
+    def _fetchone(self, sql, params):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def _write(self, sql, params):
+        """Runs one statement as a transaction."""
+        with self._lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def exists(self, doc_id):
+        row = self._fetchone('SELECT 1 FROM results WHERE doc_id = ?',
+                             (doc_id,))
+        return row is not None
+
+    def structure_path(self, doc_id):
+        return os.path.join(self.outdir, STRUCTURE_DIR,
+                            '{} SDB.png'.format(doc_id))
+
+    def structure_file(self, doc_id):
+        """
+        Writes the structure PNG from the database unless it exists, returns
+        its path or None if the document has no structure.
+        """
+        path = self.structure_path(doc_id)
+        if os.path.isfile(path):
+            return path
+        structure = self.get_structure(doc_id)
+        if structure is None:
+            return None
+        _write_atomic(path, structure, self._dirs)
+        return path
+
+    def get(self, doc_id):
+        row = self._fetchone('SELECT data FROM results WHERE doc_id = ?',
+                             (doc_id,))
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def get_structure(self, doc_id):
+        row = self._fetchone(
+            'SELECT structure FROM results WHERE doc_id = ?', (doc_id,))
+        if row is None or row[0] is None:
+            return None
+        return bytes(row[0])
+
+    def put(self, doc_id, data, structure=None):
+        raw = zlib.compress(_dump(data).encode('utf-8'))
+        self._write(
+            'INSERT INTO results (doc_id, data, structure, updated) '
+            'VALUES (?, ?, ?, ?) ON CONFLICT(doc_id) DO UPDATE SET '
+            'data = excluded.data, structure = COALESCE('
+            'excluded.structure, results.structure), '
+            'updated = excluded.updated',
+            (doc_id, raw, structure or None, time.time())
+        )
+        if structure:
+            # Written again from the new blob when needed
+            try:
+                os.remove(self.structure_path(doc_id))
+            except FileNotFoundError:
+                pass
+
+    def get_artifact(self, stage, doc_id, ext):
+        row = self._fetchone(
+            'SELECT content FROM artifacts WHERE stage = ? AND doc_id = ? '
+            'AND ext = ?', (stage, doc_id, ext))
+        return None if row is None else bytes(row[0])
+
+    def put_artifact(self, stage, doc_id, ext, content):
+        self._write(
+            'INSERT OR REPLACE INTO artifacts (stage, doc_id, ext, content) '
+            'VALUES (?, ?, ?, ?)', (stage, doc_id, ext, content))
+
+    def ids(self):
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT doc_id FROM results ORDER BY doc_id').fetchall()
+        for row in rows:
+            yield row[0]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def open_store(spec, outdir, shared=False):
+    """
+    Opens the result store given on the command line.
+
+    :parameters:
+        spec : str
+            ``dir`` (classic layout), ``sqlite`` (``results.db`` in outdir)
+            or ``sqlite:PATH``.
+        outdir : str
+            The result directory.
+        shared : bool
+            The store is used by several nodes (e.g. on NFS).
+    """
+    if not spec or spec == 'dir':
+        return DirectoryStore(outdir)
+    if spec == 'sqlite':
+        return SQLiteStore(os.path.join(outdir, DB_FILE), outdir, shared)
+    if spec.startswith('sqlite:'):
+        return SQLiteStore(spec[len('sqlite:'):], outdir, shared)
+    raise ValueError('Unknown result store: {}'.format(spec))
+
+
+def copy_store(source, target):
+    """
+    Copies all documents (and structures) from one store to another, the
+    structure paths in the data are those of the target.
+    """
+    num = 0
+    for doc_id in source.ids():
+        data = source.get(doc_id)
+        structure = source.get_structure(doc_id)
+        if data.get('structure'):
+            data['structure'] = (target.structure_path(doc_id) if structure
+                                 else '')
+        target.put(doc_id, data, structure)
+        num += 1
+    return num
+
+
+def export_directory(store, outdir):
+    """Writes all documents of a store in the classic directory layout."""
+    return copy_store(store, DirectoryStore(outdir))
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Convert between the SQLite result store '
+                       'and the classic result directory layout.')
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    e = sub.add_parser('export', help='Write the directory layout')
+    e.add_argument('database', help='SQLite result store')
+    e.add_argument('outdir', help='Result directory to write')
+    i = sub.add_parser('import', help='Load a result directory')
+    i.add_argument('outdir', help='Existing result directory')
+    i.add_argument('database', help='SQLite result store')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    db = SQLiteStore(args.database, args.outdir)
+    try:
+        if args.command == 'export':
+            num = export_directory(db, args.outdir)
+        else:
+            num = copy_store(DirectoryStore(args.outdir), db)
+    finally:
+        db.close()
+    print('Copied {} documents'.format(num))
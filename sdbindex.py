@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right, insort
+
+import utils
+
+
+INDEX_FILE = 'index.json'
+VERSION = 1
+# Query field --> field(s) of the parsed data
+FIELDS = {
+    'cas': ('cas',),
+    'eg': ('eg_num',),
+    'h': ('h',),
+    'p': ('p',),
+    'euh': ('euh',),
+    'ghs': ('symbols',),
+    'wgk': ('wgk',),
+    'lgk': ('lgk_trgs510',),
+    'producer': ('producer',),
+}
+NAME_FIELDS = ('name', 'name_en', 'art_name', 'synonyms')
+TOKEN_re = re.compile(
+    r'\s*(?:(\()|(\))|(review)\s*(<=|>=|<|>|=)\s*(\S+?)(?=[\s()]|$)|'
+    r'((?:[^\s()"]+:)?"[^"]*"|[^\s()]+))'
+)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _values(data, key):
+    value = data.get(key)
+    if value is None or value == '':
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [str(x) for x in value if str(x).strip()]
+    return [str(value)]
+
+
+def _normalize(field, value):
+    value = value.strip().strip('"').strip()
+    if field == 'producer':
+        return value.lower()
+    return value.upper()
+
+
+class SDBIndex:
+    """
+    Inverted index over parsed SDB data. Keeps posting lists for exact
+    fields, a sorted review date list for range queries and a sorted name
+    list for prefix queries. Documents are identified by their document ID
+    (see ``utils.get_doc_id``) and can be added or replaced one at a time.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.docs = {}
+        self.postings = {}
+        self.dates = []
+        self.names = []
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, filename):
+        index = cls(filename)
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as fp:
+                raw = json.load(fp)
+            if raw.get('version') == VERSION:
+                for doc_id, entry in raw['docs'].items():
+                    index._insert(doc_id, entry, False)
+                index.dates.sort()
+                index.names.sort()
+        return index
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with self._lock:
+            raw = dict(version=VERSION, docs=self.docs)
+            tmp_name = '{}.tmp'.format(filename)
+            with open(tmp_name, 'w', encoding='utf-8') as fp:
+                json.dump(raw, fp, sort_keys=True)
+            os.replace(tmp_name, filename)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.docs
+
+    @staticmethod
+    def _entry(data):
+        terms = []
+        for field, keys in FIELDS.items():
+            for key in keys:
+                for value in _values(data, key):
+                    if field == 'producer':
+                        for word in value.lower().split():
+                            terms.append([field, word.strip(',.')])
+                    else:
+                        terms.append([field, _normalize(field, value)])
+        names = set()
+        for key in NAME_FIELDS:
+            for value in _values(data, key):
+                names.add(value.strip().lower())
+        review = str(data.get('review_date') or '')
+        if not re.match(r'\d{4}-\d{2}-\d{2}', review):
+            review = ''
+        summary = dict(name=data.get('name', ''), cas=data.get('cas', ''),
+                       producer=data.get('producer', ''))
+        return dict(terms=terms, names=sorted(names), review=review,
+                    summary=summary)
+
+    def _insert(self, doc_id, entry, keep_sorted=True):
+        self.docs[doc_id] = entry
+        for field, value in entry['terms']:
+            self.postings.setdefault((field, value), set()).add(doc_id)
+        add = insort if keep_sorted else list.append
+        if entry['review']:
+            add(self.dates, (entry['review'], doc_id))
+        for name in entry['names']:
+            add(self.names, (name, doc_id))
+
+    def remove(self, doc_id):
+        with self._lock:
+            entry = self.docs.pop(doc_id, None)
+            if entry is None:
+                return
+            for field, value in entry['terms']:
+                posting = self.postings.get((field, value))
+                if posting is not None:
+                    posting.discard(doc_id)
+                    if not posting:
+                        del self.postings[(field, value)]
+            if entry['review']:
+                pos = bisect_left(self.dates, (entry['review'], doc_id))
+                del self.dates[pos]
+            for name in entry['names']:
+                pos = bisect_left(self.names, (name, doc_id))
+                del self.names[pos]
+
+    def add(self, data, doc_id=None):
+        """
+        Adds (or replaces) one document as returned by ``sdbparser.run``.
+
+        :parameters:
+            data : dict
+                The parsed data.
+            doc_id : str
+                Defaults to the ID derived from ``data['source']``.
+        """
+        if not data:
+            return
+        if doc_id is None:
+            doc_id = utils.get_doc_id(data.get('source') or data['name'])
+        with self._lock:
+            self.remove(doc_id)
+            self._insert(doc_id, self._entry(data))
+
+    def term(self, field, value):
+        if field not in FIELDS:
+            raise QueryError('Unknown field: {}'.format(field))
+        value = _normalize(field, value)
+        if field != 'producer':
+            return set(self.postings.get((field, value), ()))
+        # Producers are indexed by word, a quoted name matches all words
+        found = None
+        for word in value.split():
+            docs = set(self.postings.get((field, word.strip(',.')), ()))
+            found = docs if found is None else found & docs
+        return found or set()
+
+    def prefix(self, text):
+        text = text.strip().strip('"').lower()
+        start = bisect_left(self.names, (text, ''))
+        found = set()
+        for name, doc_id in self.names[start:]:
+            if not name.startswith(text):
+                break
+            found.add(doc_id)
+        return found
+
+    def review(self, op, value):
+        if op in ('<', '>='):
+            pos = bisect_left(self.dates, (value, ''))
+        else:
+            # Dates starting with the value count as equal ('2017' matches
+            # all of 2017)
+            pos = bisect_right(self.dates, (value + '\uffff', ''))
+        if op in ('<', '<='):
+            return {doc_id for _, doc_id in self.dates[:pos]}
+        if op in ('>', '>='):
+            return {doc_id for _, doc_id in self.dates[pos:]}
+        return {doc_id for date, doc_id in self.dates
+                if date.startswith(value)}
+
+    def query(self, expression):
+        """
+        Evaluates a boolean query and returns the sorted document IDs.
+
+        Terms are ``field:value`` (fields: cas, eg, h, p, euh, ghs, wgk,
+        lgk, producer), ``name:prefix`` and ``review<2018-01-01`` (also
+        ``<=``, ``>``, ``>=``, ``=``). They can be combined with AND, OR,
+        NOT and parentheses, AND is implied between terms.
+        """
+        with self._lock:
+            return sorted(_QueryParser(self, expression).parse())
+
+    def summary(self, doc_id):
+        return dict(self.docs[doc_id]['summary'], id=doc_id)
+
+
+class _QueryParser:
+
+    def __init__(self, index, expression):
+        self.index = index
+        self.tokens = self._tokenize(expression)
+        self.pos = 0
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        pos = 0
+        expression = expression.strip()
+        while pos < len(expression):
+            m = TOKEN_re.match(expression, pos)
+            if m is None or m.end() == pos:
+                raise QueryError('Can not parse: {}'.format(expression[pos:]))
+            pos = m.end()
+            if m.group(1) or m.group(2):
+                tokens.append((m.group(1) or m.group(2),))
+            elif m.group(3):
+                tokens.append(('review', m.group(4), m.group(5)))
+            else:
+                tokens.append(('word', m.group(6)))
+        return tokens
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _is_op(self, token, op):
+        return (token is not None and token[0] == 'word' and
+                token[1].upper() == op)
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError('Empty query')
+        result = self._or()
+        if self._peek() is not None:
+            raise QueryError('Unexpected token: {}'.format(self._peek()[-1]))
+        return result
+
+    def _or(self):
+        result = self._and()
+        while self._is_op(self._peek(), 'OR'):
+            self.pos += 1
+            result = result | self._and()
+        return result
+
+    def _and(self):
+        result = self._not()
+        while True:
+            token = self._peek()
+            if token is None or token[0] == ')' or self._is_op(token, 'OR'):
+                return result
+            if self._is_op(token, 'AND'):
+                self.pos += 1
+            result = result & self._not()
+
+    def _not(self):
+        if self._is_op(self._peek(), 'NOT'):
+            self.pos += 1
+            return set(self.index.docs) - self._not()
+        return self._atom()
+
+    def _atom(self):
+        token = self._peek()
+        if token is None:
+            raise QueryError('Unexpected end of query')
+        self.pos += 1
+        if token[0] == '(':
+            result = self._or()
+            if self._peek() != (')',):
+                raise QueryError('Missing )')
+            self.pos += 1
+            return result
+        if token[0] == 'review':
+            return self.index.review(token[1], token[2])
+        if token[0] == 'word' and ':' in token[1]:
+            field, value = token[1].split(':', 1)
+            field = field.lower()
+            if field == 'name':
+                return self.index.prefix(value)
+            return self.index.term(field, value)
+        raise QueryError('Invalid term: {}'.format(token[-1]))
+
+
+def build(source, filename):
+    """Builds a new index file from an all.json file or result directory."""
+    from columnar import iter_json_records
+    index = SDBIndex(filename)
+    for data in iter_json_records(source):
+        index.add(data)
+    index.save()
+    return index
+
+
+def _parse_commandline():
+    p = ArgumentParser(description='Build and query the index over parsed '
+                       'SDB data.')
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    b = sub.add_parser('build', help='Build the index from scratch')
+    b.add_argument('source', help='all.json or result directory')
+    b.add_argument('--index', '-i', default=INDEX_FILE,
+                   help='Index file to write (default: %(default)s)')
+    q = sub.add_parser('query', help='Query the index')
+    q.add_argument('expression', nargs='+', help='e.g. h:H350 wgk:3 '
+                   'review<2018')
+    q.add_argument('--index', '-i', default=INDEX_FILE,
+                   help='Index file to read (default: %(default)s)')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_commandline()
+    if args.command == 'build':
+        index = build(args.source, args.index)
+        print('Indexed {} documents'.format(len(index)))
+    else:
+        index = SDBIndex.load(args.index)
+        for doc_id in index.query(' '.join(args.expression)):
+            s = index.summary(doc_id)
+            print('{id}\t{cas}\t{name}\t{producer}'.format(**s))
@@ -3,19 +3,33 @@
 
 import glob
 import json
+import logging
 import os
 import re
 import shutil
+import threading
 import time
 
 from argparse import ArgumentParser
+from collections import Counter
 from datetime import date
-from subprocess import check_call, check_output
-from tempfile import TemporaryDirectory
+from functools import partial
 
 import pubchempy as pcp
 import requests
 
+import extractors
+import fingerprint
+import jsonlog
+import memprofile
+import pipeline
+import ratelimit
+import resultstore
+import sdbindex
+import spool
+import stages
+import tools
+import translate
 import uba
 import utils
 import p_acros
@@ -25,19 +39,16 @@ import p_merck
 import p_sigma
 
 
-if os.name == 'nt':
-    GS_BIN = r'C:\Users\wet\Downloads\Ghostscript\bin\gswin64c.exe'
-    TESS_BIN = r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe'
-else:
-    GS_BIN = 'gsc'
-    TESS_BIN = 'tesseract'
-
+logger = logging.getLogger(__name__)
 _PATH = os.path.dirname(os.path.abspath(__file__))
 STORE_PATH = os.path.join(_PATH, 'sdb_json')
 PC_URL = 'https://pubchem.ncbi.nlm.nih.gov/'
 PC_SEARCH = 'https://www.ncbi.nlm.nih.gov/pccompound'
 PC_IMG = '{}image/imagefly.cgi'.format(PC_URL)
-TRANSLATE_URL = 'http://translate.google.com/translate_a/t'
+PC_XREF = '{}rest/pug/compound/xref/RN/{{}}/cids/JSON'.format(PC_URL)
+RESOLVE_STATS_FILE = 'resolve_stats.json'
+# Serializes the updates of the shared files in outdir (index, caches)
+LOCK_FILE = 'outdir.lock'
 PARSERS = {
     'acros': p_acros,
     'caelo': p_caelo,
@@ -46,13 +57,6 @@ PARSERS = {
     'sigma': p_sigma,
 }
 
-TRANS = {
-    'natriumhydrogencarbonat': 'sodium bicarbonate',
-    'isopropylphenazon plv.': 'propyphenazone',
-    'kresolrot': 'cresol red',
-    'm-kresolpurpur': 'm-cresol purple',
-}
-
 GHS_SYM = {
     ('H200', 'H201', 'H202', 'H203', 'H204', 'H240'): set(['GHS01']),
     ('H241',): set(['GHS01', 'GHS02']),
@@ -79,48 +83,53 @@ MANUFACTURER_res = (
     re.compile(r'Carl\s+?(Roth)\s+?GmbH', re.I),
 )
 PC_COMPOUND_re = re.compile(r'.+?/compound/(\d+)/?'.format(PC_URL), re.I)
+# Section 16 (Sonstige Angaben) is not used by any parser, a parser module
+# can define its own STOP_re.
+STOP_re = re.compile(r'^\s*(?:abschnitt\s*)?16[.:]?\s+sonstige', re.I | re.M)
+# Text searched for the manufacturer before the default STOP_re is used
+MAX_HEAD_CHARS = 20000
+
+
+class _SectionStop:
+    """
+    Tells the extractor to stop after the page with the heading of the
+    first section the vendor parser does not need.
+    """
+
+    def __init__(self):
+        self.head = ''
+        self.stop_re = None
+
+    def __call__(self, page):
+        if self.stop_re is None:
+            self.head += page
+            try:
+                mod = get_parse_module(get_manufacturer(self.head))
+            except ValueError:
+                if len(self.head) < MAX_HEAD_CHARS:
+                    return STOP_re.search(page) is not None
+                mod = None
+            self.stop_re = getattr(mod, 'STOP_re', STOP_re)
+            self.head = ''
+        return self.stop_re.search(page) is not None
 
 
-def _run_tesseract(pdf_file):
-    with TemporaryDirectory() as tmp:
-        outname = os.path.join(tmp, 'scan_%03d.tif')
-        cmd = [GS_BIN, '-dNOPAUSE', '-r300', '-sDEVICE=tiffscaled24',
-               '-sCompression=lzw', '-dBATCH',
-               '-sOutputFile={}'.format(outname), pdf_file]
-        check_call(cmd)
-        scans = glob.glob(os.path.join(tmp, 'scan_*.tif'))
-        for scan in scans:
-            outname = os.path.splitext(scan)[0]
-            cmd = [TESS_BIN, scan, outname, '-l', 'deu']
-            check_call(cmd)
-        text_files = glob.glob(os.path.join(tmp, 'scan_*.txt'))
-        text_files.sort()
-        out = []
-        for tf in text_files:
-            with open(tf, encoding='utf-8') as fp:
-                out.append(fp.read())
-    return '\n'.join(out)
-
-
-def generate_text(pdf_file):
+def generate_text(pdf_file, extractor=None, cached=True):
     txt_file = '{}.txt'.format(pdf_file)
-    if os.path.isfile(txt_file):
+    if cached and os.path.isfile(txt_file):
         with open(txt_file, encoding='utf-8') as fp:
             return fp.read()
-    cmd = ['pdftotext', '-raw', '-nopgbrk', '-enc', 'UTF-8', pdf_file, '-']
+    extractor = extractor or extractors.SubprocessExtractor()
     try:
-        out = check_output(cmd)
-        out = out.decode('utf-8', errors='replace')
+        out = extractor.extract(pdf_file, _SectionStop())
         out = out.replace('\r', '\n').replace('\n\n', '\n')
     except Exception as err:
-        print('pdftotext can not handle:', pdf_file)
-        print('Error:', err)
-        print('Trying tesseract...')
+        logger.warning('%s can not handle %s (%s), trying tesseract',
+                       extractor.name, pdf_file, err)
         try:
-            out = _run_tesseract(pdf_file)
+            out = extractor.ocr_document(pdf_file, _SectionStop())
         except Exception as err:
-            print('tesseract can not handle:', pdf_file)
-            print('Error:', err)
+            logger.error('tesseract can not handle %s (%s)', pdf_file, err)
             return ''
     with open(txt_file, 'w', encoding='utf-8') as fp:
         fp.write(out)
@@ -148,82 +157,179 @@ def get_parse_module(manufacturer):
 
 
 def _get_filename(f, outdir, ext='json'):
-    _fn = os.path.split(f)[1]
-    fn = os.path.splitext(_fn)[0]
-    if fn.startswith('SDB'):
-        fn = fn[3:].strip()
-    store = os.path.join(outdir, fn[0].lower())
-    if not os.path.isdir(store):
-        os.makedirs(store)
-    return os.path.join(store, '{} SDB.{}'.format(fn, ext))
+    return resultstore.layout_path(outdir, utils.get_doc_id(f), ext)
+
+
+# Keeps the connections open between requests
+SESSION = requests.Session()
+
+
+def _pubchem(func, *args, **kw):
+    """Calls PubChem (or NCBI) through the rate limiter shared by all
+    processes."""
+    return ratelimit.get_limiter().call(func, *args, **kw)
 
 
 def _get_structure(cid):
     data = dict(cid=cid, width='300', height='300')
-    r = requests.get(PC_IMG, params=data)
+    r = _pubchem(SESSION.get, PC_IMG, params=data)
     if r.status_code == 200:
         return r.content
     return ''
 
 
-def _translate(text, trans):
-    t = text.lower().strip()
-    if t in TRANS:
-        return TRANS[t]
-    if t in trans:
-        text = trans[t]
-    params = dict(client='z', sl='de', tl='en', ie='UTF-8', oe='UTF-8',
-                  text=text)
-    r = requests.get(TRANSLATE_URL, params=params)
+def _translate(text, translator):
+    """
+    Offline translation, unknown names are collected by the translator for
+    the batched lookup at the end of the run.
+    """
+    if translator is None:
+        return ''
+    return translator.translate(text) or ''
+
+
+def _compound_from_cid(cid):
+    if cid is None:
+        return None
+    return _pubchem(pcp.Compound.from_cid, int(cid))
+
+
+def _search_cid(term):
+    """CID from the redirect of the NCBI search to the compound page."""
+    r = _pubchem(SESSION.get, PC_SEARCH, params={'term': term})
+    m = PC_COMPOUND_re.search(r.url)
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def _resolve_cas_xref(cas, search_name):
+    if not cas or utils.validate_cas(cas) != cas:
+        return None
+    r = _pubchem(SESSION.get, PC_XREF.format(cas))
     if r.status_code != 200:
-        return text
-    data = r.json()
-    return data
+        return None
+    cids = r.json().get('IdentifierList', {}).get('CID', [])
+    return _compound_from_cid(cids[0] if cids else None)
 
 
-def request_pubchem(cas, name, en_name, trans):
-    if en_name:
-        en_name = _translate(en_name, trans)
-    else:
-        en_name = _translate(name.capitalize(), trans)
+def _resolve_cas_search(cas, search_name):
+    if not cas:
+        return None
+    return _compound_from_cid(_search_cid('CAS-{}'.format(cas)))
+
+
+def _resolve_name_search(cas, search_name):
+    return _compound_from_cid(_search_cid(search_name()))
+
+
+def _resolve_name(cas, search_name):
+    compounds = _pubchem(pcp.get_compounds, search_name(), 'name')
+    return compounds[0] if compounds else None
+
+
+def _resolve_substance(cas, search_name):
+    substances = _pubchem(pcp.get_substances, search_name(), 'name')
+    if not substances or not substances[0].cids:
+        return None
+    return _compound_from_cid(substances[0].cids[0])
+
+
+# Cheapest and most reliable first, the name based lookups need the
+# translation. Tune the order with the hit rates in RESOLVE_STATS_FILE.
+RESOLVERS = (
+    ('cas_xref', _resolve_cas_xref),
+    ('cas_search', _resolve_cas_search),
+    ('name_search', _resolve_name_search),
+    ('name', _resolve_name),
+    ('substance', _resolve_substance),
+)
+RESOLVE_STATS = Counter()
+_RESOLVE_LOCK = threading.Lock()
+
+
+def _count_resolve(key, event):
+    with _RESOLVE_LOCK:
+        RESOLVE_STATS[(key, event)] += 1
+
+
+def request_pubchem(cas, name, en_name, translator=None):
+    """
+    Looks up the compound with the strategies in ``RESOLVERS`` until one
+    succeeds. The name is only translated (with possibly a deferred online
+    lookup) when a name based strategy is needed.
+
+    :returns: The compound data, the structure PNG, the English name and
+              the strategy which found the compound (or '').
+    :rtype: tuple
+    """
     cas = cas.strip()
-    print(name, '-->', en_name, '(en), CAS: {}'.format(cas))
-    if cas:
-        r = requests.get(PC_SEARCH, params={'term': 'CAS-{}'.format(cas)})
-    else:
-        r = requests.get(PC_SEARCH, params={'term': en_name})
-    m = PC_COMPOUND_re.search(r.url)
+    translated = []
+
+    def search_name():
+        if not translated:
+            translated.append(en_name or _translate(name, translator))
+            logger.info('Translated %s --> %s', name, translated[0])
+        # Without a translation the German name is the best guess
+        return translated[0] or name.capitalize()
+
     data = {}
     structure = ''
-    if m is not None:
-        cid = m.group(1)
-        compound = pcp.Compound.from_cid(int(cid))
-        data = compound.to_dict()
-        structure = _get_structure(cid)
-    else:
-        # Try the same with the translated name
-        r = requests.get(PC_SEARCH, params={'term': en_name})
-        m = PC_COMPOUND_re.search(r.url)
-        if m is not None:
-            cid = m.group(1)
-            compound = pcp.Compound.from_cid(int(cid))
+    strategy = ''
+    for key, resolve in RESOLVERS:
+        _count_resolve(key, 'tried')
+        compound = resolve(cas, search_name)
+        if compound is not None:
+            _count_resolve(key, 'hit')
             data = compound.to_dict()
-            structure = _get_structure(cid)
-        else:
-            try:
-                compound = pcp.get_compounds(en_name, 'name')[0]
-                data = compound.to_dict()
-                structure = _get_structure(str(compound.cid))
-            except IndexError:
-                # Try to find as substance
-                try:
-                    substance = pcp.get_substances(en_name, 'name')[0]
-                    compound = pcp.Compound.from_cid(substance.cids[0])
-                    data = compound.to_dict()
-                    structure = _get_structure(str(compound.cid))
-                except IndexError:
-                    pass
-    return data, structure, en_name
+            structure = _get_structure(str(compound.cid))
+            strategy = key
+            break
+    logger.info('PubChem: %s', strategy or 'not found',
+                extra=dict(cas=cas, strategy=strategy))
+    if translated:
+        en_name = translated[0]
+        if data and en_name and translator is not None:
+            # Found by the English name, so the translation is good
+            translator.confirm(name, en_name)
+    elif not en_name and translator is not None:
+        # Found by CAS, use an offline translation only
+        en_name = translator.lookup(name) or ''
+    return data, structure, en_name, strategy
+
+
+def resolve_stats(outdir=None):
+    """
+    Returns tried and hit counts with hit rate by strategy. With ``outdir``
+    the counts so far are added to the stored ones (and reset), the totals
+    are returned.
+    """
+    stats = {}
+    with _RESOLVE_LOCK:
+        counts = dict(RESOLVE_STATS)
+        if outdir is not None:
+            RESOLVE_STATS.clear()
+    for (key, event), num in counts.items():
+        stats.setdefault(key, dict(tried=0, hit=0))[event] = num
+    if outdir is not None:
+        filename = os.path.join(outdir, RESOLVE_STATS_FILE)
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as fp:
+                for key, old in json.load(fp).items():
+                    new = stats.setdefault(key, dict(tried=0, hit=0))
+                    new['tried'] += old.get('tried', 0)
+                    new['hit'] += old.get('hit', 0)
+        with open(filename, 'w', encoding='utf-8') as fp:
+            json.dump({k: dict(tried=v['tried'], hit=v['hit'])
+                       for k, v in stats.items()}, fp, indent=2,
+                      sort_keys=True)
+    for value in stats.values():
+        value['rate'] = value['hit'] / value['tried'] if value['tried'] else 0
+    return stats
+
+
+PUBCHEM_FIELDS = ('molmass', 'formula', 'smiles', 'pc_cid', 'inchi',
+                  'inchikey', 'iupac_en', 'iupac_de')
 
 
 def _combine_with_pubchem(data, pubchem):
@@ -270,67 +376,137 @@ def _check_uba(data, uba_data):
     ca = uba_data['cas_all']
     if data['cas']:
         if data['cas'] in ca:
-            print('UBA:', data['cas'], 'found.')
+            logger.info('UBA: %s found', data['cas'])
             data = _update_from_uba(data, ca[data['cas']])
     else:
         if name in nc:
             cas = nc[name]
-            print('UBA:', name, 'found -->', cas)
+            logger.info('UBA: %s found --> %s', name, cas)
             data = _update_from_uba(data, ca[cas])
         elif name in nec:
             cas = nec[name]
-            print('UBA:', name, 'found -->', cas)
+            logger.info('UBA: %s found --> %s', name, cas)
             data = _update_from_uba(data, ca[cas])
     return data
 
 
-def run(filename, outdir, force=False, uba_data=None):
-    uba_data = uba_data or {}
-    new_filename = _get_filename(filename, outdir)
-    if os.path.isfile(new_filename):
-        if not force:
-            return
-        else:
-            os.remove(new_filename)
-    txt = generate_text(filename)
+def _previous_revision(data, store, fingerprints, sig, doc_id):
+    """
+    Returns the ID and result of a near duplicate (e.g. an earlier revision)
+    of the same substance, or (None, None).
+    """
+    if fingerprints is None:
+        return None, None
+    prev_id, sim = fingerprints.similar(sig, data['producer'],
+                                        exclude=doc_id)
+    if prev_id is None:
+        return None, None
+    prev = store.get(prev_id)
+    if prev is None or prev.get('cas', '') != data['cas']:
+        return None, None
+    if not data['cas'] and prev.get('name', '') != data['name']:
+        return None, None
+    logger.info('Near duplicate of %s (%.0f%%), reusing the PubChem data',
+                prev_id, sim * 100)
+    return prev_id, prev
+
+
+def _stage_extract(source, ctx):
+    text = generate_text(ctx['filename'], ctx['extractor'],
+                         ctx['text_cache'])
+    if not text:
+        # Not stored, so the extraction is tried again next time
+        logger.warning('No text: %s', ctx['filename'])
+        return None
+    return dict(text=text)
+
+
+def _log_vendor(ctx, mod):
+    """Adds the parser (e.g. ``roth``) to the log fields of the document."""
+    ctx['log']['vendor'] = mod.__name__.split('_', 1)[-1]
+
+
+def _stage_parse(extracted, ctx):
+    txt = extracted['text']
     man = get_manufacturer(txt)
     try:
         mod = get_parse_module(man)
     except ValueError as err:
-        print(err, filename)
-        return
+        logger.warning('%s: %s', err, ctx['filename'])
+        return None
     data = mod.parse(txt)
     data['producer'] = man
-    data['source'] = filename
+    _log_vendor(ctx, mod)
+    data['source'] = ctx['filename']
+    if isinstance(data['review_date'], date):
+        data['review_date'] = data['review_date'].strftime('%Y-%m-%d')
+    else:
+        data['review_date'] = str(data['review_date'])
     data = _check_symbols(data)
-    data = _check_uba(data, uba_data)
-    print(ascii(data))
+    return dict(data=data, sig=fingerprint.minhash(txt))
+
+
+def _stage_uba(parsed, ctx):
+    data = _check_uba(parsed['data'], ctx['uba_data'])
+    jsonlog.log_payload(logger, 'Record', data)
     if not data['name']:
         data['name'] = data['art_name'].split()[0].capitalize()
-    try:
-        pubchem, structure, en = request_pubchem(data['cas'], data['name'],
-                                                 data['name_en'],
-                                                 uba_data['name_de_en'])
-    except:
-        pubchem = {}
-        structure = ''
-        en = ''
+    return dict(data=data, sig=parsed['sig'])
+
+
+def _stage_enrich(checked, ctx):
+    data = checked['data']
+    store = ctx['store']
+    prev_id, prev = None, None
+    if 'enrich' not in ctx['forced']:
+        # A forced run refreshes the PubChem data of every document
+        prev_id, prev = _previous_revision(data, store, ctx['fingerprints'],
+                                           checked['sig'], ctx['doc_id'])
+    if prev is not None:
+        structure = store.get_structure(prev_id) if prev['structure'] else ''
+        en = prev.get('name_en', '')
+        strategy = prev.get('pc_strategy', '')
+        for key in PUBCHEM_FIELDS:
+            data[key] = prev.get(key)
+        data['revision_of'] = prev_id
+    else:
+        try:
+            pubchem, structure, en, strategy = request_pubchem(
+                data['cas'], data['name'], data['name_en'],
+                ctx['translator'])
+        except Exception:
+            # Only this document goes without PubChem data
+            logger.exception('PubChem request failed')
+            pubchem = {}
+            structure = ''
+            en = ''
+            strategy = ''
+        data = _combine_with_pubchem(data, pubchem)
     if not data['name_en']:
         data['name_en'] = en
-    if isinstance(data['review_date'], date):
-        data['review_date'] = data['review_date'].strftime('%Y-%m-%d')
-    else:
-        data['review_date'] = str(data['review_date'])
+    data['pc_strategy'] = strategy
+    if structure:
+        ctx['artifacts'].save_blob('enrich', ctx['doc_id'], structure)
+    # Not found with the German name, which waits for a batch translation:
+    # the miss is not cached, main retries after resolve_pending
+    pending = (not strategy and not data['name_en'] and
+               ctx['translator'] is not None and
+               ctx['translator'].lookup(data['name']) is None)
+    return dict(data=data, sig=checked['sig'], structure=bool(structure),
+                pending=pending)
+
+
+def _stage_finalize(enriched, ctx):
+    data = enriched['data']
+    doc_id = ctx['doc_id']
+    store = ctx['store']
+    structure = None
+    if enriched['structure']:
+        structure = ctx['artifacts'].load_blob('enrich', doc_id)
     if structure:
-        st_name = _get_filename(filename, outdir, 'png')
-        if not os.path.isfile(st_name):
-            with open(st_name, 'wb') as fp:
-                fp.write(structure)
-        data['structure'] = st_name
+        data['structure'] = store.structure_path(doc_id)
     else:
         data['structure'] = ''
-    # Combine with pubchem entry
-    data = _combine_with_pubchem(data, pubchem)
     data['h'].sort()
     data['p'].sort()
     data['euh'].sort()
@@ -339,37 +515,353 @@ def run(filename, outdir, force=False, uba_data=None):
         if len(s) > 3:
             synonyms.add(s.strip())
     data['synonyms'] = list(synonyms)
-    with open(new_filename, 'w', encoding='utf-8') as fp:
-        json.dump(data, fp, indent=2, sort_keys=True)
+    store.put(doc_id, data, structure)
+    if ctx['fingerprints'] is not None:
+        ctx['fingerprints'].add(doc_id, data['producer'], enriched['sig'])
     return data
 
 
-def _get_sdb_files(sdb_directories):
+STAGE_FUNCS = (
+    ('extract', _stage_extract),
+    ('parse', _stage_parse),
+    ('uba', _stage_uba),
+    ('enrich', _stage_enrich),
+    ('finalize', _stage_finalize),
+)
+
+
+def start(filename, outdir, force=False, uba_data=None, store=None,
+          extractor=None, translator=None, fingerprints=None,
+          from_stage=None, only=None, artifacts=None):
+    """
+    Returns the context (state) for running the stages on one SDB, or None
+    if the document is already in the store and nothing is forced.
+    """
+    store = store or resultstore.DirectoryStore(outdir)
+    doc_id = utils.get_doc_id(filename)
+    if (store.exists(doc_id) and not force and from_stage is None and
+            only is None):
+        return None
+    # Only an explicit extract stage bypasses the text cache ({pdf}.txt)
+    text_cache = 'extract' not in (from_stage, only)
+    if force:
+        from_stage = stages.STAGES[0]
+    return dict(filename=filename, doc_id=doc_id, uba_data=uba_data or {},
+                store=store, extractor=extractor, translator=translator,
+                fingerprints=fingerprints,
+                artifacts=artifacts or stages.ArtifactStore(outdir, store),
+                forced=stages.forced_stages(from_stage, only),
+                text_cache=text_cache,
+                result=None, inputs=stages.source_digest(filename),
+                log=dict(trace_id=jsonlog.new_trace_id(), doc=doc_id))
+
+
+def _run_stage(ctx, name, func):
+    """Runs one stage or loads its artifact, returns whether it was cached."""
+    if name == 'finalize':
+        ctx['result'] = func(ctx['result'], ctx)
+        return False
+    if name not in ctx['forced']:
+        cached, digest = ctx['artifacts'].load(name, ctx['doc_id'],
+                                               ctx['inputs'])
+        if cached is not None:
+            ctx['result'], ctx['inputs'] = cached, digest
+            if name == 'parse':
+                _log_vendor(ctx, get_parse_module(cached['data']['producer']))
+            return True
+    ctx['result'] = func(ctx['result'], ctx)
+    if ctx['result'] is not None and not ctx['result'].get('pending'):
+        ctx['inputs'] = ctx['artifacts'].save(name, ctx['doc_id'],
+                                              ctx['inputs'], ctx['result'])
+    return False
+
+
+def run_stages(ctx, names=stages.STAGES):
+    """
+    Runs the given stages on a context from ``start``. Returns the context,
+    or None if a stage dropped the document. After finalize the stored data
+    is ``ctx['result']``. Everything logged carries the trace ID of the
+    document, every stage logs its duration (and is profiled, see
+    ``memprofile``).
+    """
+    funcs = dict(STAGE_FUNCS)
+    for name in names:
+        with jsonlog.context(stage=name, **ctx['log']):
+            with jsonlog.timed(logger, 'Stage finished') as fields, \
+                    memprofile.stage(name, ctx['doc_id']):
+                fields['cached'] = _run_stage(ctx, name, funcs[name])
+                fields['dropped'] = ctx['result'] is None
+                fields.update(ctx['log'])
+        if ctx['result'] is None:
+            return None
+    return ctx
+
+
+def run(filename, outdir, force=False, uba_data=None, store=None,
+        extractor=None, translator=None, fingerprints=None, from_stage=None,
+        only=None, artifacts=None):
+    """
+    Runs the stages in ``STAGE_FUNCS`` for one SDB. Every stage reuses its
+    artifact from an earlier run unless the artifact is stale (other stage
+    version or input) or the stage is forced by ``force`` (all stages),
+    ``from_stage`` (the stage and all following) or ``only``. The result
+    is written by the finalize stage, which always runs.
+    """
+    ctx = start(filename, outdir, force, uba_data, store, extractor,
+                translator, fingerprints, from_stage, only, artifacts)
+    if ctx is None:
+        return None
+    ctx = run_stages(ctx)
+    if ctx is None:
+        return None
+    return ctx['result']
+
+
+def _get_sdb_files(sdb_directories, recursive=False):
     filenames = []
     for d in sdb_directories:
         sdb_path = os.path.abspath(d)
-        for f in glob.glob(os.path.join(sdb_path, '*.pdf')):
+        if recursive:
+            pattern = os.path.join(sdb_path, '**', '*.pdf')
+        else:
+            pattern = os.path.join(sdb_path, '*.pdf')
+        for f in glob.glob(pattern, recursive=recursive):
             filenames.append(f)
     return filenames
 
 
-def main(sdb_files, outdir=STORE_PATH, force=False):
+def _start_all(sdb_files, finish, *args):
+    """
+    Yields the contexts of the files to process, the others are finished
+    right away (see ``start`` for the arguments).
+    """
+    for f in sdb_files:
+        ctx = start(f, *args)
+        if ctx is not None:
+            yield ctx
+        elif finish is not None:
+            finish(f)
+
+
+def _finishing(func, finish, last):
+    """Calls ``finish(filename)`` once a document leaves the pipeline."""
+    def _run(ctx):
+        out = None
+        try:
+            out = func(ctx)
+        finally:
+            if out is None or last:
+                finish(ctx['filename'])
+        return out
+    return _run
+
+
+def _run_pipelined(contexts, workers, finish=None):
+    steps = []
+    for num, (name, names) in enumerate(pipeline.POOLS):
+        func = partial(run_stages, names=names)
+        if finish is not None:
+            func = _finishing(func, finish, num == len(pipeline.POOLS) - 1)
+        steps.append(pipeline.Step(name, func, workers[name]))
+    executor = pipeline.PipelineExecutor(steps)
+    results = executor.run(contexts)
+    logger.info('Pipeline:\n%s', executor.report())
+    all_data = [ctx['result'] for ctx in results if ctx['result']]
+    all_data.sort(key=lambda data: data['source'])
+    return all_data
+
+
+def _spool_files(sdb_files, spool_dir):
+    """
+    Adds the files to the spool and returns the spool with a generator of
+    the files claimed by this node, tasks by file name are collected in
+    the given dict.
+    """
+    work = spool.Spool(spool_dir)
+    for f in sdb_files:
+        work.add(utils.get_doc_id(f), dict(filename=f))
+
+    def claimed(tasks):
+        for task in work.tasks():
+            tasks[task.payload['filename']] = task
+            yield task.payload['filename']
+    return work, claimed
+
+
+def _finish_task(work, tasks, store, filename):
+    """
+    The spool task of a processed file is done with a stored result,
+    failed otherwise.
+    """
+    task = tasks.pop(filename, None)
+    if task is None:
+        return
+    if store.exists(utils.get_doc_id(filename)):
+        work.done(task)
+    else:
+        work.fail(task, 'no result')
+
+
+def _finish_tasks(work, tasks, store):
+    """Finishes the tasks left, e.g. after an error."""
+    for f in list(tasks):
+        _finish_task(work, tasks, store, f)
+    work.close()
+
+
+def _write_all(outdir, all_data, merge=False):
+    """
+    Writes all.json, with ``merge`` the results of other nodes already in
+    the file are kept.
+    """
+    filename = os.path.join(outdir, 'all.json')
+    if merge and os.path.isfile(filename):
+        with open(filename, encoding='utf-8') as fp:
+            merged = {data['source']: data for data in json.load(fp)}
+        merged.update((data['source'], data) for data in all_data)
+        all_data = sorted(merged.values(), key=lambda data: data['source'])
+    tmp_name = '{}.tmp'.format(filename)
+    with open(tmp_name, 'w', encoding='utf-8') as fp:
+        json.dump(all_data, fp, indent=2, sort_keys=True)
+    os.replace(tmp_name, filename)
+
+
+def _write_structures(all_data, store):
+    """
+    Makes sure the structure files in the results exist, the SQLite store
+    writes them from the database on demand.
+    """
+    for data in all_data:
+        if data['structure']:
+            store.structure_file(utils.get_doc_id(data['source']))
+
+
+def _add_translations(all_data, translator, store, rerun=None):
+    """
+    Translates all names unknown to the offline translator with one request
+    and updates the affected results. Documents not found in PubChem are
+    enriched again with ``rerun`` (called with the file name, returns the
+    new result), as their lookup could only use the German name.
+    """
+    if not translator.pending:
+        return
+    logger.info('Translating %d unknown names', len(translator.pending))
+    translator.resolve_pending()
+    for i, data in enumerate(all_data):
+        if data['name_en']:
+            continue
+        en = translator.lookup(data['name'])
+        if not en:
+            continue
+        if not data['pc_strategy'] and rerun is not None:
+            logger.info('Retrying PubChem with %s', en,
+                        extra=dict(doc=utils.get_doc_id(data['source'])))
+            all_data[i] = rerun(data['source']) or data
+            continue
+        data['name_en'] = en
+        store.put(utils.get_doc_id(data['source']), data)
+
+
+def main(sdb_files, outdir=STORE_PATH, force=False, store='dir',
+         ocr_mode='fixed', extractor='subprocess',
+         max_text=extractors.MAX_TEXT_CHARS, from_stage=None, only=None,
+         workers=None, spool_dir=None, memory_report=True, cache_dir=None):
+    """
+    Processes the SDBs one after the other, or with ``workers`` (pool sizes,
+    see ``pipeline.parse_workers``) in a pipeline of thread pools. With
+    ``spool_dir`` the SDBs are shared with the other nodes using the same
+    spool directory and output directory (see ``spool.Spool``). With
+    ``memory_report`` the memory profile (if enabled) is written and
+    logged at the end. The translations, fingerprints and PubChem strategy
+    counts are kept in ``cache_dir`` (default ``outdir``), e.g. across the
+    jobs of the worker service.
+    """
+    cache_dir = cache_dir or outdir
     all_data = []
     uba_data = uba.main(outdir)
+    work = None
+    tasks = {}
+    if spool_dir is not None:
+        work, claimed = _spool_files(sdb_files, spool_dir)
+        sdb_files = claimed(tasks)
+    result_store = resultstore.open_store(store, outdir,
+                                          shared=work is not None)
+    finish = None
+    if work is not None:
+        finish = partial(_finish_task, work, tasks, result_store)
+    text_extractor = extractors.get_extractor(extractor, ocr_mode, max_text)
+    translator = translate.OfflineTranslator.from_uba(
+        uba_data, os.path.join(cache_dir, translate.CACHE_FILE))
+    fingerprints = fingerprint.FingerprintIndex.load(
+        os.path.join(cache_dir, fingerprint.FINGERPRINT_FILE))
+    artifacts = stages.ArtifactStore(outdir, result_store)
     path = os.path.dirname(os.path.abspath(__file__))
-    for f in sdb_files:
-        parsed_data = run(f, outdir, force, uba_data)
-        if parsed_data:
-            all_data.append(parsed_data)
-    with open(os.path.join(outdir, 'all.json'), 'w', encoding='utf-8') as fp:
-        json.dump(all_data, fp, indent=2, sort_keys=True)
+    try:
+        if workers is None:
+            for f in sdb_files:
+                try:
+                    parsed_data = run(f, outdir, force, uba_data,
+                                      result_store, text_extractor,
+                                      translator, fingerprints, from_stage,
+                                      only, artifacts)
+                finally:
+                    if finish is not None:
+                        finish(f)
+                if parsed_data:
+                    all_data.append(parsed_data)
+        else:
+            contexts = _start_all(sdb_files, finish, outdir, force, uba_data,
+                                  result_store, text_extractor, translator,
+                                  fingerprints, from_stage, only, artifacts)
+            all_data = _run_pipelined(contexts, workers, finish)
+        _add_translations(all_data, translator, result_store, partial(
+            run, outdir=outdir, uba_data=uba_data, store=result_store,
+            extractor=text_extractor, translator=translator,
+            fingerprints=fingerprints, from_stage='enrich',
+            artifacts=artifacts))
+        _write_structures(all_data, result_store)
+    finally:
+        if work is not None:
+            _finish_tasks(work, tasks, result_store)
+        text_extractor.close()
+        result_store.close()
+    with spool.file_lock(os.path.join(cache_dir, LOCK_FILE)):
+        translator.save()
+        fingerprints.save()
+        resolved = resolve_stats(cache_dir)
+    with spool.file_lock(os.path.join(outdir, LOCK_FILE)):
+        index = sdbindex.SDBIndex.load(os.path.join(outdir,
+                                                    sdbindex.INDEX_FILE))
+        for data in all_data:
+            index.add(data)
+        index.save()
+        _write_all(outdir, all_data, work is not None)
+    for tool, events in sorted(tools.stats().items()):
+        if events.get('timeout') or events.get('error'):
+            logger.warning('%s: %d timeouts, %d errors', tool,
+                           events.get('timeout', 0), events.get('error', 0),
+                           extra=dict(tool=tool))
+    for key, value in sorted(resolved.items()):
+        logger.info('%s: %d of %d resolved (%.0f%%)', key, value['hit'],
+                    value['tried'], value['rate'] * 100,
+                    extra=dict(strategy=key))
+    rate_stats = ratelimit.get_limiter().stats()
+    if rate_stats:
+        logger.info('PubChem %s', ratelimit.format_stats(rate_stats))
+    profiler = memprofile.get_profiler()
+    if memory_report and profiler is not None and profiler.running:
+        report = profiler.report()
+        with open(os.path.join(outdir, memprofile.PROFILE_FILE), 'w',
+                  encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+        logger.info('Memory:\n%s', memprofile.format_report(report))
 
 
 def _parse_commandline():
     p = ArgumentParser(description='Extract and parse the text from a german '
                        'SDB (PDF format) and collect information on '
                        'the substance.')
-    p.add_argument('directories', nargs='+', help='Directories to search for '
+    p.add_argument('directories', nargs='*', help='Directories to search for '
                    "SDB's")
     p.add_argument('--force', '-f', action='store_true', default=False,
                    help='Force the extraction of already extracted content '
@@ -379,22 +871,87 @@ def _parse_commandline():
     p.add_argument('--uba-file', '-u', default=None, help='Use existing '
                    'uba.json file (give path here). Default is to download '
                    'new data.')
-    return p.parse_args()
-
-
-def batch_call(outdir, directories, force=False, uba_file=None):
+    p.add_argument('--store', '-s', default='dir', help='Result store: '
+                   '"dir" (one file per document), "sqlite" (results.db in '
+                   'outdir) or "sqlite:PATH" (default: %(default)s)')
+    p.add_argument('--ocr', default='fixed', choices=extractors.OCR_MODES,
+                   help='OCR mode for scanned SDBs, "adaptive" starts with '
+                   'low resolution greyscale pages (default: %(default)s)')
+    p.add_argument('--extractor', '-e', default='subprocess',
+                   choices=sorted(extractors.EXTRACTORS),
+                   help='Text extraction backend (default: %(default)s)')
+    p.add_argument('--limit', '-l', action='append', default=[],
+                   metavar='TOOL=SECONDS[:MB]', help='Wall clock and memory '
+                   'limit for pdftotext, gs or tesseract, 0 means no limit '
+                   '(can be given multiple times)')
+    p.add_argument('--max-text', type=int, default=extractors.MAX_TEXT_CHARS,
+                   help='Maximum text size per document in characters '
+                   '(default: %(default)s)')
+    p.add_argument('--recursive', '-r', action='store_true', default=False,
+                   help='Search the directories recursively (default: '
+                   '%(default)s), see ingest.py to watch them')
+    p.add_argument('--workers', '-w', default=None, metavar='POOL=N,...',
+                   help='Run the stages in a pipeline of thread pools '
+                   '(cpu: extract/parse/uba, io: PubChem, write: results), '
+                   'e.g. "cpu=4,io=16", "" for the defaults')
+    p.add_argument('--log-level', default=jsonlog.LEVEL,
+                   choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                   help='(default: %(default)s)')
+    p.add_argument('--log-format', default=jsonlog.FORMAT,
+                   choices=jsonlog.FORMATS, help='"json" writes one object '
+                   'per line (default: %(default)s)')
+    p.add_argument('--log-sample', type=float, default=jsonlog.PAYLOAD_SAMPLE,
+                   help='Share of documents whose full records are logged at '
+                   'DEBUG level (default: %(default)s)')
+    p.add_argument('--memprofile', action='store_true', default=False,
+                   help='Report the memory growth per stage and document '
+                   '(tracemalloc, slow) in the log and in {}'.format(
+                       memprofile.PROFILE_FILE))
+    p.add_argument('--spool', default=None, metavar='DIR', help='Share the '
+                   'work with other nodes through this directory on a shared '
+                   'file system (use the same outdir), every node adds its '
+                   'SDBs and runs until all are done')
+    stage = p.add_mutually_exclusive_group()
+    stage.add_argument('--from-stage', choices=stages.STAGES, default=None,
+                       help='Recompute this and all following stages for '
+                       'all documents, earlier stages are loaded from their '
+                       'artifacts')
+    stage.add_argument('--only', choices=stages.STAGES, default=None,
+                       help='Recompute only this stage for all documents, '
+                       'later stages follow if its output changed')
+    args = p.parse_args()
+    if not args.directories and args.spool is None:
+        p.error('directories are required without --spool')
+    return args
+
+
+def batch_call(outdir, directories, force=False, uba_file=None, store='dir',
+               ocr_mode='fixed', extractor='subprocess',
+               max_text=extractors.MAX_TEXT_CHARS, recursive=False,
+               from_stage=None, only=None, workers=None, spool_dir=None,
+               memory_report=True, cache_dir=None):
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
-    files = _get_sdb_files(directories)
+    files = _get_sdb_files(directories, recursive)
     if uba_file is not None and os.path.isfile(uba_file):
         shutil.copy2(uba_file, outdir)
-    main(files, outdir, force)
+    main(files, outdir, force, store, ocr_mode, extractor, max_text,
+         from_stage, only, workers, spool_dir, memory_report, cache_dir)
 
 
 if __name__ == '__main__':
-    start = time.time()
+    started = time.time()
     args = _parse_commandline()
-    batch_call(args.outdir, args.directories, args.force, args.uba_file)
+    jsonlog.configure(args.log_level, args.log_format, args.log_sample)
+    if args.memprofile:
+        memprofile.enable()
+    for limit in args.limit:
+        tools.parse_limit(limit)
+    batch_call(args.outdir, args.directories, args.force, args.uba_file,
+               args.store, args.ocr, args.extractor, args.max_text,
+               args.recursive, args.from_stage, args.only,
+               None if args.workers is None else
+               pipeline.parse_workers(args.workers), args.spool)
     end = time.time()
-    minutes, seconds = divmod(end - start, 60)
-    print('Duration: {}min {:.1f}s'.format(int(minutes), seconds))
+    minutes, seconds = divmod(end - started, 60)
+    logger.info('Duration: %dmin %.1fs', minutes, seconds)
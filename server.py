@@ -2,12 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import os
-import queue
 import cherrypy as cp
+import jsonlog
+import memprofile
+import spool
 import sys
+import transport
+import uploads
 
 from functools import partial
-from worker import Worker
+from jobqueue import CLASSES, SQLiteJobQueue
+from sdbindex import QueryError, SDBIndex
+from worker import INDEX_FILE, JOBS_FILE, WORKDIR, Worker
+
+
+# Shared by several worker nodes, uploads must be visible to all of them
+SPOOL_DIR = os.environ.get('MSDS_SPOOL')
+UPLOAD_DIR = os.path.join(SPOOL_DIR or WORKDIR, uploads.UPLOAD_DIR)
+UPLOAD_FIELDS = ('result_url', 'security_token', 'result_format', 'priority')
 
 
 class WorkerApp:
@@ -19,7 +31,143 @@ class WorkerApp:
     @cp.tools.json_in()
     def index(self):
         data = cp.request.json
-        self.worker_queue.put(data)
+        # Several documents at once are a bulk import
+        jobs, cls = (data, 'bulk') if isinstance(data, list) else (
+            [data], 'interactive')
+        # All jobs are checked first, so a bad one queues nothing
+        for job in jobs:
+            if not isinstance(job, dict):
+                raise cp.HTTPError(400, 'Job must be an object')
+            if not job.get('download_url'):
+                raise cp.HTTPError(400, 'download_url missing')
+            _check_job(job)
+        for job in jobs:
+            job.setdefault('trace_id', jsonlog.new_trace_id())
+            job.setdefault('priority', cls)
+            self.worker_queue.put(job)
+
+    @cp.expose
+    @cp.tools.allow(methods=['POST', 'PUT'])
+    @cp.tools.json_out()
+    @cp.config(**{'request.process_request_body': False})
+    def upload(self, **params):
+        """
+        Takes the PDF itself, either as raw body (``application/pdf``, job
+        fields in the query string) or as ``multipart/form-data`` with the
+        file in the ``file`` field. The optional ``sha256`` skips the
+        transfer of an already known document (send no body then).
+        """
+        request = cp.request
+        body = request.body
+        multipart = body.content_type.value.startswith('multipart/')
+        if not multipart:
+            # The job fields are in the query string, check before the
+            # transfer
+            _check_job(params)
+        try:
+            path = uploads.known(UPLOAD_DIR, params.get('sha256'))
+            if path is not None and not body.length:
+                sha256, size, duplicate = params['sha256'], None, True
+            elif multipart:
+                # Parsed by CherryPy, the file part is spooled to disk
+                body.maxbytes = uploads.MAX_UPLOAD + 64 * 1024
+                body.process()
+                params.update(body.params)
+                _check_job(params)
+                part = params.pop('file', None)
+                if part is None or not hasattr(part, 'file'):
+                    raise uploads.UploadError(400, 'No file field')
+                part.file.seek(0)
+                path, sha256, size, duplicate = uploads.spool(
+                    part.file, UPLOAD_DIR, sha256=params.get('sha256'))
+            elif body.length is None:
+                raise uploads.UploadError(411, 'Content-Length required')
+            else:
+                path, sha256, size, duplicate = uploads.spool(
+                    body.fp, UPLOAD_DIR, body.length, params.get('sha256'))
+            job = {k: v for k, v in params.items() if k in UPLOAD_FIELDS}
+            job['trace_id'] = jsonlog.new_trace_id()
+            # Removed by the worker once the job is done
+            job['pdf_path'] = uploads.link_job(UPLOAD_DIR, path,
+                                               job['trace_id'])
+        except uploads.UploadError as err:
+            raise cp.HTTPError(err.status, str(err))
+        job.setdefault('priority', 'interactive')
+        self.worker_queue.put(job)
+        return dict(sha256=sha256, size=size, duplicate=duplicate,
+                    trace_id=job['trace_id'])
+
+    @cp.expose
+    @cp.tools.allow(methods=['GET'])
+    @cp.tools.json_out()
+    def stats(self):
+        """Queue lengths and latencies by job class."""
+        return self.worker_queue.stats()
+
+    @cp.expose
+    @cp.tools.allow(methods=['GET'])
+    @cp.tools.json_out()
+    def dead(self, limit=100):
+        """Jobs which failed too often."""
+        return self.worker_queue.dead_jobs(int(limit))
+
+
+def _check_job(params):
+    if not params.get('result_url'):
+        raise cp.HTTPError(400, 'result_url missing')
+    if params.get('priority', 'interactive') not in CLASSES:
+        raise cp.HTTPError(400, 'Unknown priority: {}'.format(
+            params['priority']))
+    if params.get('result_format', 'json') not in transport.FORMATS:
+        raise cp.HTTPError(400, 'Unknown result format: {}'.format(
+            params['result_format']))
+
+
+class QueryApp:
+    """Read only access to the index of all processed documents."""
+
+    def __init__(self, sdb_index):
+        self.sdb_index = sdb_index
+
+    @cp.expose
+    @cp.tools.allow(methods=['GET'])
+    @cp.tools.json_out()
+    def index(self, q='', limit=100):
+        try:
+            found = self.sdb_index.query(q)
+        except QueryError as err:
+            raise cp.HTTPError(400, str(err))
+        return dict(total=len(found),
+                    results=[self.sdb_index.summary(x) for x in
+                             found[:int(limit)]])
+
+
+class DebugApp:
+
+    @cp.expose
+    @cp.tools.allow(methods=['GET', 'POST'])
+    @cp.tools.json_out()
+    def memory(self, action=None, top=memprofile.TOP):
+        """
+        Memory growth per pipeline stage and document, see memprofile.
+        POST with ``action`` start, stop or reset (also MSDS_MEMPROFILE=1
+        at startup).
+        """
+        if action is not None:
+            if cp.request.method != 'POST':
+                raise cp.HTTPError(405)
+            if action == 'start':
+                memprofile.enable()
+            elif action == 'stop':
+                memprofile.disable()
+            elif action == 'reset' and memprofile.get_profiler():
+                memprofile.get_profiler().reset()
+            elif action != 'reset':
+                raise cp.HTTPError(400, 'Unknown action: {}'.format(action))
+        profiler = memprofile.get_profiler()
+        if profiler is None:
+            return dict(running=False)
+        return profiler.report(int(top))
 
 
 def stop_worker(q):
@@ -53,8 +201,21 @@ config = {
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'production':
         config['global']['environment'] = 'production'
-    q = queue.Queue()
-    w = Worker(q)
+    # Format and level from MSDS_LOG_FORMAT and MSDS_LOG_LEVEL
+    jsonlog.configure()
+    if os.environ.get('MSDS_MEMPROFILE'):
+        memprofile.enable()
+    os.makedirs(WORKDIR, exist_ok=True)
+    # Jobs survive restarts, the ones in progress at a crash are redone
+    if SPOOL_DIR:
+        q = spool.SpoolQueue(SPOOL_DIR)
+    else:
+        q = SQLiteJobQueue(JOBS_FILE)
+    q.recover()
+    index = SDBIndex.load(INDEX_FILE)
+    w = Worker(q, index)
     w.start()
     cp.engine.subscribe('stop', partial(stop_worker, q))
+    cp.tree.mount(QueryApp(index), '/query', {'/': config['/']})
+    cp.tree.mount(DebugApp(), '/debug', {'/': config['/']})
     cp.quickstart(WorkerApp(q), '/', config)
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from jobqueue import CLASSES
+
+
+HOST = socket.gethostname()
+NODE = '{}-{}'.format(HOST, os.getpid())
+# A lease not renewed for this long (seconds) belongs to a dead node. The
+# clocks of the nodes must agree much better than this (NTP).
+LEASE_TIMEOUT = 600.0
+HEARTBEAT = 30.0
+POLL_INTERVAL = 5.0
+MAX_ATTEMPTS = 3
+_SEP = '@'
+
+
+@contextmanager
+def file_lock(filename):
+    """Exclusive lock (flock) for updates of files shared by the nodes."""
+    with open(filename, 'a') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _write_json(filename, value):
+    tmp_name = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    with open(tmp_name, 'w', encoding='utf-8') as fp:
+        json.dump(value, fp)
+    return tmp_name
+
+
+def _node_alive(node):
+    """False only for a process of this host which does not exist."""
+    host, _, pid = node.rpartition('-')
+    if host != HOST or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Task:
+    __slots__ = ('name', 'path', 'payload', 'attempts', 'errors', 'lost')
+
+    def __init__(self, name, path, record):
+        self.name = name
+        self.path = path
+        self.payload = record['payload']
+        self.attempts = record.get('attempts', 0)
+        self.errors = record.get('errors', [])
+        self.lost = False
+
+    def record(self):
+        return dict(payload=self.payload, attempts=self.attempts,
+                    errors=self.errors)
+
+
+class Spool:
+    """
+    Work shared by several nodes through a directory on a shared file
+    system, without a broker. A task is a JSON file in ``new/``; a node
+    claims it by renaming it into ``leased/`` under its node name. Renames
+    are atomic, so exactly one node gets a task. A heartbeat thread renews
+    (touches) the leases of the tasks in progress; a lease which was not
+    renewed for ``lease_timeout`` seconds, or whose process on this host is
+    gone, is moved back into ``new/`` by ``recover``. Tasks which failed
+    ``max_attempts`` times end up in ``failed/``. A link in ``names/``
+    reserves the name of a task until it is done or failed for good.
+    """
+
+    def __init__(self, directory, node=NODE, lease_timeout=LEASE_TIMEOUT,
+                 heartbeat=HEARTBEAT, max_attempts=MAX_ATTEMPTS):
+        self.directory = directory
+        self.node = node
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        for name in ('new', 'leased', 'failed', 'names', 'tmp'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._beat = threading.Thread(target=self._heartbeat_loop,
+                                      daemon=True)
+        self._beat.start()
+
+    def _path(self, sub, name=''):
+        return os.path.join(self.directory, sub, name)
+
+    def _names(self, sub):
+        try:
+            return sorted(os.listdir(self._path(sub)))
+        except FileNotFoundError:
+            return []
+
+    def add(self, name, payload):
+        """
+        Adds a task unless one with this name is waiting or in progress
+        (so every node may add the same corpus). Returns whether it was
+        added. Tasks are claimed in the order of their names.
+        """
+        filename = '{}.json'.format(quote(name, safe=''))
+        tmp_name = _write_json(self._path('tmp', filename),
+                               dict(payload=payload, attempts=0, errors=[]))
+        try:
+            # Unlike rename, link does not replace an existing name
+            os.link(tmp_name, self._path('names', filename))
+        except FileExistsError:
+            os.remove(tmp_name)
+            return False
+        os.rename(tmp_name, self._path('new', filename))
+        return True
+
+    def _unreserve(self, filename):
+        try:
+            os.remove(self._path('names', filename))
+        except FileNotFoundError:
+            pass
+
+    def claim(self):
+        """Leases the first waiting task, returns a Task or None."""
+        for filename in self._names('new'):
+            leased = self._path('leased', '{}{}{}'.format(filename, _SEP,
+                                                           self.node))
+            waiting = self._path('new', filename)
+            try:
+                # A rename keeps the mtime, which is the lease time. Touch
+                # first, so recover never sees a fresh lease as expired
+                os.utime(waiting)
+                os.rename(waiting, leased)
+                with open(leased, encoding='utf-8') as fp:
+                    record = json.load(fp)
+            except FileNotFoundError:
+                # Claimed by another node first
+                continue
+            except ValueError:
+                os.replace(leased, self._path('failed', filename))
+                self._unreserve(filename)
+                continue
+            task = Task(unquote(filename[:-len('.json')]), leased, record)
+            with self._lock:
+                self._held[leased] = task
+            return task
+        return None
+
+    def _release(self, task):
+        with self._lock:
+            self._held.pop(task.path, None)
+
+    def done(self, task):
+        self._release(task)
+        try:
+            os.remove(task.path)
+        except FileNotFoundError:
+            # Lease expired and taken over, the work was done twice
+            return
+        self._unreserve(os.path.basename(task.path).rpartition(_SEP)[0])
+
+    def fail(self, task, error=''):
+        """Puts the task back for a retry or into ``failed/``."""
+        self._release(task)
+        if task.lost:
+            return
+        task.attempts += 1
+        task.errors.append(dict(node=self.node, error=error,
+                                time=time.time()))
+        self._requeue(task.path, '{}.json'.format(quote(task.name, safe='')),
+                      task.record())
+
+    def _requeue(self, path, filename, record):
+        sub = 'failed' if record['attempts'] >= self.max_attempts else 'new'
+        tmp_name = _write_json(self._path('tmp', filename), record)
+        os.replace(tmp_name, self._path(sub, filename))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if sub == 'failed':
+            self._unreserve(filename)
+
+    def release_all(self, error='not finished'):
+        """Fails all tasks still held, e.g. when the node shuts down."""
+        with self._lock:
+            tasks = list(self._held.values())
+        for task in tasks:
+            self.fail(task, error)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                tasks = list(self._held.values())
+            for task in tasks:
+                try:
+                    os.utime(task.path)
+                except FileNotFoundError:
+                    task.lost = True
+
+    def leases(self, foreign=False):
+        """Names of the leased tasks, with ``foreign`` of other nodes only."""
+        own = '{}{}'.format(_SEP, self.node)
+        return [x for x in self._names('leased')
+                if not (foreign and x.endswith(own))]
+
+    def recover(self):
+        """
+        Moves expired leases (dead nodes) back into ``new/``, counting the
+        attempt. Returns the number of recovered tasks.
+        """
+        now = time.time()
+        num = 0
+        for leased in self.leases(foreign=True):
+            path = self._path('leased', leased)
+            filename, _, node = leased.rpartition(_SEP)
+            try:
+                expired = now - os.stat(path).st_mtime > self.lease_timeout
+            except FileNotFoundError:
+                continue
+            if not expired and _node_alive(node):
+                continue
+            # Claim the recovery, so only one node requeues the task
+            claimed = self._path('tmp', '{}{}{}'.format(leased, _SEP,
+                                                        self.node))
+            try:
+                os.rename(path, claimed)
+                with open(claimed, encoding='utf-8') as fp:
+                    record = json.load(fp)
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                os.replace(claimed, self._path('failed', filename))
+                self._unreserve(filename)
+                continue
+            record['attempts'] = record.get('attempts', 0) + 1
+            record.setdefault('errors', []).append(dict(
+                node=node, error='lease expired', time=now))
+            self._requeue(claimed, filename, record)
+            num += 1
+        return num
+
+    def tasks(self, wait=True):
+        """
+        Yields claimed tasks until the spool is empty. With ``wait`` also
+        until the other nodes are finished, so tasks of a node which dies
+        are still taken over. Call ``done`` or ``fail`` for every task.
+        """
+        while True:
+            task = self.claim()
+            if task is not None:
+                yield task
+                continue
+            if self.recover():
+                continue
+            if not wait or not self.leases(foreign=True):
+                return
+            time.sleep(POLL_INTERVAL)
+
+    def failed(self, limit=100):
+        out = []
+        for filename in self._names('failed')[:limit]:
+            try:
+                with open(self._path('failed', filename),
+                          encoding='utf-8') as fp:
+                    record = json.load(fp)
+            except (FileNotFoundError, ValueError):
+                continue
+            record['name'] = unquote(filename[:-len('.json')])
+            out.append(record)
+        return out
+
+    def close(self):
+        self._stop.set()
+        self._beat.join()
+
+
+class SpoolQueue:
+    """
+    Job queue for the worker service on several nodes with one shared
+    spool directory (see ``Spool``). Interactive jobs are served before
+    bulk jobs, within a class in order of arrival; the cost based
+    scheduling of ``jobqueue.SQLiteJobQueue`` is not available.
+    """
+
+    def __init__(self, directory, **kw):
+        self.spool = Spool(directory, **kw)
+        self._active = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._jobs = {cls: 0 for cls in CLASSES}
+
+    def put(self, job, priority=None):
+        if job is None:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            return
+        cls = priority or job.get('priority') or 'interactive'
+        if cls not in CLASSES:
+            raise ValueError('Unknown job class: {}'.format(cls))
+        name = '{}-{:017.6f}-{}'.format(CLASSES.index(cls), time.time(),
+                                         uuid.uuid4().hex[:8])
+        self.spool.add(name, dict(job=job, cls=cls))
+        with self._cond:
+            self._cond.notify()
+
+    def get(self):
+        """Blocks until a job is available, returns None once stopped."""
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return None
+            task = self.spool.claim()
+            if task is None and self.spool.recover():
+                continue
+            if task is not None:
+                break
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(POLL_INTERVAL)
+        job = task.payload['job']
+        with self._cond:
+            self._active[id(job)] = task
+            self._jobs[task.payload['cls']] += 1
+        return job
+
+    def done(self, job):
+        with self._cond:
+            task = self._active.pop(id(job))
+        self.spool.done(task)
+
+    def fail(self, job, error=''):
+        with self._cond:
+            task = self._active.pop(id(job))
+        self.spool.fail(task, error)
+
+    def recover(self):
+        return self.spool.recover()
+
+    def dead_jobs(self, limit=100):
+        return [dict(id=x['name'], job=x['payload']['job'],
+                     attempts=x['attempts'], errors=x['errors'])
+                for x in self.spool.failed(limit)]
+
+    def qsize(self):
+        return len(self.spool._names('new'))
+
+    def stats(self):
+        counts = {cls: dict(queued=0, leased=0, dead=0) for cls in CLASSES}
+        for sub, key in (('new', 'queued'), ('leased', 'leased'),
+                         ('failed', 'dead')):
+            for name in self.spool._names(sub):
+                rank = name.split('-', 1)[0]
+                if rank.isdigit() and int(rank) < len(CLASSES):
+                    counts[CLASSES[int(rank)]][key] += 1
+        with self._cond:
+            for cls in CLASSES:
+                counts[cls]['jobs'] = self._jobs[cls]
+        return counts
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.spool.close()
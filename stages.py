@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import json
+import os
+
+import resultstore
+
+
+STAGES = ('extract', 'parse', 'uba', 'enrich', 'finalize')
+# Raise a version when the output of a stage changes, all artifacts of the
+# stage (and, through the input digests, everything downstream) are then
+# recomputed.
+STAGE_VERSIONS = {
+    'extract': 1,
+    'parse': 1,
+    'uba': 1,
+    'enrich': 1,
+    'finalize': 1,
+}
+
+
+def forced_stages(from_stage=None, only=None):
+    """
+    Returns the stages which are recomputed even with a valid artifact:
+    ``from_stage`` and all following stages, or just ``only``.
+    """
+    for name in (from_stage, only):
+        if name is not None and name not in STAGES:
+            raise ValueError('Unknown stage: {}'.format(name))
+    if only is not None:
+        return {only}
+    if from_stage is not None:
+        return set(STAGES[STAGES.index(from_stage):])
+    return set()
+
+
+def digest(value):
+    raw = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
+
+
+def source_digest(filename):
+    """Input digest of the first stage: path, size and mtime of the PDF."""
+    st = os.stat(filename)
+    return digest([os.path.abspath(filename), st.st_size, st.st_mtime])
+
+
+class ArtifactStore:
+    """
+    The intermediate result of every stage per document as gzipped JSON,
+    kept by the result store: in ``outdir/stages/STAGE/`` (same letter
+    layout as the results) or in the SQLite database. An artifact is only
+    valid for the stage version and the digest of the input it was
+    computed from.
+    """
+
+    def __init__(self, outdir, store=None):
+        self.store = store or resultstore.DirectoryStore(outdir)
+
+    def load(self, stage, doc_id, inputs):
+        """
+        Returns the artifact data and its digest, or (None, None) if it is
+        missing or stale.
+        """
+        raw = self.store.get_artifact(stage, doc_id, 'json.gz')
+        if raw is None:
+            return None, None
+        try:
+            artifact = json.loads(gzip.decompress(raw).decode('utf-8'))
+        except (OSError, ValueError):
+            return None, None
+        if (artifact.get('version') != STAGE_VERSIONS[stage] or
+                artifact.get('inputs') != inputs):
+            return None, None
+        return artifact['data'], artifact['digest']
+
+    def save(self, stage, doc_id, inputs, data):
+        """Stores the artifact, returns its digest (input of the next)."""
+        artifact = dict(stage=stage, version=STAGE_VERSIONS[stage],
+                        inputs=inputs, digest=digest(data), data=data)
+        raw = json.dumps(artifact, sort_keys=True, default=str)
+        self.store.put_artifact(stage, doc_id, 'json.gz',
+                                gzip.compress(raw.encode('utf-8')))
+        return artifact['digest']
+
+    def save_blob(self, stage, doc_id, content, ext='png'):
+        self.store.put_artifact(stage, doc_id, ext, content)
+
+    def load_blob(self, stage, doc_id, ext='png'):
+        return self.store.get_artifact(stage, doc_id, ext)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import signal
+import subprocess
+import threading
+
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+MB = 1024 * 1024
+CHUNK_SIZE = 1 << 16
+# Wall clock (seconds) and address space (bytes) limit per external tool,
+# None means no limit.
+TOOL_LIMITS = {
+    'pdftotext': dict(timeout=60, memory=512 * MB),
+    'gs': dict(timeout=300, memory=2048 * MB),
+    'tesseract': dict(timeout=120, memory=1024 * MB),
+}
+# util-linux prlimit sets the limit before the tool runs
+PRLIMIT = shutil.which('prlimit')
+_STATS = Counter()
+_STATS_LOCK = threading.Lock()
+
+
+class ToolTimeout(subprocess.TimeoutExpired):
+    pass
+
+
+def configure(tool, timeout=None, memory=None):
+    """Sets the limits for a tool (memory in MB, 0 removes a limit)."""
+    limits = TOOL_LIMITS.setdefault(tool, dict(timeout=None, memory=None))
+    if timeout is not None:
+        limits['timeout'] = timeout or None
+    if memory is not None:
+        limits['memory'] = memory * MB or None
+
+
+def parse_limit(spec):
+    """
+    Parses ``TOOL=SECONDS[:MB]`` (e.g. ``gs=120:1024``) from the command
+    line and applies it.
+    """
+    tool, _, value = spec.partition('=')
+    timeout, _, memory = value.partition(':')
+    configure(tool.strip(), int(timeout) if timeout else None,
+              int(memory) if memory else None)
+
+
+def count(tool, event):
+    with _STATS_LOCK:
+        _STATS[(tool, event)] += 1
+
+
+def stats():
+    """Returns the counted events (ok, error, timeout) by tool."""
+    out = {}
+    with _STATS_LOCK:
+        for (tool, event), num in _STATS.items():
+            out.setdefault(tool, {})[event] = num
+    return out
+
+
+def _kill(proc):
+    try:
+        if os.name == 'nt':
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _spawn(tool, cmd, **kw):
+    """
+    Starts the tool in its own process group with its memory limit. No
+    preexec_fn, which is not safe in a process with threads: the command
+    is run through prlimit or, without it, the limit is set right after
+    the start (Linux only).
+    """
+    memory = TOOL_LIMITS.get(tool, {}).get('memory')
+    if os.name == 'nt':
+        kw['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        return subprocess.Popen(cmd, **kw)
+    kw['start_new_session'] = True
+    if memory and PRLIMIT:
+        cmd = [PRLIMIT, '--as={}'.format(memory), '--'] + list(cmd)
+        memory = None
+    proc = subprocess.Popen(cmd, **kw)
+    if memory and hasattr(resource, 'prlimit'):
+        try:
+            resource.prlimit(proc.pid, resource.RLIMIT_AS, (memory, memory))
+        except ProcessLookupError:
+            # Already finished
+            pass
+    return proc
+
+
+def stream_tool(tool, cmd):
+    """
+    Like ``run_tool``, but yields stdout in chunks (bytes) as soon as the
+    tool writes them. Closing the generator early kills the tool, the
+    timeout is enforced by a timer.
+    """
+    timeout = TOOL_LIMITS.get(tool, {}).get('timeout')
+    proc = _spawn(tool, cmd, stdout=subprocess.PIPE)
+    expired = threading.Event()
+
+    def _expire():
+        expired.set()
+        _kill(proc)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        while True:
+            chunk = proc.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.poll() is None:
+            _kill(proc)
+            proc.wait()
+            count(tool, 'stopped')
+        proc.stdout.close()
+    if expired.is_set():
+        count(tool, 'timeout')
+        raise ToolTimeout(cmd, timeout)
+    if proc.returncode:
+        count(tool, 'error')
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    count(tool, 'ok')
+
+
+def run_tool(tool, cmd, capture=False):
+    """
+    Runs an external tool in its own process group with the configured
+    limits. On timeout the whole process group is killed and ToolTimeout
+    is raised, a non-zero exit (e.g. out of memory) raises
+    CalledProcessError. Both are counted, see ``stats``.
+
+    :parameters:
+        tool : str
+            Key in ``TOOL_LIMITS``.
+        cmd : list
+            The command.
+        capture : bool
+            Return stdout (bytes).
+    """
+    timeout = TOOL_LIMITS.get(tool, {}).get('timeout')
+    proc = _spawn(tool, cmd, stdout=subprocess.PIPE if capture else None)
+    try:
+        out, _ = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(proc)
+        proc.communicate()
+        count(tool, 'timeout')
+        raise ToolTimeout(cmd, timeout)
+    except BaseException:
+        _kill(proc)
+        proc.wait()
+        raise
+    if proc.returncode:
+        count(tool, 'error')
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    count(tool, 'ok')
+    return out
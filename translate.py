@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import re
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+CACHE_FILE = 'translations.json'
+TRANSLATE_URL = 'http://translate.google.com/translate_a/t'
+# Names per request are limited by the URL length (umlauts are encoded
+# in up to six characters)
+MAX_QUERY_CHARS = 1000
+
+TRANS = {
+    'natriumhydrogencarbonat': 'sodium bicarbonate',
+    'isopropylphenazon plv.': 'propyphenazone',
+    'kresolrot': 'cresol red',
+    'm-kresolpurpur': 'm-cresol purple',
+}
+
+# Grades, purities and forms which do not change the substance
+PURITY_re = re.compile(
+    r'(?:[\s,]+|^)(?:p\.\s?a\.?|z\.\s?a\.?|zur analyse|reinst|rein|puriss\.?|'
+    r'purum|techn\.?|technisch|plv\.?|pulver|krist\.?|kristallin|'
+    r'granuliert|gepulvert|wasserfrei|extra pure|for analysis|'
+    r'ph\.\s?eur\.?|usp|acs|[<>≥~]?\s*\d+(?:[.,]\d+)?\s*%)\s*$'
+)
+MULTIPLIERS = {
+    'mono': 'mono', 'di': 'di', 'tri': 'tri', 'tetra': 'tetra',
+    'penta': 'penta', 'hexa': 'hexa', 'hepta': 'hepta', 'octa': 'octa',
+    'okta': 'octa', 'nona': 'nona', 'deca': 'deca', 'deka': 'deca',
+}
+HYDRATE_re = re.compile(r'[\s-]*({})?hydrat$'.format('|'.join(MULTIPLIERS)))
+CATIONS = {
+    'aluminium': 'aluminium', 'ammonium': 'ammonium', 'barium': 'barium',
+    'blei(ii)': 'lead(II)', 'cäsium': 'caesium', 'calcium': 'calcium',
+    'cobalt(ii)': 'cobalt(II)', 'eisen(ii)': 'iron(II)',
+    'eisen(iii)': 'iron(III)', 'kalium': 'potassium', 'kupfer(i)': 'copper(I)',
+    'kupfer(ii)': 'copper(II)', 'lithium': 'lithium',
+    'magnesium': 'magnesium', 'mangan(ii)': 'manganese(II)',
+    'natrium': 'sodium', 'nickel(ii)': 'nickel(II)',
+    'quecksilber(ii)': 'mercury(II)', 'silber': 'silver',
+    'strontium': 'strontium', 'zink': 'zinc', 'zinn(ii)': 'tin(II)',
+}
+ANIONS = {
+    'acetat': 'acetate', 'azid': 'azide', 'borat': 'borate',
+    'bromid': 'bromide', 'carbonat': 'carbonate', 'chlorat': 'chlorate',
+    'chlorid': 'chloride', 'chromat': 'chromate', 'citrat': 'citrate',
+    'cyanid': 'cyanide', 'dichromat': 'dichromate',
+    'dihydrogenphosphat': 'dihydrogen phosphate', 'fluorid': 'fluoride',
+    'formiat': 'formate', 'hydrogencarbonat': 'hydrogen carbonate',
+    'hydrogenphosphat': 'hydrogen phosphate',
+    'hydrogensulfat': 'hydrogen sulfate', 'hydroxid': 'hydroxide',
+    'iodid': 'iodide', 'jodid': 'iodide', 'molybdat': 'molybdate',
+    'nitrat': 'nitrate', 'nitrit': 'nitrite', 'oxalat': 'oxalate',
+    'oxid': 'oxide', 'perchlorat': 'perchlorate',
+    'permanganat': 'permanganate', 'peroxid': 'peroxide',
+    'phosphat': 'phosphate', 'silicat': 'silicate', 'sulfat': 'sulfate',
+    'sulfid': 'sulfide', 'sulfit': 'sulfite', 'tartrat': 'tartrate',
+    'thiocyanat': 'thiocyanate', 'thiosulfat': 'thiosulfate',
+}
+
+
+def normalize(name):
+    """Lower case, single spaces and without grade or purity suffixes."""
+    name = ' '.join(name.lower().replace(' ', ' ').split())
+    while True:
+        new = PURITY_re.sub('', name).strip(' ,;')
+        if new == name:
+            return name
+        name = new
+
+
+def _split_multiplier(text, table):
+    for prefix in sorted(MULTIPLIERS, key=len, reverse=True):
+        if text.startswith(prefix) and text[len(prefix):] in table:
+            return MULTIPLIERS[prefix], table[text[len(prefix):]]
+    if text in table:
+        return '', table[text]
+    return None
+
+
+def compose_salt(name):
+    """
+    Translates simple salts (cation + anion, optionally with multipliers
+    and hydrate water), e.g. 'dinatriumhydrogenphosphat-dihydrat'.
+    """
+    hydrate = ''
+    m = HYDRATE_re.search(name)
+    if m is not None:
+        mult = MULTIPLIERS.get(m.group(1) or '', '')
+        hydrate = ' {}hydrate'.format(mult)
+        name = name[:m.start()]
+    for cation in sorted(CATIONS, key=len, reverse=True):
+        pos = name.find(cation)
+        if pos < 0:
+            continue
+        prefix = name[:pos]
+        if prefix and prefix not in MULTIPLIERS:
+            continue
+        anion = _split_multiplier(name[pos + len(cation):].strip(' -'),
+                                  ANIONS)
+        if anion is None:
+            continue
+        return '{}{} {}{}{}'.format(MULTIPLIERS.get(prefix, ''),
+                                    CATIONS[cation], anion[0], anion[1],
+                                    hydrate)
+    return None
+
+
+def _chunks(names, max_chars=MAX_QUERY_CHARS):
+    chunk = []
+    size = 0
+    for name in names:
+        if chunk and size + len(name) + 1 > max_chars:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(name)
+        size += len(name) + 1
+    if chunk:
+        yield chunk
+
+
+def batch_translate(names):
+    """
+    Translates all names with as few requests as the URL length allows
+    (one name per line).
+
+    :returns: The translations by name (missing on errors).
+    :rtype: dict
+    """
+    found = {}
+    for chunk in _chunks(sorted(names)):
+        found.update(_translate_lines(chunk))
+    return found
+
+
+def _translate_lines(names):
+    params = dict(client='z', sl='de', tl='en', ie='UTF-8', oe='UTF-8',
+                  text='\n'.join(names))
+    try:
+        r = requests.get(TRANSLATE_URL, params=params)
+        r.raise_for_status()
+        data = r.json()
+    except (requests.RequestException, ValueError) as err:
+        logger.warning('Translation failed: %s', err)
+        return {}
+    if isinstance(data, list):
+        data = '\n'.join(str(x) for x in data)
+    lines = [x.strip() for x in str(data).split('\n')]
+    if len(lines) != len(names):
+        return {}
+    return dict(zip(names, lines))
+
+
+class OfflineTranslator:
+    """
+    German to English chemical names from local data: the TRANS table,
+    UBA names and synonyms, translations confirmed by PubChem hits and
+    earlier batch translations. Names which can not be resolved are
+    collected for one batched lookup (``resolve_pending``).
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.english = set()
+        self.confirmed = {}
+        self.machine = {}
+        self.pending = set()
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, encoding='utf-8') as fp:
+                cache = json.load(fp)
+            self.confirmed = cache.get('confirmed', {})
+            self.machine = cache.get('machine', {})
+
+    @classmethod
+    def from_uba(cls, uba_data, cache_file=None):
+        self = cls(cache_file)
+        for de, en in uba_data.get('name_de_en', {}).items():
+            if en:
+                self.entries[normalize(de)] = en
+        for en in uba_data.get('name_en_cas', {}):
+            if en:
+                self.english.add(normalize(en))
+        for item in uba_data.get('cas_all', {}).values():
+            en = item.get('name_en', '')
+            if not en:
+                continue
+            for de in [item.get('name', '')] + item.get('synonyms', []):
+                if de:
+                    self.entries.setdefault(normalize(de), en)
+        for de, en in TRANS.items():
+            self.entries[normalize(de)] = en
+        return self
+
+    def lookup(self, name):
+        """Returns the English name or None without remembering misses."""
+        key = normalize(name)
+        if not key:
+            return None
+        for table in (self.confirmed, self.entries, self.machine):
+            if key in table:
+                return table[key]
+        if key in self.english:
+            return name.strip()
+        return compose_salt(key)
+
+    def translate(self, name):
+        en = self.lookup(name)
+        if en is None and normalize(name):
+            self.pending.add(normalize(name))
+        return en
+
+    def confirm(self, name, en_name):
+        """Remembers a translation which led to a PubChem hit."""
+        key = normalize(name)
+        if key and en_name and key != normalize(en_name):
+            self.confirmed[key] = en_name
+            self.machine.pop(key, None)
+
+    def resolve_pending(self, translate_func=batch_translate):
+        """
+        Looks up all collected names at once.
+
+        :returns: The new translations by normalized name.
+        :rtype: dict
+        """
+        todo = {x for x in self.pending if self.lookup(x) is None}
+        self.pending = set()
+        found = translate_func(todo) if todo else {}
+        for key, en in found.items():
+            if en and en.lower() != key:
+                self.machine[key] = en
+        return found
+
+    def save(self):
+        """
+        Writes the cache, merged with translations saved meanwhile by other
+        processes (e.g. other nodes sharing the output directory).
+        """
+        if not self.cache_file:
+            return
+        if os.path.isfile(self.cache_file):
+            with open(self.cache_file, encoding='utf-8') as fp:
+                cache = json.load(fp)
+            for key, en in cache.get('confirmed', {}).items():
+                self.confirmed.setdefault(key, en)
+            for key, en in cache.get('machine', {}).items():
+                if key not in self.confirmed:
+                    self.machine.setdefault(key, en)
+        tmp_name = '{}.tmp'.format(self.cache_file)
+        with open(tmp_name, 'w', encoding='utf-8') as fp:
+            json.dump(dict(confirmed=self.confirmed, machine=self.machine), fp,
+                      indent=2, sort_keys=True)
+        os.replace(tmp_name, self.cache_file)
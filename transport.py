@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import os
+import struct
+
+import requests
+
+
+FORMATS = ('json', 'multipart', 'envelope')
+ENVELOPE_TYPE = 'application/x-msds-envelope'
+MAGIC = b'MSDSENV1'
+CHUNK_SIZE = 1 << 16
+_HEAD = struct.Struct('<8sI')
+_SIZE = struct.Struct('<Q')
+
+
+def _envelope_parts(result, structure_path=None):
+    raw = json.dumps(result, sort_keys=True).encode('utf-8')
+    size = os.path.getsize(structure_path) if structure_path else 0
+    yield _HEAD.pack(MAGIC, len(raw)) + raw + _SIZE.pack(size)
+    if structure_path:
+        with open(structure_path, 'rb') as fp:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def pack_envelope(result, structure=b''):
+    """
+    Returns the binary envelope: magic, JSON length (uint32), JSON, image
+    length (uint64) and the raw image, all little endian.
+    """
+    raw = json.dumps(result, sort_keys=True).encode('utf-8')
+    return (_HEAD.pack(MAGIC, len(raw)) + raw + _SIZE.pack(len(structure)) +
+            structure)
+
+
+def _read_exact(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError('Envelope truncated')
+    return data
+
+
+def read_envelope(fp, image_fp=None):
+    """
+    Reads an envelope from a file like object. The image is copied in
+    chunks to ``image_fp`` (e.g. a file opened for writing), so it never
+    has to be kept in memory. Without ``image_fp`` it is returned as bytes.
+
+    :returns: The result and the image (or the number of copied bytes).
+    :rtype: tuple
+    """
+    magic, json_size = _HEAD.unpack(_read_exact(fp, _HEAD.size))
+    if magic != MAGIC:
+        raise ValueError('Not a result envelope')
+    result = json.loads(_read_exact(fp, json_size).decode('utf-8'))
+    size = _SIZE.unpack(_read_exact(fp, _SIZE.size))[0]
+    if image_fp is None:
+        return result, _read_exact(fp, size)
+    remaining = size
+    while remaining:
+        chunk = fp.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise ValueError('Envelope truncated')
+        image_fp.write(chunk)
+        remaining -= len(chunk)
+    return result, size
+
+
+def send_result(result_url, result, structure_path=None, fmt='json'):
+    """
+    Posts a prepared result (see ``prepare.prepare_data``) to the receiver.
+
+    :parameters:
+        result_url : str
+            The receiving URL.
+        result : dict
+            The prepared chemical, without embedded structure unless the
+            legacy format is used.
+        structure_path : str
+            The structure PNG (or None).
+        fmt : str
+            ``json`` (legacy, base64 embedded image), ``multipart`` (JSON
+            in the ``result`` field, PNG in the ``structure`` file field)
+            or ``envelope`` (binary, see ``pack_envelope``).
+
+    :rtype: requests.Response
+    """
+    if fmt == 'json':
+        if structure_path and not result.get('structure'):
+            with open(structure_path, 'rb') as fp:
+                result['structure'] = base64.b64encode(fp.read()).decode(
+                    'ascii')
+        return requests.post(result_url, json=result)
+    if fmt == 'multipart':
+        fields = {'result': (None, json.dumps(result, sort_keys=True),
+                             'application/json')}
+        if not structure_path:
+            return requests.post(result_url, files=fields)
+        with open(structure_path, 'rb') as fp:
+            fields['structure'] = (os.path.basename(structure_path), fp,
+                                   'image/png')
+            return requests.post(result_url, files=fields)
+    if fmt == 'envelope':
+        return requests.post(result_url,
+                             data=_envelope_parts(result, structure_path),
+                             headers={'Content-Type': ENVELOPE_TYPE})
+    raise ValueError('Unknown result format: {}'.format(fmt))
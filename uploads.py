@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import re
+import tempfile
+
+
+UPLOAD_DIR = 'uploads'
+# One hard link of the upload per queued job, see link_job
+JOB_DIR = 'jobs'
+MAX_UPLOAD = 50 * 1024 * 1024
+CHUNK_SIZE = 1 << 16
+_SHA256_re = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+
+    def __init__(self, status, message):
+        ValueError.__init__(self, message)
+        self.status = status
+
+
+def upload_path(upload_dir, sha256):
+    return os.path.join(upload_dir, '{}.pdf'.format(sha256))
+
+
+def check_hash(sha256):
+    sha256 = (sha256 or '').strip().lower()
+    if sha256 and not _SHA256_re.match(sha256):
+        raise UploadError(400, 'Invalid SHA-256: {}'.format(sha256))
+    return sha256
+
+
+def known(upload_dir, sha256):
+    """Returns the path of an already uploaded file or None."""
+    sha256 = check_hash(sha256)
+    if sha256 and os.path.isfile(upload_path(upload_dir, sha256)):
+        return upload_path(upload_dir, sha256)
+    return None
+
+
+def link_job(upload_dir, path, job_id):
+    """
+    Links an upload for a job (``jobs/JOB_ID/SHA256.pdf``), so it is kept
+    until every job using it is finished (``release``). Returns the path
+    of the link.
+    """
+    job_dir = os.path.join(upload_dir, JOB_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    link = os.path.join(job_dir, os.path.basename(path))
+    try:
+        os.link(path, link)
+    except FileNotFoundError:
+        os.rmdir(job_dir)
+        raise UploadError(409, 'Upload removed meanwhile, send it again')
+    return link
+
+
+def release(link):
+    """
+    Removes the link of a finished job and the upload itself once no
+    other job links to it (the link count is the reference count).
+    """
+    job_dir = os.path.dirname(link)
+    upload_dir = os.path.dirname(os.path.dirname(job_dir))
+    path = os.path.join(upload_dir, os.path.basename(link))
+    try:
+        os.remove(link)
+        os.rmdir(job_dir)
+    except FileNotFoundError:
+        pass
+    try:
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+    except FileNotFoundError:
+        # Released by another job at the same time
+        pass
+
+
+def spool(fp, upload_dir, length=None, sha256=None, max_bytes=MAX_UPLOAD):
+    """
+    Copies an uploaded PDF in chunks from ``fp`` into ``upload_dir``, named
+    by its SHA-256, so the same document is stored only once. Reads at most
+    ``length`` bytes (the Content-Length) and fails once more than
+    ``max_bytes`` arrive or if the content does not match ``sha256``.
+
+    :returns: The path, the hash, the size and whether the file was
+              already known.
+    :rtype: tuple
+    """
+    expected = check_hash(sha256)
+    if length is not None and length > max_bytes:
+        raise UploadError(413, 'Upload larger than {} bytes'.format(
+            max_bytes))
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    remaining = length
+    tmp = tempfile.NamedTemporaryFile(dir=upload_dir, suffix='.part',
+                                      delete=False)
+    try:
+        with tmp:
+            while remaining is None or remaining > 0:
+                want = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE,
+                                                                remaining)
+                chunk = fp.read(want)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(413, 'Upload larger than {} '
+                                      'bytes'.format(max_bytes))
+                if size == len(chunk) and not chunk.startswith(b'%PDF'):
+                    raise UploadError(415, 'Not a PDF')
+                digest.update(chunk)
+                tmp.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+        if remaining:
+            raise UploadError(400, 'Upload truncated')
+        if not size:
+            raise UploadError(400, 'Empty upload')
+        sha = digest.hexdigest()
+        if expected and sha != expected:
+            raise UploadError(400, 'SHA-256 mismatch')
+        path = upload_path(upload_dir, sha)
+        duplicate = os.path.isfile(path)
+        if duplicate:
+            os.remove(tmp.name)
+        else:
+            os.replace(tmp.name, path)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return path, sha, size, duplicate
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
 
 
@@ -23,6 +24,15 @@ def validate_cas(cas_nr):
         return ''
 
 
+def get_doc_id(filename):
+    """Returns the document ID (file name without a leading 'SDB')."""
+    _fn = os.path.split(filename)[1]
+    fn = os.path.splitext(_fn)[0]
+    if fn.startswith('SDB'):
+        fn = fn[3:].strip()
+    return fn
+
+
 class ParserSpec:
 
     def __init__(self, id, regex, flags=0, func=None, default=''):
@@ -1,62 +1,130 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
+import logging
 import os
 import requests
+import shutil
 import sys
 
 from subprocess import call
 from tempfile import TemporaryDirectory
 from threading import Thread
 
+import jobqueue
+import jsonlog
+import memprofile
 import prepare
+import ratelimit
+import resultstore
+import sdbindex
 import sdbparser
+import transport
 import uba
+import uploads
 
 
+logger = logging.getLogger(__name__)
 WORKDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workdir')
 UBA_FILE = os.path.join(WORKDIR, 'uba.json')
+INDEX_FILE = os.path.join(WORKDIR, sdbindex.INDEX_FILE)
+JOBS_FILE = os.path.join(WORKDIR, jobqueue.JOBS_DB)
+# Kept across jobs, so near duplicates of earlier documents are found
+RESULTS_FILE = os.path.join(WORKDIR, resultstore.DB_FILE)
 
 
 class Worker(Thread):
 
-    def __init__(self, queue):
+    def __init__(self, queue, index=None):
         Thread.__init__(self)
         self.queue = queue
+        self.index = index
 
-    def run(self):
+    def setup(self):
         if not os.path.isfile(UBA_FILE):
             uba.main(WORKDIR)
+
+    def run(self):
+        self.setup()
         while True:
             item = self.queue.get()
             if item is None:
                 break
-            self._process_item(**item)
+            trace_id = item.get('trace_id') or jsonlog.new_trace_id()
+            # Interactive jobs go before bulk jobs and CLI runs to PubChem
+            cls = item.get('priority') or 'interactive'
+            profiler = memprofile.get_profiler()
+            before = None
+            if profiler is not None and profiler.running:
+                before = profiler.totals()
+            with jsonlog.context(job=trace_id), ratelimit.priority(cls):
+                try:
+                    with jsonlog.timed(logger, 'Job finished'):
+                        self._process_item(**item)
+                except Exception as err:
+                    # Retried by the queue, see jobqueue.SQLiteJobQueue
+                    logger.exception('Job failed')
+                    self.queue.fail(item, repr(err))
+                else:
+                    self.queue.done(item)
+                    if item.get('pdf_path'):
+                        # Kept for retries (and dead jobs) until done
+                        uploads.release(item['pdf_path'])
+                if before is not None:
+                    # Only this job, the full report is at /debug/memory
+                    delta = profiler.delta(before)
+                    logger.info('Memory growth: %s',
+                                memprofile.format_delta(delta) or 'none',
+                                extra=dict(growth=sum(delta.values())))
 
-    def _process_item(self, download_url, result_url, **kw):
+    def _process_item(self, result_url, download_url=None, pdf_path=None,
+                      **kw):
         token = kw.get('security_token', '')
+        result_format = kw.get('result_format', 'json')
         tmp = TemporaryDirectory(prefix='msds-', dir=WORKDIR)
         outdir = os.path.join(tmp.name, 'out')
         json_file = os.path.join(outdir, 'all.json')
         result_file = os.path.join(outdir, 'single_chem.json')
-        r = requests.get(download_url)
-        if r.status_code != 200:
-            return
-        with open(os.path.join(tmp.name, 'sdb.pdf'), 'wb') as fp:
-            fp.write(r.content)
-        sdbparser.batch_call(outdir, [tmp.name], True, UBA_FILE)
+        # Named by the content hash, which is the document ID in the index
+        if pdf_path is not None:
+            # Uploaded (already named so), see server.WorkerApp.upload
+            shutil.copyfile(pdf_path, os.path.join(
+                tmp.name, os.path.basename(pdf_path)))
+        else:
+            r = requests.get(download_url)
+            r.raise_for_status()
+            sha256 = hashlib.sha256(r.content).hexdigest()
+            with open(os.path.join(tmp.name, '{}.pdf'.format(sha256)),
+                      'wb') as fp:
+                fp.write(r.content)
+        # The translations and fingerprints stay in WORKDIR. Finalize
+        # always runs, the other stages are stale for a new temporary PDF
+        # path, enrich is not forced so earlier revisions are reused.
+        sdbparser.batch_call(outdir, [tmp.name], uba_file=UBA_FILE,
+                             store='sqlite:' + RESULTS_FILE, only='finalize',
+                             memory_report=False, cache_dir=WORKDIR)
         if not os.path.isfile(json_file):
             return
         with open(json_file, encoding='utf-8') as fp:
             data = json.load(fp)
+        if self.index is not None and data:
+            self.index.add(data[0])
+            self.index.save()
+        structure = data[0].get('structure', '') if data else ''
         try:
-            prepare.prepare_data(data[0], outdir)
+            prepare.prepare_data(data[0], outdir, result_format == 'json')
         except:
             pass
         if os.path.isfile(result_file):
             with open(result_file, encoding='utf-8') as fp:
                 result = json.load(fp)
             result['security_token'] = token
-            requests.post(result_url, json=result)
+            if not os.path.isfile(structure):
+                structure = None
+            r = transport.send_result(result_url, result, structure,
+                                      result_format)
+            # Failed deliveries go through the retries of the queue
+            r.raise_for_status()
 